@@ -0,0 +1,310 @@
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import timeit
+from array import array
+
+from bson import ObjectId
+
+from memeshark.config import setup_logging
+from memeshark.graph import build_commit_graph, ChainPartition, CommitStatus
+from memeshark.fingerprint import fingerprint
+from memeshark.merge import propagate_changes
+from memeshark.metrics import fingerprints, numpy
+from memeshark.offline import OfflineWorker
+from memeshark.storage import MemoryStorage
+
+
+def generate_history(no_commits, branch_probability=0.05, merge_probability=0.05, seed=42, shuffle=True):
+    """
+    Generates a synthetic commit history in the format of the projected commit documents.
+    :param no_commits: number of commits
+    :param branch_probability: probability that a commit starts a new branch from a random earlier commit
+    :param merge_probability: probability that a commit merges two heads
+    :param seed: seed for the random number generator
+    :param shuffle: if false, the parents of a commit precede the commit in the list
+    :return: list of dicts with the keys _id, revision_hash, and parents
+    """
+    rnd = random.Random(seed)
+    commits = []
+    heads = []
+    for i in range(0, no_commits):
+        commit = {'_id': ObjectId(), 'revision_hash': '%040x' % rnd.getrandbits(160), 'parents': []}
+        if len(commits) > 0:
+            if rnd.random() < branch_probability or len(heads) == 0:
+                heads.append(rnd.choice(commits)['revision_hash'])
+            head = rnd.randrange(len(heads))
+            commit['parents'].append(heads[head])
+            if len(heads) > 1 and rnd.random() < merge_probability:
+                commit['parents'].append(heads.pop(head - 1))
+                head = heads.index(commit['parents'][0])
+            heads[head] = commit['revision_hash']
+        else:
+            heads.append(commit['revision_hash'])
+        commits.append(commit)
+    # the cursor does not return the commits in topological order
+    if shuffle:
+        rnd.shuffle(commits)
+    return commits
+
+
+def benchmark_graph(args, logger):
+    """
+    Measures the time required to build the commit graph for different numbers of commits.
+    :param args: parsed command line arguments
+    :param logger: logger for the results
+    """
+    logger.info("%10s %10s %12s %14s", "commits", "edges", "time (s)", "commits / s")
+    for no_commits in args.sizes:
+        commits = generate_history(no_commits)
+        elapsed = []
+        for _ in range(0, args.repeat):
+            start_time = timeit.default_timer()
+            commit_graph, missing = build_commit_graph(commits)
+            elapsed.append(timeit.default_timer() - start_time)
+        best = min(elapsed)
+        logger.info("%10i %10i %12.4f %14.0f", no_commits, commit_graph.number_of_edges(), best, no_commits / best)
+
+
+def generate_hierarchy(no_ces, depth):
+    """
+    Generates a synthetic hierarchy of code entity states of one commit as disjoint chains of parent references, e.g.,
+    nested classes and their methods. The roots of the chains changed, all other code entity states are unchanged.
+    :param no_ces: number of code entity states
+    :param depth: depth of the hierarchy
+    :return: tuple of the IDs of the unchanged states, the mapping to their parents, and the IDs of the changed states
+    """
+    ces_unchanged = []
+    ces_unchanged_parents = {}
+    ces_changed = []
+    parent = None
+    for i in range(0, no_ces):
+        ces = ObjectId()
+        if i % depth == 0:
+            ces_changed.append(ces)
+        else:
+            ces_unchanged.append(ces)
+            ces_unchanged_parents[ces] = parent
+        parent = ces
+    return ces_unchanged, ces_unchanged_parents, ces_changed
+
+
+def _propagate_changes_fixpoint(ces_unchanged, ces_unchanged_parents, ces_changed):
+    """
+    Reference of the former propagation in :meth:`~memeshark.memeshark.MemeSHARKWorker._merge_node`, which rescans
+    the unchanged states until no parent changed anymore.
+    :param ces_unchanged: IDs of the unchanged code entity states
+    :param ces_unchanged_parents: mapping from the IDs of the unchanged code entity states to the IDs of their parents
+    :param ces_changed: IDs of the changed code entity states
+    :return: list of the IDs of the unchanged code entity states that must be kept
+    """
+    ces_unchanged = list(ces_unchanged)
+    ces_changed = list(ces_changed)
+    saved = []
+    saved_children = True
+    while saved_children:
+        saved_children = False
+        for ces in ces_unchanged:
+            if ces_unchanged_parents[ces] in ces_changed:
+                saved_children = True
+                saved.append(ces)
+                ces_changed.append(ces)
+                ces_unchanged.remove(ces)
+    return saved
+
+
+def benchmark_propagation(args, logger):
+    """
+    Measures the time required to propagate changed parents through a deep hierarchy of code entity states.
+    :param args: parsed command line arguments
+    :param logger: logger for the results
+    """
+    logger.info("%10s %8s %14s %14s", "states", "depth", "time (s)", "fixpoint (s)")
+    for no_ces in args.sizes:
+        hierarchy = generate_hierarchy(no_ces, args.depth)
+        elapsed = []
+        for _ in range(0, args.repeat):
+            start_time = timeit.default_timer()
+            saved = propagate_changes(*hierarchy)
+            elapsed.append(timeit.default_timer() - start_time)
+        if no_ces <= args.fixpoint_limit:
+            start_time = timeit.default_timer()
+            reference = _propagate_changes_fixpoint(*hierarchy)
+            elapsed_fixpoint = '%14.4f' % (timeit.default_timer() - start_time)
+            if set(saved) != set(reference):
+                logger.error("propagation differs from the fixpoint for %i states", no_ces)
+        else:
+            elapsed_fixpoint = '%14s' % '-'
+        logger.info("%10i %8i %14.4f %s", no_ces, args.depth, min(elapsed), elapsed_fixpoint)
+
+
+def generate_states(no_ces, no_metrics, seed=42):
+    """
+    Generates synthetic code entity states of one commit with numeric metrics.
+    :param no_ces: number of code entity states
+    :param no_metrics: number of metrics per code entity state
+    :param seed: seed for the random number generator
+    :return: list of dicts in the format of the code entity states in the database
+    """
+    rnd = random.Random(seed)
+    file_id = ObjectId()
+    states = []
+    for i in range(0, no_ces):
+        metrics = {}
+        for j in range(0, no_metrics):
+            metrics['M%i' % j] = float('nan') if rnd.random() < 0.05 else float(rnd.randrange(100))
+        states.append({'_id': ObjectId(), 'long_name': 'Class%i.method%i()' % (i // 20, i), 'file_id': file_id,
+                       'ce_type': 'method', 'start_line': i, 'end_line': i + 10, 'metrics': metrics})
+    return states
+
+
+def benchmark_fingerprint(args, logger):
+    """
+    Measures the time required to fingerprint all code entity states of a commit one by one and with the metrics
+    aligned into arrays.
+    :param args: parsed command line arguments
+    :param logger: logger for the results
+    """
+    if numpy is None:
+        logger.warning("NumPy is not installed, the vectorized fingerprints fall back to the scalar path")
+    logger.info("%10s %8s %12s %14s", "states", "metrics", "scalar (s)", "vectorized (s)")
+    for no_ces in args.sizes:
+        states = generate_states(no_ces, args.metrics)
+        elapsed_scalar = []
+        elapsed_vectorized = []
+        for _ in range(0, args.repeat):
+            start_time = timeit.default_timer()
+            scalar = [fingerprint(ces) for ces in states]
+            elapsed_scalar.append(timeit.default_timer() - start_time)
+            start_time = timeit.default_timer()
+            vectorized = fingerprints(states)
+            elapsed_vectorized.append(timeit.default_timer() - start_time)
+        if scalar != vectorized:
+            logger.error("scalar and vectorized fingerprints differ for %i states", no_ces)
+        logger.info("%10i %8i %12.4f %14.4f", no_ces, args.metrics, min(elapsed_scalar), min(elapsed_vectorized))
+
+
+def generate_project(no_commits, no_entities, change_probability, no_metrics, seed=42):
+    """
+    Generates a synthetic project whose code entity states have not yet been merged. Every commit has one code entity
+    state per code entity, whose metrics change with a given probability compared to the first parent of the commit.
+    The code entities form classes of ten entities, such that changes are propagated to the unchanged members.
+    :param no_commits: number of commits
+    :param no_entities: number of code entities
+    :param change_probability: probability that a code entity changes in a commit
+    :param no_metrics: number of metrics per code entity state
+    :param seed: seed for the random number generator
+    :return: tuple of the commits and the code entity states as dicts
+    """
+    rnd = random.Random(seed)
+    commits = generate_history(no_commits, seed=seed, shuffle=False)
+    file_id = ObjectId()
+    versions = {}
+    code_entity_states = []
+    for commit in commits:
+        if len(commit['parents']) > 0:
+            version = list(versions[commit['parents'][0]])
+        else:
+            version = [0] * no_entities
+        ces_ids = []
+        for i in range(0, no_entities):
+            if rnd.random() < change_probability:
+                version[i] += 1
+            ces_ids.append(ObjectId())
+            code_entity_states.append({'_id': ces_ids[i], 'commit_id': commit['_id'],
+                                       'long_name': 'Class%i.method%i()' % (i // 10, i), 'file_id': file_id,
+                                       'ce_type': 'method', 'ce_parent_id': ces_ids[i - i % 10] if i % 10 else None,
+                                       'metrics': {'M%i' % j: float(version[i] + j) for j in range(0, no_metrics)}})
+        versions[commit['revision_hash']] = version
+    return commits, code_entity_states
+
+
+def benchmark_merge(args, logger):
+    """
+    Measures the time that a worker requires to merge the code entity states of synthetic projects from a
+    :class:`~memeshark.storage.MemoryStorage`, i.e., the merging without the round-trips to the MongoDB.
+    :param args: parsed command line arguments
+    :param logger: logger for the results
+    """
+    # the worker logs every commit
+    logging.getLogger('worker0').setLevel(logging.WARNING)
+    logger.info("%10s %10s %10s %12s %12s %14s", "commits", "states", "deleted", "time (s)", "commits / s",
+                "states / s")
+    for no_commits in args.sizes:
+        elapsed = []
+        for _ in range(0, args.repeat):
+            commits, code_entity_states = generate_project(no_commits, args.entities, args.change_probability,
+                                                           args.metrics)
+            storage = MemoryStorage(commits, code_entity_states)
+            commit_graph, missing = build_commit_graph(commits)
+            chains = ChainPartition.from_graph(commit_graph)
+            status = CommitStatus(bytearray(len(commit_graph)), array('q'))
+            work_dir = tempfile.mkdtemp(prefix='memeshark')
+            try:
+                os.mkdir(os.path.join(work_dir, 'states'))
+                worker = OfflineWorker(work_dir, storage, commit_graph, chains, status)
+                start_time = timeit.default_timer()
+                worker.run()
+                elapsed.append(timeit.default_timer() - start_time)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        best = min(elapsed)
+        logger.info("%10i %10i %10i %12.4f %12.0f %14.0f", no_commits, worker.ces_total, worker.ces_deleted, best,
+                    no_commits / best, len(code_entity_states) / best)
+
+
+def start():
+    """
+    Runs benchmarks for the building blocks of the memeSHARK that do not require a MongoDB.
+    """
+    setup_logging()
+    logger = logging.getLogger("benchmark")
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the memeSHARK.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser_graph = subparsers.add_parser('graph', help='Build time of the commit graph against the number of commits.')
+    parser_graph.add_argument('--sizes', help='Numbers of commits.', type=int, nargs='+',
+                              default=[1000, 10000, 100000])
+    parser_graph.add_argument('--repeat', help='Number of repetitions per size.', type=int, default=3)
+    parser_graph.set_defaults(func=benchmark_graph)
+
+    parser_propagation = subparsers.add_parser('propagation', help='Propagation of changed parents through a deep '
+                                                                   'hierarchy of code entity states.')
+    parser_propagation.add_argument('--sizes', help='Numbers of code entity states.', type=int, nargs='+',
+                                    default=[1000, 10000, 100000])
+    parser_propagation.add_argument('--depth', help='Depth of the hierarchy.', type=int, default=100)
+    parser_propagation.add_argument('--repeat', help='Number of repetitions per size.', type=int, default=3)
+    parser_propagation.add_argument('--fixpoint-limit', help='Largest number of states for which the former fixpoint '
+                                                             'propagation is measured as reference.', type=int,
+                                    default=1000)
+    parser_propagation.set_defaults(func=benchmark_propagation)
+
+    parser_fingerprint = subparsers.add_parser('fingerprint', help='Fingerprinting of the code entity states of a '
+                                                                   'commit.')
+    parser_fingerprint.add_argument('--sizes', help='Numbers of code entity states.', type=int, nargs='+',
+                                    default=[1000, 10000, 50000])
+    parser_fingerprint.add_argument('--metrics', help='Number of metrics per code entity state.', type=int,
+                                    default=40)
+    parser_fingerprint.add_argument('--repeat', help='Number of repetitions per size.', type=int, default=3)
+    parser_fingerprint.set_defaults(func=benchmark_fingerprint)
+
+    parser_merge = subparsers.add_parser('merge', help='Merging of synthetic projects from an in-memory storage.')
+    parser_merge.add_argument('--sizes', help='Numbers of commits.', type=int, nargs='+', default=[500, 2000])
+    parser_merge.add_argument('--entities', help='Number of code entities per commit.', type=int, default=200)
+    parser_merge.add_argument('--change-probability', help='Probability that a code entity changes in a commit.',
+                              type=float, default=0.05)
+    parser_merge.add_argument('--metrics', help='Number of metrics per code entity state.', type=int, default=10)
+    parser_merge.add_argument('--repeat', help='Number of repetitions per size.', type=int, default=3)
+    parser_merge.set_defaults(func=benchmark_merge)
+
+    args = parser.parse_args()
+    args.func(args, logger)
+
+
+if __name__ == "__main__":
+    start()
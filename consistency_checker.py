@@ -1,16 +1,29 @@
 import argparse
+import bisect
+import collections
 import json
 import logging
 import logging.config
+import math
+import multiprocessing
 import os
+import random
 import sys
 
 from dictdiffer import diff
-from mongoengine import connect, DoesNotExist
+from mongoengine import connect, connection, DoesNotExist
 from mongoengine.context_managers import switch_db
 from pycoshark.mongomodels import Commit, CodeEntityState, Project, VCSSystem, File
 from pycoshark.utils import create_mongodb_uri_string
 
+from memeshark.fingerprint import fingerprint
+
+# fields of code entity states that differ between the verbose and the condensed database
+EXCLUDED_FIELDS = {'_id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids', 'file_id'}
+
+# checker of a process of the pool, see _init_checker
+_checker = None
+
 
 def setup_logging(default_path=os.path.dirname(os.path.realpath(__file__)) + "/../loggerConfiguration.json",
                   default_level=logging.INFO):
@@ -29,6 +42,406 @@ def setup_logging(default_path=os.path.dirname(os.path.realpath(__file__)) + "/.
         logging.basicConfig(level=default_level)
 
 
+class Report(object):
+    """
+    Counts of the checked commits and code entity states that are aggregated over all batches of commits, and the
+    revision hashes of the inconsistent commits.
+    """
+
+    FIELDS = ('commits', 'commits_missing', 'commits_inconsistent', 'ces_verbose', 'ces_condensed', 'ces_missing',
+              'ces_unequal', 'parents_unequal', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.inconsistent = []
+
+    def add(self, other):
+        """
+        Adds the counts of another report.
+        :param other: the other report
+        """
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        self.inconsistent.extend(other.inconsistent)
+
+    def not_matched(self):
+        """
+        :return: number of code entity states of the verbose database that are not matched in the condensed database
+        """
+        return self.ces_missing + self.ces_unequal + self.parents_unequal
+
+    def log(self, logger):
+        """
+        Logs the report.
+        :param logger: the logger
+        """
+        logger.info("num commits checked: %i (%i not found in condensed db, %i inconsistent)", self.commits,
+                    self.commits_missing, self.commits_inconsistent)
+        logger.info("num CES verbose  : %i", self.ces_verbose)
+        logger.info("num CES condensed: %i", self.ces_condensed)
+        logger.info("num CES not found in condensed db: %i", self.ces_missing)
+        logger.info("num CES not equal: %i", self.ces_unequal)
+        logger.info("num CES with unequal parents: %i", self.parents_unequal)
+        lookups = self.cache_hits + self.cache_misses
+        logger.info("cache hits for condensed CES: %i of %i (%0.1f%%)", self.cache_hits, lookups,
+                    100.0 * self.cache_hits / lookups if lookups > 0 else 0)
+        logger.info("num CES from verbose not matched: %i", self.not_matched())
+
+
+class LRUCache(object):
+    """
+    Cache with a maximal number of entries that evicts the least recently used entries.
+    :param capacity: maximal number of entries
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        :param key: the key
+        :return: the cached value; None if the key is not cached
+        """
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Caches a value and evicts the least recently used entry if the cache is full.
+        :param key: the key
+        :param value: the value
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+class ConsistencyChecker(object):
+    """
+    Compares the code entity states of commits of the verbose database with the states that the memeSHARK added to the
+    same commits in the condensed database. The condensed code entity states are shared by many commits and are,
+    therefore, cached across commits. The missing ones are fetched with batched $in queries.
+    :param condensed_db: pymongo database that was condensed with the memeSHARK
+    :param verbose_db: pymongo database with the verbose code entity states
+    :param vcs_system_condensed: ID of the VCS system of the project in the condensed database
+    :param files_condensed: mapping from the IDs of the files in the condensed database to their paths
+    :param files_verbose: mapping from the IDs of the files in the verbose database to their paths
+    :param read_batch_size: number of code entity states that are fetched per round-trip and maximal number of IDs per
+        $in query
+    :param cache_size: maximal number of condensed code entity states that are cached
+    :param use_fingerprints: if true, the code entity states are compared by their content fingerprints (see
+        :func:`~memeshark.fingerprint.fingerprint`) and only the differing ones are compared field by field
+    """
+
+    def __init__(self, condensed_db, verbose_db, vcs_system_condensed, files_condensed, files_verbose,
+                 read_batch_size=5000, cache_size=100000, use_fingerprints=False):
+        self.logger = logging.getLogger("main")
+        self.commits_condensed = condensed_db[Commit._get_collection_name()]
+        self.ces_condensed = condensed_db[CodeEntityState._get_collection_name()]
+        self.ces_verbose = verbose_db[CodeEntityState._get_collection_name()]
+        self.vcs_system_condensed = vcs_system_condensed
+        self.files_condensed = files_condensed
+        self.files_verbose = files_verbose
+        self.read_batch_size = read_batch_size
+        self.cache = LRUCache(cache_size)
+        self.use_fingerprints = use_fingerprints
+
+    def check(self, commits):
+        """
+        Checks a batch of commits.
+        :param commits: list of tuples of the IDs and the revision hashes of the commits in the verbose database
+        :return: the :class:`Report` of the batch
+        """
+        report = Report()
+        states = {}
+        for commit in self.commits_condensed.find({'vcs_system_id': self.vcs_system_condensed,
+                                                   'revision_hash': {'$in': [revision for _, revision in commits]}},
+                                                  {'revision_hash': True, 'code_entity_states': True}):
+            states[commit['revision_hash']] = commit.get('code_entity_states') or []
+
+        for commit_id, revision_hash in commits:
+            report.commits += 1
+            if revision_hash not in states:
+                self.logger.info("commit %s not found in condensed db", revision_hash)
+                report.commits_missing += 1
+                report.commits_inconsistent += 1
+                report.inconsistent.append(revision_hash)
+                continue
+            not_matched = report.not_matched()
+            self._check_commit(commit_id, states[revision_hash], report)
+            if report.not_matched() > not_matched:
+                report.commits_inconsistent += 1
+                report.inconsistent.append(revision_hash)
+        return report
+
+    def _check_commit(self, commit_id, ces_ids, report):
+        """
+        Compares the code entity states of one commit.
+        :param commit_id: ID of the commit in the verbose database
+        :param ces_ids: IDs of the code entity states of the commit in the condensed database
+        :param report: the report to which the counts are added
+        """
+        ces_verbose = {}
+        ces_verbose_by_id = {}
+        for cur_ces_verbose in self.ces_verbose.find({'commit_id': commit_id}, batch_size=self.read_batch_size):
+            ces_verbose[cur_ces_verbose['long_name'] + self.files_verbose[cur_ces_verbose['file_id']]] = \
+                cur_ces_verbose
+            ces_verbose_by_id[cur_ces_verbose['_id']] = cur_ces_verbose
+
+        ces_condensed_by_id = self._condensed(ces_ids, report)
+        ces_condensed = {}
+        for cur_ces_condensed in ces_condensed_by_id.values():
+            ces_condensed[cur_ces_condensed['long_name'] + self.files_condensed[cur_ces_condensed['file_id']]] = \
+                cur_ces_condensed
+        report.ces_verbose += len(ces_verbose)
+        report.ces_condensed += len(ces_condensed)
+
+        for long_name_verbose, cur_ces_verbose in ces_verbose.items():
+            if long_name_verbose not in ces_condensed:
+                self.logger.error("CES with long_name %s not found in condensed DB!", long_name_verbose)
+                report.ces_missing += 1
+                continue
+
+            cur_ces_condensed = ces_condensed[long_name_verbose]
+            old, new = self._differences(cur_ces_verbose, cur_ces_condensed)
+            if len(new.keys()) > 0 or len(old.keys()) > 0:
+                self.logger.error("CES with long_name %s (id verbose: %s /id condensed %s) not equal!",
+                                  long_name_verbose, cur_ces_verbose['_id'], cur_ces_condensed['_id'])
+                self.logger.error("verbose  : %s", old)
+                self.logger.error("condensed: %s", new)
+                report.ces_unequal += 1
+                continue
+
+            # check if CES parent is equal
+            ces_parent_verbose = ces_verbose_by_id.get(cur_ces_verbose.get('ce_parent_id'))
+            ces_parent_condensed = None
+            parent_id = cur_ces_condensed.get('ce_parent_id')
+            if parent_id is not None:
+                ces_parent_condensed = ces_condensed_by_id.get(parent_id)
+                if ces_parent_condensed is None:
+                    ces_parent_condensed = self._condensed([parent_id], report).get(parent_id)
+            if ces_parent_verbose is None and ces_parent_condensed is None:
+                continue
+            if ces_parent_verbose is None or ces_parent_condensed is None:
+                self.logger.error("ce_parent of CES with long_name %s not equal!", long_name_verbose)
+                self.logger.error("verbose  : %s", ces_parent_verbose)
+                self.logger.error("condensed: %s", ces_parent_condensed)
+                report.parents_unequal += 1
+                continue
+            old, new = self._differences(ces_parent_verbose, ces_parent_condensed)
+            if len(new.keys()) > 0 or len(old.keys()) > 0:
+                self.logger.error("ce_parent of CES with long_name %s not equal!", long_name_verbose)
+                self.logger.error("verbose  : %s", old)
+                self.logger.error("condensed: %s", new)
+                report.parents_unequal += 1
+
+    def _differences(self, ces_verbose, ces_condensed):
+        """
+        Compares a verbose and a condensed code entity state.
+        :param ces_verbose: the verbose code entity state as dict
+        :param ces_condensed: the condensed code entity state as dict
+        :return: two dicts with the differing fields of the verbose and the condensed state (see :func:`compare_dicts`)
+        """
+        if self.use_fingerprints and \
+                fingerprint(ces_verbose, EXCLUDED_FIELDS) == fingerprint(ces_condensed, EXCLUDED_FIELDS):
+            return {}, {}
+        return compare_dicts(ces_verbose, ces_condensed, EXCLUDED_FIELDS)
+
+    def _condensed(self, ces_ids, report):
+        """
+        Fetches condensed code entity states from the cache or, if they are not cached, with batched $in queries.
+        :param ces_ids: IDs of the code entity states
+        :param report: the report to which the cache hits and misses are added
+        :return: mapping from the IDs to the code entity states as dicts
+        """
+        states = {}
+        missing = []
+        for ces_id in ces_ids:
+            cur_ces_condensed = self.cache.get(ces_id)
+            if cur_ces_condensed is None:
+                missing.append(ces_id)
+            else:
+                states[ces_id] = cur_ces_condensed
+        report.cache_hits += len(states)
+        report.cache_misses += len(missing)
+
+        for start in range(0, len(missing), self.read_batch_size):
+            for cur_ces_condensed in self.ces_condensed.find(
+                    {'_id': {'$in': missing[start:start + self.read_batch_size]}}, batch_size=self.read_batch_size):
+                states[cur_ces_condensed['_id']] = cur_ces_condensed
+                self.cache.put(cur_ces_condensed['_id'], cur_ces_condensed)
+        return states
+
+
+def _init_checker(database1, uri1, database2, uri2, vcs_system_condensed, files_condensed, files_verbose,
+                  read_batch_size, cache_size, use_fingerprints):
+    """
+    Connects a process of the pool to the databases and creates its :class:`ConsistencyChecker`.
+    """
+    global _checker
+    setup_logging()
+    # the connections of the parent process must not be used after the fork
+    connection._dbs = {}
+    connection._connections = {}
+    connection._connection_settings = {}
+    condensed_client = connect(database1, host=uri1, alias='default')
+    verbose_client = connect(database2, host=uri2, alias='db-verbose')
+    _checker = ConsistencyChecker(condensed_client[database1], verbose_client[database2], vcs_system_condensed,
+                                  files_condensed, files_verbose, read_batch_size, cache_size, use_fingerprints)
+
+
+def _check(commits):
+    """
+    Checks a batch of commits in a process of the pool.
+    :param commits: list of tuples of the IDs and the revision hashes of the commits in the verbose database
+    :return: the :class:`Report` of the batch
+    """
+    return _checker.check(commits)
+
+
+def _batches(commits, batch_size):
+    """
+    Groups a stream of commits into batches.
+    :param commits: iterable of the commits as dicts with their IDs and revision hashes
+    :param batch_size: number of commits per batch
+    :return: generator of lists of tuples of the IDs and the revision hashes
+    """
+    batch = []
+    for commit in commits:
+        batch.append((commit['_id'], commit['revision_hash']))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def normal_quantile(probability):
+    """
+    Calculates the quantile of the standard normal distribution by bisection of its distribution function.
+    :param probability: the probability, between 0 and 1
+    :return: the quantile
+    """
+    low, high = -40.0, 40.0
+    for _ in range(0, 100):
+        middle = (low + high) / 2
+        if 0.5 * math.erfc(-middle / math.sqrt(2)) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def wilson_upper_bound(errors, trials, confidence):
+    """
+    Calculates the one-sided upper bound of the Wilson score interval of a rate.
+    :param errors: number of errors; may be fractional for an estimated rate with an effective number of trials
+    :param trials: number of trials
+    :param confidence: confidence level, e.g., 0.95
+    :return: the upper bound of the rate
+    """
+    if trials == 0:
+        return 1.0
+    z = normal_quantile(confidence)
+    rate = errors / trials
+    center = rate + z * z / (2 * trials)
+    spread = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials))
+    return min(1.0, (center + spread) / (1 + z * z / trials))
+
+
+def stratified_upper_bound(strata, confidence):
+    """
+    Calculates an upper bound of the rate of errors of a population from a stratified sample. The rates of the strata
+    are weighted with the sizes of the strata, because the strata are not sampled with the same rate. The Wilson score
+    interval of the weighted rate uses the effective number of trials of the weighting (Kish), i.e., the number of
+    trials of a simple random sample whose rate has the same variance if the rates of all strata are equal.
+    :param strata: iterable of tuples of the size of a stratum, its number of sampled commits, and its number of errors
+    :param confidence: confidence level, e.g., 0.95
+    :return: tuple of the weighted rate, the effective number of trials, and the upper bound of the rate
+    """
+    strata = [(size, trials, errors) for size, trials, errors in strata if trials > 0]
+    population = sum(size for size, _, _ in strata)
+    if population == 0:
+        return 0.0, 0.0, 1.0
+    rate = sum(size * errors / trials for size, trials, errors in strata) / population
+    effective_trials = 1 / sum((size / population) ** 2 / trials for size, trials, _ in strata)
+    return rate, effective_trials, wilson_upper_bound(rate * effective_trials, effective_trials, confidence)
+
+
+def _position(parents, children):
+    """
+    Classifies the position of a commit in the commit graph.
+    :param parents: number of parents of the commit
+    :param children: number of children of the commit
+    :return: one of root, merge, fork, and linear
+    """
+    if parents == 0:
+        return 'root'
+    if parents > 1:
+        return 'merge'
+    if children > 1:
+        return 'fork'
+    return 'linear'
+
+
+def sample_commits(commits_verbose, commits_condensed, vcs_system_verbose, vcs_system_condensed, size, seed=0):
+    """
+    Draws a sample of commits that is stratified by the position of the commits in the commit graph and by their
+    number of code entities. The number of code entities is taken from the states that the memeSHARK added to the
+    condensed commits, such that no code entity states are read. The quartiles of the numbers of code entities and the
+    positions form the strata, from which commits are drawn proportionally to their size, but at least one. Small strata
+    are, therefore, sampled with a higher rate (see :func:`stratified_upper_bound`).
+    :param commits_verbose: pymongo collection of the commits of the verbose database
+    :param commits_condensed: pymongo collection of the commits of the condensed database
+    :param vcs_system_verbose: ID of the VCS system in the verbose database
+    :param vcs_system_condensed: ID of the VCS system in the condensed database
+    :param size: number of commits of the sample
+    :param seed: seed of the random sample
+    :return: tuple of the sampled commits as list of dicts with their IDs, revision hashes, and strata and a dict
+        from the strata to their numbers of commits
+    """
+    logger = logging.getLogger("main")
+    entities = {}
+    for commit in commits_condensed.aggregate([
+            {'$match': {'vcs_system_id': vcs_system_condensed}},
+            {'$project': {'_id': False, 'revision_hash': True,
+                          'count': {'$size': {'$ifNull': ['$code_entity_states', []]}}}}], allowDiskUse=True):
+        entities[commit['revision_hash']] = commit['count']
+
+    commits = []
+    children = collections.Counter()
+    for commit in commits_verbose.find({'vcs_system_id': vcs_system_verbose}, {'revision_hash': True,
+                                                                               'parents': True}):
+        parents = commit.get('parents') or []
+        children.update(parents)
+        commits.append((commit['_id'], commit['revision_hash'], len(parents)))
+
+    counts = sorted(entities.get(revision_hash, 0) for _, revision_hash, _ in commits)
+    quartiles = [counts[len(counts) * quarter // 4] for quarter in (1, 2, 3)] if len(counts) > 0 else []
+    strata = collections.defaultdict(list)
+    for index, (_, revision_hash, parents) in enumerate(commits):
+        strata[(_position(parents, children[revision_hash]),
+                bisect.bisect_right(quartiles, entities.get(revision_hash, 0)))].append(index)
+
+    rnd = random.Random(seed)
+    sample = []
+    for stratum in sorted(strata):
+        indices = strata[stratum]
+        quota = min(len(indices), max(1, int(round(size * len(indices) / len(commits)))))
+        logger.info("stratum of %s commits in entity quartile %i: %i of %i commits sampled", stratum[0], stratum[1] + 1,
+                    quota, len(indices))
+        sample.extend(rnd.sample(indices, quota))
+    # the commits are checked in the order of the database, such that neighbouring commits share the cache
+    stratum_of = {index: stratum for stratum, indices in strata.items() for index in indices}
+    return [{'_id': commits[index][0], 'revision_hash': commits[index][1], 'stratum': stratum_of[index]}
+            for index in sorted(sample)], {stratum: len(indices) for stratum, indices in strata.items()}
+
+
 def start():
     """
     Compares the commits and code_entity_states of two MongoDBs, whereas the first MongoDB is
@@ -66,25 +479,48 @@ def start():
     parser.add_argument('--project-name1', help='Name of the project.', default=None)
     parser.add_argument('--project-name2', help='Name of the project.', default=None)
 
+    parser.add_argument('-c', '--processes', help='Number of parallel processes.', default=1, type=int)
+    parser.add_argument('--commit-batch-size', help='Number of commits that a process checks per task.', default=100,
+                        type=int)
+    parser.add_argument('--read-batch-size', help='Number of code entity states that are fetched per round-trip.',
+                        default=5000, type=int)
+    parser.add_argument('--cache-size', help='Number of condensed code entity states that every process caches.',
+                        default=100000, type=int)
+    parser.add_argument('--sample', help='Number of commits that are sampled, stratified by their position in the '
+                                         'commit graph and their number of code entities. The states are compared by '
+                                         'their fingerprints and an upper bound of the rate of inconsistent commits '
+                                         'is reported.', default=None, type=int)
+    parser.add_argument('--confidence', help='Confidence level of the upper bound of the sample.', default=0.95,
+                        type=float)
+    parser.add_argument('--seed', help='Seed of the sample.', default=0, type=int)
+
     args = parser.parse_args()
 
     logger.info(args)
+    check(args)
 
+
+def check(args):
+    """
+    Checks all commits of the project. The commits of the verbose database are streamed in batches to a pool of
+    processes and their reports are aggregated.
+    :param args: the parsed arguments
+    :return: the aggregated :class:`Report`
+    """
+    logger = logging.getLogger("main")
     logger.info("connecting to database 1 (condensed)...")
     uri1 = create_mongodb_uri_string(args.db_user1, args.db_password1, args.db_hostname1, args.db_port1,
                                      args.db_authentication1, args.ssl1)
     logger.info(uri1)
-    connect(args.db_database1, host=uri1, alias='default')
+    condensed_client = connect(args.db_database1, host=uri1, alias='default')
 
     logger.info("connecting to database 2 (verbose)...")
     uri2 = create_mongodb_uri_string(args.db_user2, args.db_password2, args.db_hostname2, args.db_port2,
                                      args.db_authentication2, args.ssl2)
     logger.info(uri2)
-    connect(args.db_database2, host=uri2, alias='db-verbose')
+    verbose_client = connect(args.db_database2, host=uri2, alias='db-verbose')
 
-    # fetch all verbose commmits
-    commits_verbose = []
-    with switch_db(Commit, 'db-verbose') as CommitVerbose:
+    with switch_db(Commit, 'db-verbose'):
         # fetch only commits for selected project
         try:
             project_id = Project.objects(name=args.project_name2).get().id
@@ -93,10 +529,6 @@ def start():
             sys.exit(1)
         vcs_systems = VCSSystem.objects(project_id=project_id).get().id
         logger.info("vcs_system_id: %s", vcs_systems)
-        commit_objects = Commit.objects(vcs_system_id=vcs_systems)
-
-        for cur_commit_verbose in commit_objects:
-            commits_verbose.append(cur_commit_verbose)
 
     with switch_db(VCSSystem, 'default') as VCSSystemCondensed:
         # fetch only commits for selected project
@@ -118,73 +550,93 @@ def start():
         for cur_file_condensed in FilesCondensed.objects(vcs_system_id=vcs_systems_condensed):
             files_condensed[cur_file_condensed.id] = cur_file_condensed.path
 
-    num_commits_verbose = len(commits_verbose)
+    # the verbose commits are streamed instead of loaded at once
+    commits_verbose = verbose_client[args.db_database2][Commit._get_collection_name()]
+    use_fingerprints = args.sample is not None
+    sample, strata = None, None
+    if args.sample is None:
+        num_commits_verbose = commits_verbose.count_documents({'vcs_system_id': vcs_systems})
+        commits = commits_verbose.find({'vcs_system_id': vcs_systems}, {'revision_hash': True},
+                                       batch_size=args.commit_batch_size)
+    else:
+        commits_condensed = condensed_client[args.db_database1][Commit._get_collection_name()]
+        sample, strata = sample_commits(commits_verbose, commits_condensed, vcs_systems, vcs_systems_condensed,
+                                        args.sample, args.seed)
+        commits = sample
+        num_commits_verbose = len(commits)
+        logger.info("sampled %i of %i commits", num_commits_verbose, sum(strata.values()))
     logger.info("num commits verbose: %i", num_commits_verbose)
-    for commit_nr, commit_verbose in enumerate(commits_verbose):
-        logger.info("processing commit %s (%i / %i)", commit_verbose.id, commit_nr + 1, num_commits_verbose)
-        # fetch verbose CES
-        ces_verbose = {}
-        ces_verbose_by_id = {}
-        with switch_db(CodeEntityState, 'db-verbose') as CodeEntityStateVerbose:
-            for cur_ces_verbose in CodeEntityStateVerbose.objects(commit_id=commit_verbose.id):
-                ces_verbose[cur_ces_verbose.long_name + files_verbose[cur_ces_verbose.file_id]] = cur_ces_verbose
-                ces_verbose_by_id[cur_ces_verbose.id] = cur_ces_verbose
-
-        # fetch same commit in condensed DB
-        with switch_db(Commit, 'default') as CommitCondensed:
-            try:
-                commit_condensed = CommitCondensed.objects(revision_hash=commit_verbose.revision_hash,
-                                                           vcs_system_id=vcs_systems_condensed).get()
-            except:
-                logger.info("commit %s not found in condensed db", commit_verbose.revision_hash)
-                continue
-
-        # fetch CES from condensed DB
-        ces_condensed = {}
-        ces_condensed_by_id = {}
-        with switch_db(CodeEntityState, 'default') as CodeEntityStateCondensed:
-            for ces_id in commit_condensed.code_entity_states:
-                cur_ces_condensed = CodeEntityStateCondensed.objects(id=ces_id).get()
-                ces_condensed[
-                    cur_ces_condensed.long_name + files_condensed[cur_ces_condensed.file_id]] = cur_ces_condensed
-                ces_condensed_by_id[cur_ces_condensed.id] = cur_ces_condensed
-
-        logger.info("num CES verbose  : %i", len(ces_verbose.keys()))
-        logger.info("num CES condensed: %i", len(ces_condensed.keys()))
-
-        ces_unequal = 0
-        # compare CES
-        for long_name_verbose, cur_ces_verbose in ces_verbose.items():
-            if long_name_verbose not in ces_condensed:
-                logger.error("CES with long_name %s not found in condensed DB!", long_name_verbose)
-                ces_unequal += 1
-                continue
-
-            cur_ces_condensed = ces_condensed[long_name_verbose]
-            old, new = compare_dicts(cur_ces_verbose, cur_ces_condensed,
-                                     {'id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids', 'file_id'})
-            if len(new.keys()) > 0 or len(old.keys()) > 0:
-                logger.error("CES with long_name %s (id verbose: %s /id condensed %s) not equal!", long_name_verbose,
-                             cur_ces_verbose.id, cur_ces_condensed.id)
-                logger.error("verbose  : %s", old)
-                logger.error("condensed: %s", new)
-                ces_unequal += 1
-                continue
-
-            # check if CES parent is equal
-            ces_parent_verbose = ces_verbose_by_id[cur_ces_verbose.id]
-            ces_parent_condensed = ces_condensed_by_id[cur_ces_condensed.id]
-            old, new = compare_dicts\
-                (ces_parent_verbose, ces_parent_condensed,
-                 {'id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids', 'file_id'})
-            if len(new.keys()) > 0 or len(old.keys()) > 0:
-                logger.error("ce_parent of CES with long_name %s not equal!", long_name_verbose)
-                logger.error("verbose  : %s", old)
-                logger.error("condensed: %s", new)
-                ces_unequal += 1
-                continue
-
-        logger.info("num CES from verbose not matched: %i", ces_unequal)
+    batches = _batches(commits, args.commit_batch_size)
+
+    report = Report()
+    if args.processes <= 1:
+        checker = ConsistencyChecker(condensed_client[args.db_database1], verbose_client[args.db_database2],
+                                     vcs_systems_condensed, files_condensed, files_verbose, args.read_batch_size,
+                                     args.cache_size, use_fingerprints)
+        for batch in batches:
+            _add_report(report, checker.check(batch), num_commits_verbose)
+        _log_report(report, args, sample, strata)
+        return report
+
+    # the main process streams the batches to the pool, at most two per process are queued
+    pool = multiprocessing.Pool(args.processes, _init_checker,
+                                (args.db_database1, uri1, args.db_database2, uri2, vcs_systems_condensed,
+                                 files_condensed, files_verbose, args.read_batch_size, args.cache_size,
+                                 use_fingerprints))
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(_check, (batch,)))
+            if len(pending) >= 2 * args.processes:
+                _add_report(report, pending.popleft().get(), num_commits_verbose)
+        while len(pending) > 0:
+            _add_report(report, pending.popleft().get(), num_commits_verbose)
+    finally:
+        pool.terminate()
+        pool.join()
+    _log_report(report, args, sample, strata)
+    return report
+
+
+def _log_report(report, args, sample=None, strata=None):
+    """
+    Logs the aggregated report and, for a sample, the upper bounds of the rates of inconsistent commits of the strata
+    and of all commits.
+    :param report: the aggregated report
+    :param args: the parsed arguments
+    :param sample: the sampled commits (see :func:`sample_commits`; optional)
+    :param strata: dict from the strata to their numbers of commits (see :func:`sample_commits`; optional)
+    """
+    logger = logging.getLogger("main")
+    report.log(logger)
+    if sample is None:
+        return
+    logger.info("inconsistent commits in the sample: %i of %i", report.commits_inconsistent, report.commits)
+    stratum_of = {commit['revision_hash']: commit['stratum'] for commit in sample}
+    trials = collections.Counter(commit['stratum'] for commit in sample)
+    errors = collections.Counter(stratum_of[revision_hash] for revision_hash in report.inconsistent)
+    for stratum in sorted(strata):
+        logger.info("stratum of %s commits in entity quartile %i: %i of %i sampled commits inconsistent, at most "
+                    "%0.3f%% of its %i commits", stratum[0], stratum[1] + 1, errors[stratum], trials[stratum],
+                    100 * wilson_upper_bound(errors[stratum], trials[stratum], args.confidence), strata[stratum])
+    rate, effective_trials, bound = stratified_upper_bound(
+        [(strata[stratum], trials[stratum], errors[stratum]) for stratum in strata], args.confidence)
+    logger.info("estimated rate of inconsistent commits: %0.3f%% (weighted by the sizes of the strata, effective "
+                "sample size %0.1f)", 100 * rate, effective_trials)
+    logger.info("at most %0.3f%% of the commits are inconsistent (upper bound of the Wilson score interval with "
+                "%0.1f%% confidence)", 100 * bound, 100 * args.confidence)
+
+
+def _add_report(report, batch_report, num_commits):
+    """
+    Adds the report of a batch to the aggregated report and logs the progress.
+    :param report: the aggregated report
+    :param batch_report: the report of the batch
+    :param num_commits: number of commits that are checked
+    """
+    report.add(batch_report)
+    logging.getLogger("main").info("processed %i / %i commits (%i CES not matched)", report.commits, num_commits,
+                                   report.not_matched())
 
 
 def compare_dicts(obj1, obj2, excluded_keys):
@@ -195,25 +647,22 @@ def compare_dicts(obj1, obj2, excluded_keys):
     :param excluded_keys: keys that are ignored
     :return: two dicts: old for the state in the obj1, new for the state in obj2 in case of differences
     """
-    keys = obj1._fields_ordered
+    keys = set(obj1.keys()) | set(obj2.keys())
     old, new = {}, {}
     for key in keys:
         if key in excluded_keys:
             continue
-        try:
-            value1 = getattr(obj1, key)
-            value2 = getattr(obj2, key)
-            if value1 != value2:
-                if isinstance(value1, dict) and isinstance(value2, dict):
-                    result = list(diff(value1, value2))
-                    if len(result) > 0:
-                        old.update({key: getattr(obj1, key)})
-                        new.update({key: getattr(obj2, key)})
-                else:
-                    old.update({key: getattr(obj1, key)})
-                    new.update({key: getattr(obj2, key)})
-        except KeyError:
-            old.update({key: getattr(obj1, key)})
+        value1 = obj1.get(key)
+        value2 = obj2.get(key)
+        if value1 != value2:
+            if isinstance(value1, dict) and isinstance(value2, dict):
+                result = list(diff(value1, value2))
+                if len(result) > 0:
+                    old.update({key: value1})
+                    new.update({key: value2})
+            else:
+                old.update({key: value1})
+                new.update({key: value2})
 
     return old, new
 
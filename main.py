@@ -5,6 +5,7 @@ from pycoshark.utils import get_base_argparser
 
 from memeshark.config import Config, setup_logging
 from memeshark.memeshark import MemeSHARK
+from memeshark.offline import OfflineMemeSHARK
 
 
 def start():
@@ -19,14 +20,67 @@ def start():
     parser = get_base_argparser('Plugin to remove code entities and code groups that did not change in a revision.', '0.1.0')
     parser.add_argument('--log-level', help='Sets the debug level.', default='DEBUG',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
-    parser.add_argument('-n', '--project-name', help='Name of the project to compress.', required=True)
+    projects = parser.add_mutually_exclusive_group(required=True)
+    projects.add_argument('-n', '--project-name', help='Name of the project to compress.')
+    projects.add_argument('--projects', help='Names of the projects that are compressed by one pool of workers.',
+                          nargs='+', default=None)
+    projects.add_argument('--all-projects', help='Compresses all projects of the database that have commits that are '
+                                                 'not yet processed.', action='store_true')
+    projects.add_argument('--join', help='Name of a distributed run that the workers of this host join.', default=None)
+    parser.add_argument('--project-order', help='Order in which the projects of --projects or --all-projects are '
+                                                'processed; largest and smallest order them by the estimated number '
+                                                'of commits to process.', default='largest',
+                        choices=['largest', 'smallest', 'given'])
     parser.add_argument('-c', '--processes', help='Number of parallel processes.', default=1)
+    parser.add_argument('--verify-fingerprints', help='Verifies that the fingerprints of the code entity states agree '
+                                                      'with a full comparison of the states.',
+                        default=False, action='store_true')
+    parser.add_argument('--read-batch-size', help='Number of code entity states that are fetched per round-trip.',
+                        default=5000)
+    parser.add_argument('--write-batch-size', help='Number of write operations after which the buffered writes of a '
+                                                   'worker are sent.', default=1000)
+    parser.add_argument('--write-flush-interval', help='Time in seconds after which the buffered writes of a worker '
+                                                       'are sent.', default=5.0)
+    parser.add_argument('--write-concern', help='Write concern (w) of the bulk writes, e.g., 1 or majority.',
+                        default='1')
+    parser.add_argument('--cache-memory', help='Memory budget in MB per worker for the states of fork commits that '
+                                               'are kept for their branches.', default=256)
+    parser.add_argument('--incremental', help='Only processes the commits that were added since the last run.',
+                        action='store_true')
+    parser.add_argument('--journal', help='Path of a journal of the finished chains of commits, which is used to '
+                                          'resume after a crash. The journal is removed after a successful run.',
+                        default=None)
+    parser.add_argument('--prefetch-depth', help='Number of commits of a chain that a worker reads ahead while it '
+                                                 'merges the current commit; 0 disables the read-ahead.', default=2)
+    parser.add_argument('--prefetch-documents', help='Maximal number of code entity states that a worker reads '
+                                                     'ahead.', default=100000)
+    parser.add_argument('--metrics-interval', help='Time in seconds between two summaries of the counters of the '
+                                                   'workers.', default=60.0)
+    parser.add_argument('--metrics-file', help='Path of a file to which the counters of the workers are written with '
+                                               'every summary; files ending with .prom are written in the Prometheus '
+                                               'text format, all others as JSON.', default=None)
+    parser.add_argument('--profile', help='Directory to which every worker writes a cProfile dump and the times of its '
+                                          'phases; the dumps are merged into one report after the run.', default=None)
+    parser.add_argument('--distributed', help='Name of a distributed run: the chains of commits are published as tasks '
+                                              'in the database, from which the workers of all hosts that joined the '
+                                              'run claim them with leases.', default=None)
+    parser.add_argument('--lease-time', help='Time in seconds after which the task of a worker of a distributed run '
+                                             'is claimed by another worker if the lease was not renewed.',
+                        default=60.0)
+    parser.add_argument('--offline', help='Directory of a mongodump whose commit and code_entity_state collections are '
+                                          'compacted without the MongoDB.', default=None)
+    parser.add_argument('--offline-output', help='Directory to which the compacted collections of --offline are '
+                                                 'written for mongorestore.', default=None)
+    parser.add_argument('--dry-run', help='Merges the code entity states without writing to the database and reports '
+                                          'the projected savings and throughput.', action='store_true')
+    parser.add_argument('--dry-run-sample', help='Fraction of the chains of commits that are merged in a dry run; the '
+                                                 'savings are extrapolated to all chains.', default=1.0)
 
     args = parser.parse_args()
     cfg = Config(args)
 
     logger.debug("Got the following config: %s" % cfg)
-    meme_shark = MemeSHARK()
+    meme_shark = OfflineMemeSHARK() if cfg.offline is not None else MemeSHARK()
     meme_shark.start(cfg)
 
 
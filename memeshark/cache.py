@@ -0,0 +1,146 @@
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+from bson import ObjectId
+
+from memeshark.state import CESState
+
+_COUNT = struct.Struct('<I')
+_ENTRY = struct.Struct('<16s12s12s?12sI')
+_NO_PARENT = bytes(12)
+
+
+def state_path(directory, commit_id):
+    """
+    :param directory: directory of the spill files
+    :param commit_id: ID of the commit
+    :return: the path of the spill file with the state of the commit
+    """
+    return os.path.join(directory, '%s.state' % commit_id)
+
+
+def write_state(path, state, keys):
+    """
+    Writes a state to a spill file. The file is written atomically, such that other processes never read partial
+    states. Because the integer keys are only valid within a process, the long names and file IDs are written.
+    :param path: path of the spill file
+    :param state: dict from the integer keys of the code entities to :class:`~memeshark.state.CESState`
+    :param keys: the :class:`~memeshark.state.KeyTable` of the integer keys
+    """
+    tmp_path = '%s.%i.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_COUNT.pack(len(state)))
+        for key, ces_state in state.items():
+            long_name, file_id = keys.key(key)
+            encoded_name = long_name.encode('utf-8')
+            has_parent = ces_state.parent_id is not None
+            f.write(_ENTRY.pack(ces_state.fingerprint, ces_state.id.binary,
+                                ces_state.parent_id.binary if has_parent else _NO_PARENT, has_parent,
+                                file_id.binary, len(encoded_name)))
+            f.write(encoded_name)
+    os.replace(tmp_path, path)
+
+
+def read_state(path, keys):
+    """
+    Reads a state from a memory-mapped spill file.
+    :param path: path of the spill file
+    :param keys: the :class:`~memeshark.state.KeyTable` in which the keys are interned
+    :return: dict from the integer keys of the code entities to :class:`~memeshark.state.CESState`; None if the file
+        does not exist
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        state = {}
+        count, = _COUNT.unpack_from(mapped, 0)
+        offset = _COUNT.size
+        for _ in range(0, count):
+            fingerprint, ces_id, parent_id, has_parent, file_id, name_length = _ENTRY.unpack_from(mapped, offset)
+            offset += _ENTRY.size
+            key = keys.intern(mapped[offset:offset + name_length].decode('utf-8'), ObjectId(file_id))
+            offset += name_length
+            state[key] = CESState(fingerprint, ObjectId(ces_id), ObjectId(parent_id) if has_parent else None)
+    return state
+
+
+def remove_state(directory, commit_id):
+    """
+    Removes the spill file of a state.
+    :param directory: directory of the spill files
+    :param commit_id: ID of the commit
+    """
+    try:
+        os.remove(state_path(directory, commit_id))
+    except FileNotFoundError:
+        pass
+
+
+class StateCache(object):
+    """
+    Cache for the end-states of fork commits, i.e., commits with multiple branches. The states are kept in memory
+    until all branches of the fork that are processed by this worker consumed them. The memory is bounded by a budget
+    and the least recently used states are evicted first. Additionally, every state is spilled to a memory-mapped
+    file in a directory that is shared by all workers, such that workers that steal a branch read the state from the
+    local disk instead of the database. The spill files are removed by the
+    :class:`~memeshark.scheduler.Scheduler` once all branches of the fork are finished. In a distributed run, the
+    workers of other hosts read the state of the fork commit from the database.
+    :param directory: directory of the spill files
+    :param memory_budget: estimated number of bytes that may be used for the states in memory
+    :param keys: the :class:`~memeshark.state.KeyTable` of the worker
+    """
+
+    # estimated memory of a code entity state in memory
+    ENTRY_SIZE = 150
+
+    def __init__(self, directory, memory_budget, keys):
+        self.directory = directory
+        self.keys = keys
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self._states = OrderedDict()
+
+    def put(self, commit_id, state, consumers):
+        """
+        Adds the state of a fork commit to the cache.
+        :param commit_id: ID of the commit
+        :param state: dict from the integer keys of the code entities to :class:`~memeshark.state.CESState`
+        :param consumers: number of branches that will consume the state
+        """
+        write_state(state_path(self.directory, commit_id), state, self.keys)
+        size = self._size(state)
+        if size > self.memory_budget:
+            return
+        self._states[commit_id] = (state, consumers, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_budget:
+            _, (_, _, evicted_size) = self._states.popitem(last=False)
+            self.memory_used -= evicted_size
+
+    def get(self, commit_id):
+        """
+        Fetches the state of a fork commit from the memory or the spill file.
+        :param commit_id: ID of the commit
+        :return: dict from the integer keys of the code entities to :class:`~memeshark.state.CESState`; None if the
+            state is not cached
+        """
+        if commit_id in self._states:
+            state, consumers, size = self._states.pop(commit_id)
+            if consumers > 1:
+                self._states[commit_id] = (state, consumers - 1, size)
+            else:
+                self.memory_used -= size
+            return state
+        return read_state(state_path(self.directory, commit_id), self.keys)
+
+    def _size(self, state):
+        """
+        Estimates the memory of a state.
+        :param state: the state
+        :return: estimated number of bytes
+        """
+        return len(state) * self.ENTRY_SIZE
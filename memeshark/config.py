@@ -45,8 +45,31 @@ class Config(object):
         self.authentication_db = args.db_authentication
         self.debug = args.log_level
         self.project_name = args.project_name
+        self.projects = args.projects
+        self.all_projects = args.all_projects
+        self.project_order = args.project_order
         self.processes = int(args.processes)
         self.ssl_enabled = args.ssl
+        self.verify_fingerprints = args.verify_fingerprints
+        self.read_batch_size = int(args.read_batch_size)
+        self.write_batch_size = int(args.write_batch_size)
+        self.write_flush_interval = float(args.write_flush_interval)
+        self.write_concern = int(args.write_concern) if str(args.write_concern).isdigit() else args.write_concern
+        self.cache_memory = int(args.cache_memory) * 1024 * 1024
+        self.incremental = args.incremental
+        self.journal = args.journal
+        self.prefetch_depth = int(args.prefetch_depth)
+        self.prefetch_documents = int(args.prefetch_documents)
+        self.dry_run = args.dry_run
+        self.dry_run_sample = float(args.dry_run_sample)
+        self.metrics_interval = float(args.metrics_interval)
+        self.metrics_file = args.metrics_file
+        self.profile = args.profile
+        self.distributed = args.distributed
+        self.join = args.join
+        self.lease_time = float(args.lease_time)
+        self.offline = args.offline
+        self.offline_output = args.offline_output
 
     def get_debug_level(self):
         """
@@ -64,7 +87,13 @@ class Config(object):
 
     def __str__(self):
         return "Config: host: %s, port: %s, user: %s, " \
-               "password: %s, database: %s, authentication_db: %s, ssl: %s, project_name:%s, processes: %s, log_level: %s" % \
+               "password: %s, database: %s, authentication_db: %s, ssl: %s, project_name:%s, " \
+               "projects: %s, all_projects: %s, project_order: %s, processes: %s, log_level: %s, " \
+               "verify_fingerprints: %s, read_batch_size: %s, write_batch_size: %s, write_flush_interval: %s, " \
+               "write_concern: %s, cache_memory: %s, incremental: %s, journal: %s, " \
+               "prefetch_depth: %s, prefetch_documents: %s, dry_run: %s, dry_run_sample: %s, " \
+               "metrics_interval: %s, metrics_file: %s, profile: %s, distributed: %s, join: %s, " \
+               "lease_time: %s, offline: %s, offline_output: %s" % \
                (
                    self.host,
                    self.port,
@@ -74,8 +103,31 @@ class Config(object):
                    self.authentication_db,
                    self.ssl_enabled,
                    self.project_name,
+                   self.projects,
+                   self.all_projects,
+                   self.project_order,
                    self.processes,
                    self.debug,
+                   self.verify_fingerprints,
+                   self.read_batch_size,
+                   self.write_batch_size,
+                   self.write_flush_interval,
+                   self.write_concern,
+                   self.cache_memory,
+                   self.incremental,
+                   self.journal,
+                   self.prefetch_depth,
+                   self.prefetch_documents,
+                   self.dry_run,
+                   self.dry_run_sample,
+                   self.metrics_interval,
+                   self.metrics_file,
+                   self.profile,
+                   self.distributed,
+                   self.join,
+                   self.lease_time,
+                   self.offline,
+                   self.offline_output,
                )
 
 
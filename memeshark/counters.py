@@ -0,0 +1,257 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import timeit
+
+
+class Counters(object):
+    """
+    Counters of the workers in shared memory, such that the coordinator can read them while the workers run. Every
+    worker has its own row of counters that only it writes, i.e., the counters do not require a lock between the
+    processes. Besides the counters of the merging, every operation on the MongoDB counts its round-trips, its time,
+    and its documents.
+    :param workers: number of workers
+    """
+
+    COUNTERS = ('commits', 'ces_compared', 'ces_deleted', 'ces_updated')
+    OPERATIONS = ('find_commits', 'find_ces', 'write_commits', 'write_ces')
+    OPERATION_COUNTERS = ('round_trips', 'seconds', 'documents')
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.width = len(self.COUNTERS) + len(self.OPERATIONS) * len(self.OPERATION_COUNTERS)
+        self._values = multiprocessing.RawArray('d', workers * self.width)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, worker, counter, value=1):
+        """
+        Increments a counter of a worker.
+        :param worker: number of the worker
+        :param counter: name of the counter (see :attr:`COUNTERS`)
+        :param value: increment
+        """
+        index = worker * self.width + self.COUNTERS.index(counter)
+        # the read-ahead thread of a worker shares its row
+        with self._lock:
+            self._values[index] += value
+
+    def record(self, worker, operation, seconds, documents, round_trips=1):
+        """
+        Records an operation on the MongoDB.
+        :param worker: number of the worker
+        :param operation: name of the operation (see :attr:`OPERATIONS`)
+        :param seconds: time in seconds that the operation took
+        :param documents: number of documents that were read or written
+        :param round_trips: number of round-trips of the operation
+        """
+        index = worker * self.width + len(self.COUNTERS) + \
+            self.OPERATIONS.index(operation) * len(self.OPERATION_COUNTERS)
+        with self._lock:
+            self._values[index] += round_trips
+            self._values[index + 1] += seconds
+            self._values[index + 2] += documents
+
+    def worker(self, worker):
+        """
+        :param worker: number of the worker
+        :return: the counters of the worker (see :class:`WorkerCounters`)
+        """
+        return WorkerCounters(self, worker)
+
+    def snapshot(self):
+        """
+        Copies the counters of all workers.
+        :return: list with one dict of the counters per worker; the operations are dicts of their counters
+        """
+        values = self._values[:]
+        workers = []
+        for worker in range(0, self.workers):
+            row = values[worker * self.width:(worker + 1) * self.width]
+            counters = dict(zip(self.COUNTERS, row))
+            for i, operation in enumerate(self.OPERATIONS):
+                start = len(self.COUNTERS) + i * len(self.OPERATION_COUNTERS)
+                counters[operation] = dict(zip(self.OPERATION_COUNTERS,
+                                               row[start:start + len(self.OPERATION_COUNTERS)]))
+            workers.append(counters)
+        return workers
+
+
+class WorkerCounters(object):
+    """
+    The counters of one worker (see :class:`Counters`).
+    :param counters: the shared counters
+    :param worker: number of the worker
+    """
+
+    def __init__(self, counters, worker):
+        self.counters = counters
+        self.worker = worker
+
+    def add(self, counter, value=1):
+        """
+        Increments a counter (see :meth:`Counters.add`).
+        """
+        self.counters.add(self.worker, counter, value)
+
+    def record(self, operation, seconds, documents, round_trips=1):
+        """
+        Records an operation on the MongoDB (see :meth:`Counters.record`).
+        """
+        self.counters.record(self.worker, operation, seconds, documents, round_trips)
+
+
+def total(workers):
+    """
+    Sums the counters of all workers.
+    :param workers: list of the counters of the workers (see :meth:`Counters.snapshot`)
+    :return: dict of the summed counters
+    """
+    counters = {counter: sum(worker[counter] for worker in workers) for counter in Counters.COUNTERS}
+    for operation in Counters.OPERATIONS:
+        counters[operation] = {counter: sum(worker[operation][counter] for worker in workers)
+                               for counter in Counters.OPERATION_COUNTERS}
+    return counters
+
+
+class CounterReporter(object):
+    """
+    Periodically logs a summary of the :class:`Counters` and optionally writes them to a file that can be scraped
+    during long runs. Files that end with .prom are written in the Prometheus text format, all other files as JSON.
+    The file is replaced atomically.
+    :param counters: the counters of the workers
+    :param interval: time in seconds between two reports
+    :param path: path of the file to which the counters are written (optional)
+    """
+
+    def __init__(self, counters, interval=60.0, path=None):
+        self.logger = logging.getLogger("main")
+        self.counters = counters
+        self.interval = interval
+        self.path = path
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+        self._last_time = None
+        self._last = None
+
+    def start(self):
+        """
+        Starts to report in a background thread.
+        """
+        self._start_time = self._last_time = timeit.default_timer()
+        self._last = total(self.counters.snapshot())
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread and reports the final counters.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.report()
+
+    def report(self):
+        """
+        Logs the totals of the counters with the rates since the last report and writes the file.
+        """
+        now = timeit.default_timer()
+        workers = self.counters.snapshot()
+        counters = total(workers)
+        elapsed = now - self._last_time
+        rates = {counter: (counters[counter] - self._last[counter]) / elapsed if elapsed > 0 else 0
+                 for counter in Counters.COUNTERS}
+        ces_read = counters['find_ces']['documents']
+        self.logger.info("%i commits (%0.1f/s), %i code entity states read (%0.1f/s), %i compared (%0.1f/s), "
+                         "%i deleted (%0.1f/s), %i updated (%0.1f/s)", counters['commits'], rates['commits'],
+                         ces_read, (ces_read - self._last['find_ces']['documents']) / elapsed if elapsed > 0 else 0,
+                         counters['ces_compared'], rates['ces_compared'], counters['ces_deleted'],
+                         rates['ces_deleted'], counters['ces_updated'], rates['ces_updated'])
+        for operation in Counters.OPERATIONS:
+            self._log_operation("all workers", operation, counters[operation], logging.INFO)
+        for worker, worker_counters in enumerate(workers):
+            self.logger.debug("worker%i: %i commits, %i code entity states compared, %i deleted, %i updated", worker,
+                              worker_counters['commits'], worker_counters['ces_compared'],
+                              worker_counters['ces_deleted'], worker_counters['ces_updated'])
+            for operation in Counters.OPERATIONS:
+                self._log_operation("worker%i" % worker, operation, worker_counters[operation], logging.DEBUG)
+
+        if self.path is not None:
+            try:
+                self._write(workers, counters, rates, now - self._start_time)
+            except OSError as e:
+                self.logger.warning("could not write the counters to %s: %s", self.path, e)
+        self._last_time = now
+        self._last = counters
+
+    def _run(self):
+        """
+        Reports until the reporter is stopped.
+        """
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def _log_operation(self, name, operation, counters, level):
+        """
+        Logs the counters of an operation on the MongoDB.
+        :param name: name of the workers
+        :param operation: name of the operation
+        :param counters: the counters of the operation
+        :param level: log level
+        """
+        if counters['round_trips'] == 0:
+            return
+        self.logger.log(level, "%s %s: %i round-trips, %i documents, %0.2f ms per round-trip", name, operation,
+                        counters['round_trips'], counters['documents'],
+                        1000 * counters['seconds'] / counters['round_trips'])
+
+    def _write(self, workers, counters, rates, elapsed):
+        """
+        Writes the counters to the file.
+        :param workers: the counters of the workers
+        :param counters: the totals of the counters
+        :param rates: the rates of the counters since the last report
+        :param elapsed: time in seconds since the start
+        """
+        if self.path.endswith('.prom'):
+            content = self._prometheus(workers)
+        else:
+            content = json.dumps({'elapsed': elapsed, 'total': counters, 'rates': rates, 'workers': workers},
+                                 indent=2)
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(content)
+        os.replace(temporary_path, self.path)
+
+    def _prometheus(self, workers):
+        """
+        Formats the counters of the workers in the Prometheus text format.
+        :param workers: the counters of the workers
+        :return: the text
+        """
+        lines = []
+        for counter in Counters.COUNTERS:
+            lines.append('# TYPE memeshark_%s_total counter' % counter)
+            for worker, worker_counters in enumerate(workers):
+                lines.append('memeshark_%s_total{worker="%i"} %s' % (counter, worker, repr(worker_counters[counter])))
+        for counter in Counters.OPERATION_COUNTERS:
+            lines.append('# TYPE memeshark_db_%s_total counter' % counter)
+            for worker, worker_counters in enumerate(workers):
+                for operation in Counters.OPERATIONS:
+                    lines.append('memeshark_db_%s_total{worker="%i",operation="%s"} %s' %
+                                 (counter, worker, operation, repr(worker_counters[operation][counter])))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,167 @@
+import mmap
+import os
+import struct
+
+import bson
+from bson import ObjectId
+from bson.binary import UuidRepresentation
+from bson.codec_options import CodecOptions
+
+_INT32 = struct.Struct('<i')
+
+# options that decode and encode documents without changing the types of their values, e.g., the subtypes of UUIDs
+CODEC_OPTIONS = CodecOptions(uuid_representation=UuidRepresentation.UNSPECIFIED)
+
+# sizes of the BSON types with a fixed size
+_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0,
+                0xFF: 0}
+
+# BSON types whose size is given by an int32 that includes itself
+_SIZED = (0x03, 0x04, 0x0F)
+
+# BSON types whose size is given by an int32 that excludes itself
+_STRINGS = (0x02, 0x0D, 0x0E)
+
+
+class BSONFile(object):
+    """
+    A collection of a mongodump, i.e., a file with concatenated BSON documents, that is memory-mapped, such that the
+    documents are decoded only if they are needed. The documents are addressed by their offsets in the file.
+    :param path: path of the .bson file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    def close(self):
+        """
+        Unmaps and closes the file.
+        """
+        if isinstance(self._mapped, mmap.mmap):
+            self._mapped.close()
+        self._file.close()
+
+    def __iter__(self):
+        """
+        :return: iterator over the offsets of the documents
+        """
+        offset = 0
+        end = len(self._mapped)
+        while offset < end:
+            yield offset
+            offset += _INT32.unpack_from(self._mapped, offset)[0]
+
+    def raw(self, offset):
+        """
+        :param offset: offset of a document
+        :return: the encoded document
+        """
+        return self._mapped[offset:offset + _INT32.unpack_from(self._mapped, offset)[0]]
+
+    def decode(self, offset):
+        """
+        :param offset: offset of a document
+        :return: the document as dict
+        """
+        return bson.decode(self.raw(offset), CODEC_OPTIONS)
+
+    def object_ids(self, offset, names):
+        """
+        Reads top-level fields of type ObjectId of a document without decoding it.
+        :param offset: offset of a document
+        :param names: tuple of the names of the fields as bytes
+        :return: dict from the names of the fields to their ObjectIds; fields that do not exist or are not ObjectIds
+            are missing
+        """
+        try:
+            positions = _object_id_positions(self._mapped, offset, names)
+        except ValueError:
+            document = self.decode(offset)
+            return {name: document[name.decode('utf-8')] for name in names
+                    if isinstance(document.get(name.decode('utf-8')), ObjectId)}
+        return {name: ObjectId(self._mapped[position:position + 12]) for name, position in positions.items()}
+
+    def replace_object_id(self, offset, name, value):
+        """
+        Encodes a document in which the value of a top-level field of type ObjectId is replaced. The bytes of the
+        value are replaced without decoding the document.
+        :param offset: offset of a document
+        :param name: name of the field as bytes
+        :param value: the new ObjectId
+        :return: the encoded document
+        """
+        raw = self.raw(offset)
+        try:
+            position = _object_id_positions(self._mapped, offset, (name,)).get(name)
+        except ValueError:
+            position = None
+        if position is None:
+            document = bson.decode(raw, CODEC_OPTIONS)
+            document[name.decode('utf-8')] = value
+            return bson.encode(document, codec_options=CODEC_OPTIONS)
+        position -= offset
+        return raw[:position] + value.binary + raw[position + 12:]
+
+
+def _object_id_positions(data, offset, names):
+    """
+    Finds top-level fields of type ObjectId of a BSON document. The elements of the document are skipped until all
+    fields are found.
+    :param data: buffer with the document
+    :param offset: offset of the document in the buffer
+    :param names: tuple of the names of the fields as bytes
+    :return: dict from the names of the fields to the offsets of their values in the buffer
+    """
+    end = offset + _INT32.unpack_from(data, offset)[0] - 1
+    position = offset + 4
+    found = {}
+    while position < end and len(found) < len(names):
+        element_type = data[position]
+        name_end = _cstring_end(data, position + 1)
+        name = data[position + 1:name_end]
+        position = name_end + 1
+        if element_type == 0x07:
+            if name in names:
+                found[name] = position
+            position += 12
+        elif element_type in _FIXED_SIZES:
+            position += _FIXED_SIZES[element_type]
+        elif element_type in _SIZED:
+            position += _INT32.unpack_from(data, position)[0]
+        elif element_type in _STRINGS:
+            position += 4 + _INT32.unpack_from(data, position)[0]
+        elif element_type == 0x05:
+            position += 5 + _INT32.unpack_from(data, position)[0]
+        elif element_type == 0x0B:
+            position = _cstring_end(data, _cstring_end(data, position) + 1) + 1
+        elif element_type == 0x0C:
+            position += 4 + _INT32.unpack_from(data, position)[0] + 12
+        else:
+            raise ValueError('unknown BSON type %i' % element_type)
+    return found
+
+
+def _cstring_end(data, position):
+    """
+    :param data: buffer with a BSON document
+    :param position: offset of a cstring in the buffer
+    :return: offset of the terminating null byte of the cstring
+    """
+    end = data.find(b'\x00', position)
+    if end < 0:
+        raise ValueError('unterminated cstring at offset %i' % position)
+    return end
+
+
+def read_collection(path):
+    """
+    Decodes all documents of a small collection of a mongodump.
+    :param path: path of the .bson file
+    :return: iterator over the documents as dicts
+    """
+    with open(path, 'rb') as f:
+        for document in bson.decode_file_iter(f):
+            yield document
@@ -0,0 +1,143 @@
+import hashlib
+import struct
+from math import isnan
+
+from mongoengine.base import BaseDocument
+
+# fields that differ between states of the same code entity, even if the code entity did not change
+EXCLUDED_FIELDS = frozenset(['_id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids'])
+
+# field with the dict of the metrics of a code entity state, which is fingerprinted with a digest of its numbers
+METRICS_FIELD = 'metrics'
+
+# integers with a larger absolute value cannot be represented exactly as float and are fingerprinted canonically
+MAX_EXACT_INTEGER = 2 ** 53
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# bits of the float that represents all NaNs in the digest of the metrics
+NAN_BITS = 0x7FF8000000000000
+
+_DOUBLE = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+_key_hashes = {}
+
+
+def _canonical(value, out):
+    """
+    Writes a canonical representation of a value. The keys of dicts are sorted, numbers are written independent of
+    their type (i.e., 1 and 1.0 are the same) and all NaNs are written the same way.
+    :param value: the value
+    :param out: list to which the parts of the representation are appended
+    """
+    if isinstance(value, dict):
+        out.append('{')
+        for key in sorted(value):
+            out.append(repr(key))
+            out.append(':')
+            _canonical(value[key], out)
+            out.append(',')
+        out.append('}')
+    elif isinstance(value, (list, tuple)):
+        out.append('[')
+        for item in value:
+            _canonical(item, out)
+            out.append(',')
+        out.append(']')
+    elif isinstance(value, float):
+        if isnan(value):
+            out.append('nan')
+        elif value.is_integer():
+            out.append('%d' % value)
+        else:
+            out.append(repr(value))
+    elif isinstance(value, int):
+        out.append('%d' % value)
+    else:
+        out.append(repr(value))
+
+
+def is_numeric(metrics):
+    """
+    :param metrics: the metrics of a code entity state
+    :return: true if the metrics are a dict of numbers that are exactly represented as float, false otherwise
+    """
+    if not isinstance(metrics, dict):
+        return False
+    for value in metrics.values():
+        if type(value) is not float and \
+                (not isinstance(value, int) or not -MAX_EXACT_INTEGER <= value <= MAX_EXACT_INTEGER):
+            return False
+    return True
+
+
+def key_hash(key):
+    """
+    :param key: name of a metric
+    :return: hash of the name that is the same in all processes as int with 64 bits
+    """
+    if key not in _key_hashes:
+        _key_hashes[key] = _UINT64.unpack(hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+    return _key_hashes[key]
+
+
+def splitmix64(value):
+    """
+    Mixes the bits of an int with 64 bits (finalizer of SplitMix64).
+    :param value: the int
+    :return: the mixed int with 64 bits
+    """
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def metrics_digest(metrics):
+    """
+    Calculates the digest of numeric metrics (see :func:`is_numeric`) as the sum of the mixed names and float bits of
+    all metrics modulo 2^64. Numbers are compared as floats, i.e., 1 and 1.0 as well as 0.0 and -0.0 are the same,
+    and all NaNs are the same. :mod:`memeshark.metrics` calculates the same digest for many states at once.
+    :param metrics: the metrics
+    :return: the digest as int with 64 bits
+    """
+    digest = 0
+    for key, value in metrics.items():
+        value = float(value)
+        if isnan(value):
+            bits = NAN_BITS
+        elif value == 0:
+            bits = 0
+        else:
+            bits = _UINT64.unpack(_DOUBLE.pack(value))[0]
+        digest += splitmix64(key_hash(key) ^ bits)
+    return digest & MASK64
+
+
+def fingerprint(ces, excluded_fields=EXCLUDED_FIELDS, digest=None):
+    """
+    Calculates a fingerprint of the content of a code entity state. Two states have the same fingerprint if and only
+    if :meth:`~memeshark.memeshark.MemeSHARKWorker._compare_dicts` considers them as equal (up to hash collisions).
+    Fields that are not set, None, or empty are ignored, because they are the same for the comparison. Numeric metrics
+    are represented by their :func:`metrics_digest`.
+    :param ces: the code entity state, either as :class:`~pycoshark.mongomodels.CodeEntityState` or as raw dict
+    :param excluded_fields: names of the fields in the database that are ignored
+    :param digest: the :func:`metrics_digest` of the metrics if it was already calculated (optional)
+    :return: the fingerprint as 16 bytes
+    """
+    if isinstance(ces, BaseDocument):
+        ces = ces.to_mongo()
+    out = []
+    for key in sorted(ces):
+        value = ces[key]
+        if key in excluded_fields or value is None or (isinstance(value, (list, dict)) and len(value) == 0):
+            continue
+        out.append(key)
+        out.append('=')
+        if key == METRICS_FIELD and (digest is not None or is_numeric(value)):
+            out.append('#%016x' % (digest if digest is not None else metrics_digest(value)))
+        else:
+            _canonical(value, out)
+        out.append(';')
+    # MD5 is only used as a fast hash with 16 bytes, hashlib.blake2b requires Python 3.6
+    return hashlib.md5(''.join(out).encode('utf-8')).digest()
@@ -0,0 +1,464 @@
+import json
+import mmap
+import struct
+from array import array
+
+from bson import ObjectId
+
+_MAGIC = b'MEMESHRK'
+_HEADER = struct.Struct('<8sQ')
+_ALIGNMENT = 8
+
+
+def _save_arrays(path, arrays):
+    """
+    Writes arrays to a binary file that can be memory-mapped with :func:`_load_arrays`.
+    :param path: path of the file
+    :param arrays: list of (name, typecode, buffer) tuples
+    """
+    entries = []
+    offset = 0
+    for name, typecode, data in arrays:
+        nbytes = memoryview(data).nbytes
+        entries.append({'name': name, 'typecode': typecode, 'offset': offset, 'nbytes': nbytes})
+        offset += nbytes + (-nbytes % _ALIGNMENT)
+    header = json.dumps(entries).encode('utf-8')
+    header += b' ' * (-(_HEADER.size + len(header)) % _ALIGNMENT)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(header)))
+        f.write(header)
+        for (name, typecode, data), entry in zip(arrays, entries):
+            f.write(memoryview(data).cast('B'))
+            f.write(b'\0' * (-entry['nbytes'] % _ALIGNMENT))
+
+
+def _load_arrays(path):
+    """
+    Memory-maps a file written with :func:`_save_arrays`. The pages are shared between all processes that map the file.
+    :param path: path of the file
+    :return: dict from the names of the arrays to read-only memoryviews
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_size = _HEADER.unpack_from(mapped, 0)
+    if magic != _MAGIC:
+        raise ValueError('%s is not a memeSHARK array file' % path)
+    entries = json.loads(mapped[_HEADER.size:_HEADER.size + header_size].decode('utf-8'))
+    data_offset = _HEADER.size + header_size
+
+    buffer = memoryview(mapped)
+    arrays = {}
+    for entry in entries:
+        start = data_offset + entry['offset']
+        arrays[entry['name']] = buffer[start:start + entry['nbytes']].cast(entry['typecode'])
+    return arrays
+
+
+def _csr(no_nodes, edges):
+    """
+    Creates the offsets and indices of a compressed sparse row representation of adjacency lists.
+    :param no_nodes: number of nodes
+    :param edges: list of (source, target) tuples; the order of the targets of a source is retained
+    :return: tuple of the offsets and indices arrays
+    """
+    offsets = array('i', bytes(4 * (no_nodes + 1)))
+    for source, _ in edges:
+        offsets[source + 1] += 1
+    for i in range(0, no_nodes):
+        offsets[i + 1] += offsets[i]
+    indices = array('i', bytes(4 * len(edges)))
+    position = array('i', offsets[:-1])
+    for source, target in edges:
+        indices[position[source]] = target
+        position[source] += 1
+    return offsets, indices
+
+
+class CompactCommitGraph(object):
+    """
+    Read-only commit graph that is stored in flat arrays. The nodes are the integer indices 0..n-1 in the order in which
+    the commits were streamed. The predecessors and successors are stored in CSR-style offset/index arrays and the
+    commit ids in a table of 12 byte ObjectIds. The graph can be saved to a file and memory-mapped by the workers, such
+    that all processes share the same pages instead of holding copies.
+    :param ids: buffer with the binary commit ids (12 bytes per node)
+    :param pred_offsets: offsets of the predecessors of the nodes in pred_indices
+    :param pred_indices: predecessors of all nodes
+    :param succ_offsets: offsets of the successors of the nodes in succ_indices
+    :param succ_indices: successors of all nodes
+    """
+
+    def __init__(self, ids, pred_offsets, pred_indices, succ_offsets, succ_indices):
+        self._ids = ids
+        self._pred_offsets = pred_offsets
+        self._pred_indices = pred_indices
+        self._succ_offsets = succ_offsets
+        self._succ_indices = succ_indices
+        self._index = None
+
+    @classmethod
+    def from_commits(cls, commits):
+        """
+        Builds the graph from a stream of commit documents. The parents of the commits are resolved through an
+        in-memory index of the revision hashes, i.e., no additional queries are required.
+        :param commits: iterable of dicts with the keys _id, revision_hash, and parents (e.g., a projected pymongo
+            cursor)
+        :return: tuple of the commit graph and a list of (commit id, revision hash) pairs of parents that are missing
+        """
+        ids = bytearray()
+        node_by_hash = {}
+        parents = []
+
+        # first we index all nodes and remember the parents, because they may be streamed after the children
+        for node, c in enumerate(commits):
+            ids += c['_id'].binary
+            node_by_hash[c['revision_hash']] = node
+            if c.get('parents'):
+                parents.append((node, c['parents']))
+
+        # after that we resolve all edges
+        missing = []
+        edges = []
+        for node, revision_hashes in parents:
+            resolved = []
+            for p in revision_hashes:
+                parent = node_by_hash.get(p)
+                if parent is None:
+                    missing.append((ObjectId(bytes(ids[12 * node:12 * node + 12])), p))
+                elif parent not in resolved:
+                    resolved.append(parent)
+            edges.extend((node, parent) for parent in resolved)
+
+        no_nodes = len(node_by_hash)
+        pred_offsets, pred_indices = _csr(no_nodes, edges)
+        succ_offsets, succ_indices = _csr(no_nodes, [(parent, node) for node, parent in edges])
+        return cls(bytes(ids), pred_offsets, pred_indices, succ_offsets, succ_indices), missing
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a graph that was written with :meth:`save`.
+        :param path: path of the graph file
+        :return: the commit graph
+        """
+        arrays = _load_arrays(path)
+        return cls(arrays['ids'], arrays['pred_offsets'], arrays['pred_indices'], arrays['succ_offsets'],
+                   arrays['succ_indices'])
+
+    def save(self, path):
+        """
+        Writes the graph to a file.
+        :param path: path of the graph file
+        """
+        _save_arrays(path, [('ids', 'B', self._ids),
+                            ('pred_offsets', 'i', self._pred_offsets),
+                            ('pred_indices', 'i', self._pred_indices),
+                            ('succ_offsets', 'i', self._succ_offsets),
+                            ('succ_indices', 'i', self._succ_indices)])
+
+    def __len__(self):
+        return len(self._pred_offsets) - 1
+
+    def __iter__(self):
+        return iter(range(0, len(self)))
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def number_of_edges(self):
+        return len(self._pred_indices)
+
+    def node_id(self, node):
+        """
+        :param node: index of the node
+        :return: the commit id of the node
+        """
+        return ObjectId(bytes(self._ids[12 * node:12 * node + 12]))
+
+    def index(self, commit_id):
+        """
+        :param commit_id: id of a commit
+        :return: the index of the node of the commit
+        """
+        if self._index is None:
+            self._index = {bytes(self._ids[12 * node:12 * node + 12]): node for node in self}
+        return self._index[commit_id.binary]
+
+    def pred(self, node):
+        """
+        :param node: index of the node
+        :return: the indices of the predecessors of the node
+        """
+        return self._pred_indices[self._pred_offsets[node]:self._pred_offsets[node + 1]]
+
+    def succ(self, node):
+        """
+        :param node: index of the node
+        :return: the indices of the successors of the node
+        """
+        return self._succ_indices[self._succ_offsets[node]:self._succ_offsets[node + 1]]
+
+    def in_degree(self, node):
+        return self._pred_offsets[node + 1] - self._pred_offsets[node]
+
+    def out_degree(self, node):
+        return self._succ_offsets[node + 1] - self._succ_offsets[node]
+
+
+def build_commit_graph(commits):
+    """
+    Builds the commit graph from a stream of commit documents.
+    :param commits: iterable of dicts with the keys _id, revision_hash, and parents
+    :return: tuple of the :class:`CompactCommitGraph` and a list of (commit id, revision hash) pairs of missing parents
+    """
+    return CompactCommitGraph.from_commits(commits)
+
+
+class CommitStatus(object):
+    """
+    Status of the commits of a :class:`CompactCommitGraph` at the start of a run, indexed by the nodes of the graph:
+    whether a commit was already processed, i.e., has code entity states, and how many code entity states the commit
+    has in the collection. Like the graph, the status is stored in flat arrays that the workers memory-map.
+    :param processed: one byte per node that is 1 if the commit was already processed
+    :param ces_counts: number of code entity states of each commit; empty if the numbers are not available
+    """
+
+    def __init__(self, processed, ces_counts):
+        self._processed = processed
+        self._ces_counts = ces_counts
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a status that was written with :meth:`save`.
+        :param path: path of the status file
+        :return: the commit status
+        """
+        arrays = _load_arrays(path)
+        return cls(arrays['processed'], arrays['ces_counts'])
+
+    def save(self, path):
+        """
+        Writes the status to a file.
+        :param path: path of the status file
+        """
+        _save_arrays(path, [('processed', 'B', self._processed),
+                            ('ces_counts', 'q', self._ces_counts)])
+
+    def __len__(self):
+        return len(self._processed)
+
+    def is_processed(self, node):
+        """
+        :param node: index of the node
+        :return: true if the commit was already processed at the start of the run
+        """
+        return self._processed[node] != 0
+
+    def processed(self):
+        """
+        :return: bytearray with one byte per node that is 1 if the commit was already processed
+        """
+        return bytearray(self._processed)
+
+    def mark_processed(self, nodes):
+        """
+        Creates a copy of the status in which nodes are processed, e.g., the commits that a worker of a distributed run
+        processed before it lost the lease of its task.
+        :param nodes: indices of the nodes
+        :return: the new :class:`CommitStatus`
+        """
+        processed = self.processed()
+        for node in nodes:
+            processed[node] = 1
+        return CommitStatus(processed, self._ces_counts)
+
+    def has_ces_counts(self):
+        """
+        :return: true if the numbers of code entity states are available
+        """
+        return len(self._ces_counts) == len(self._processed)
+
+    def ces_count(self, node):
+        """
+        :param node: index of the node
+        :return: the number of code entity states of the commit
+        """
+        return self._ces_counts[node]
+
+    def weights(self):
+        """
+        :return: array with one plus the number of code entity states for each node, i.e., the costs of merging the
+            commits; None if the numbers of code entity states are not available
+        """
+        if not self.has_ces_counts():
+            return None
+        return array('d', (1.0 + count for count in self._ces_counts))
+
+
+class ChainPartition(object):
+    """
+    Decomposition of a commit graph into linear chains. A chain starts at a node that either does not have exactly one
+    predecessor (start of a path) or whose predecessor has multiple successors (start of a branch). The chain is
+    extended as long as its last node has exactly one successor and this successor has exactly one predecessor.
+    Thus, every node belongs to exactly one chain. The parent of the chain of a branch is the chain that ends with the
+    predecessor of the branch; chains of paths do not have a parent, because they start from their own state.
+    Like the :class:`CompactCommitGraph`, the partition is stored in flat arrays that can be memory-mapped.
+    :param offsets: offsets of the nodes of the chains in nodes
+    :param nodes: nodes of all chains
+    :param parents: parent of each chain; -1 if the chain does not have a parent
+    :param child_offsets: offsets of the children of the chains in children
+    :param children: children of all chains
+    """
+
+    def __init__(self, offsets, nodes, parents, child_offsets, children):
+        self._offsets = offsets
+        self._nodes = nodes
+        self._parents = parents
+        self._child_offsets = child_offsets
+        self._children = children
+
+    @classmethod
+    def from_graph(cls, commit_graph, processed=None):
+        """
+        Decomposes a commit graph into chains. Nodes that are already processed can be excluded, e.g., for incremental
+        runs. A chain whose head has a processed predecessor does not have a parent, because the state of the
+        predecessor is loaded from the database.
+        :param commit_graph: the commit graph (see :class:`CompactCommitGraph`)
+        :param processed: one byte per node that is not zero if the node is already processed (optional)
+        :return: the chain partition
+        """
+        def is_processed(node):
+            return processed is not None and processed[node] != 0
+
+        offsets = array('i', [0])
+        nodes = array('i')
+        chain_of_node = array('i', bytes(4 * len(commit_graph)))
+        for node in commit_graph:
+            if is_processed(node):
+                continue
+            if commit_graph.in_degree(node) == 1 and commit_graph.out_degree(commit_graph.pred(node)[0]) == 1 and \
+                    not is_processed(commit_graph.pred(node)[0]):
+                continue  # node is inside a chain
+            chain = len(offsets) - 1
+            while True:
+                nodes.append(node)
+                chain_of_node[node] = chain
+                if commit_graph.out_degree(node) != 1:
+                    break
+                successor = commit_graph.succ(node)[0]
+                if commit_graph.in_degree(successor) != 1 or is_processed(successor):
+                    break
+                node = successor
+            offsets.append(len(nodes))
+
+        no_chains = len(offsets) - 1
+        parents = array('i', [-1] * no_chains)
+        for chain in range(0, no_chains):
+            head = nodes[offsets[chain]]
+            if commit_graph.in_degree(head) == 1 and not is_processed(commit_graph.pred(head)[0]):
+                parents[chain] = chain_of_node[commit_graph.pred(head)[0]]
+        child_offsets, children = _csr(no_chains, [(parent, chain) for chain, parent in enumerate(parents)
+                                                   if parent >= 0])
+        return cls(offsets, nodes, parents, child_offsets, children)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a partition that was written with :meth:`save`.
+        :param path: path of the partition file
+        :return: the chain partition
+        """
+        arrays = _load_arrays(path)
+        return cls(arrays['offsets'], arrays['nodes'], arrays['parents'], arrays['child_offsets'], arrays['children'])
+
+    def save(self, path):
+        """
+        Writes the partition to a file.
+        :param path: path of the partition file
+        """
+        _save_arrays(path, [('offsets', 'i', self._offsets),
+                            ('nodes', 'i', self._nodes),
+                            ('parents', 'i', self._parents),
+                            ('child_offsets', 'i', self._child_offsets),
+                            ('children', 'i', self._children)])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        return iter(range(0, len(self)))
+
+    def nodes(self, chain):
+        """
+        :param chain: index of the chain
+        :return: the nodes of the chain in the order in which they must be merged
+        """
+        return self._nodes[self._offsets[chain]:self._offsets[chain + 1]]
+
+    def head(self, chain):
+        return self._nodes[self._offsets[chain]]
+
+    def tail(self, chain):
+        return self._nodes[self._offsets[chain + 1] - 1]
+
+    def length(self, chain):
+        return self._offsets[chain + 1] - self._offsets[chain]
+
+    def parent(self, chain):
+        """
+        :param chain: index of the chain
+        :return: the index of the parent chain; -1 if the chain starts a path
+        """
+        return self._parents[chain]
+
+    def children(self, chain):
+        """
+        :param chain: index of the chain
+        :return: the indices of the chains of the branches that start after the last node of the chain
+        """
+        return self._children[self._child_offsets[chain]:self._child_offsets[chain + 1]]
+
+    def weights(self, node_weights=None):
+        """
+        Calculates the weight of each chain, i.e., the sum of the weights of its nodes.
+        :param node_weights: weights of the nodes; if None, every node has the weight one
+        :return: array with the weights of the chains
+        """
+        chain_weights = array('d', bytes(8 * len(self)))
+        for chain in self:
+            if node_weights is None:
+                chain_weights[chain] = self.length(chain)
+            else:
+                chain_weights[chain] = sum(node_weights[node] for node in self.nodes(chain))
+        return chain_weights
+
+    def critical_paths(self, chain_weights):
+        """
+        Calculates the remaining work on the critical path of each chain, i.e., the weight of the chain plus the maximal
+        critical path of its children.
+        :param chain_weights: weights of the chains
+        :return: array with the critical paths of the chains
+        """
+        # the children of a chain may have lower indices than the chain, hence we need a topological order
+        order = [chain for chain in self if self.parent(chain) < 0]
+        for chain in order:
+            order.extend(self.children(chain))
+        critical = array('d', chain_weights)
+        for chain in reversed(order):
+            children = self.children(chain)
+            if len(children) > 0:
+                critical[chain] += max(critical[child] for child in children)
+        return critical
+
+    def sort_children(self, critical_paths):
+        """
+        Sorts the children of every chain by their critical path in descending order. The workers continue with the
+        first child of a chain themselves, i.e., with the longest remaining work.
+        :param critical_paths: critical paths of the chains
+        """
+        children = array('i', self._children)
+        for chain in self:
+            start, end = self._child_offsets[chain], self._child_offsets[chain + 1]
+            children[start:end] = array('i', sorted(children[start:end], key=lambda child: -critical_paths[child]))
+        self._children = children
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def state_digest(ces_ids):
+    """
+    Calculates a digest of the state of a commit that does not depend on the order of the code entity states.
+    :param ces_ids: IDs of the code entity states of the commit
+    :return: the digest as hex string
+    """
+    digest = hashlib.md5()
+    for ces_id in sorted(ces_id.binary for ces_id in ces_ids):
+        digest.update(ces_id)
+    return digest.hexdigest()
+
+
+class Journal(object):
+    """
+    Append-only journal of the chains (see :class:`~memeshark.graph.ChainPartition`) that are finished, i.e., whose
+    writes were flushed to the MongoDB. Every chain is recorded as one line of JSON with its first and last commit,
+    its number of commits, and the :func:`state_digest` of its last commit. Every line is flushed to the disk before
+    the next chain is recorded, such that a crash loses at most the line that was written. After a crash, the
+    finished chains are skipped without querying their commits.
+    :param path: path of the journal file
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger("main")
+        self.path = path
+        self._file = None
+
+    def load(self, commit_graph):
+        """
+        Reads the finished chains from the journal. Chains that do not match the commit graph anymore are ignored.
+        :param commit_graph: the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`)
+        :return: tuple of a bytearray with one byte per node that is 1 if the node is in a finished chain and a dict
+            from the last nodes of the finished chains to the digests of their states
+        """
+        processed = bytearray(len(commit_graph))
+        digests = {}
+        if not os.path.exists(self.path):
+            return processed, digests
+        with open(self.path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                    head = commit_graph.index(ObjectId(entry['head']))
+                    tail = commit_graph.index(ObjectId(entry['tail']))
+                except (ValueError, KeyError, TypeError, InvalidId):
+                    # the last line may be incomplete after a crash
+                    self.logger.warning("ignoring line %i of the journal %s", line_number, self.path)
+                    continue
+                nodes = [head]
+                while len(nodes) < entry['length'] and commit_graph.out_degree(nodes[-1]) == 1:
+                    nodes.append(commit_graph.succ(nodes[-1])[0])
+                if len(nodes) != entry['length'] or nodes[-1] != tail:
+                    self.logger.warning("ignoring chain from commit %s to commit %s of the journal, because it does "
+                                        "not match the commit graph", entry['head'], entry['tail'])
+                    continue
+                for node in nodes:
+                    processed[node] = 1
+                digests[tail] = entry['state']
+        return processed, digests
+
+    def record(self, head, tail, length, digest):
+        """
+        Appends a finished chain to the journal and flushes it to the disk.
+        :param head: ID of the first commit of the chain
+        :param tail: ID of the last commit of the chain
+        :param length: number of commits of the chain
+        :param digest: :func:`state_digest` of the last commit; None if the state is not known
+        """
+        if self._file is None:
+            self._file = open(self.path, 'ab+')
+            if self._file.seek(0, os.SEEK_END) > 0:
+                # terminate a line that was incompletely written before a crash
+                self._file.seek(-1, os.SEEK_END)
+                if self._file.read(1) != b'\n':
+                    self._file.write(b'\n')
+        entry = {'head': str(head), 'tail': str(tail), 'length': length, 'state': digest}
+        self._file.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """
+        Removes the journal after a successful run, because all commits are then processed in the MongoDB.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
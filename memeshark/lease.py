@@ -0,0 +1,500 @@
+import datetime
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import timeit
+
+from bson import ObjectId
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from mongoengine.connection import get_db
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+
+from memeshark.graph import ChainPartition, CommitStatus
+from memeshark.scheduler import job_directory, Scheduler
+
+# files of a job that the coordinator publishes for the workers of other hosts
+JOB_FILES = ('commit_graph.bin', 'chains.bin', 'commit_status.bin', 'job.json')
+
+
+class LeaseError(Exception):
+    """
+    Exception that is thrown if a worker lost the lease of its task, i.e., another worker may process the task
+    """
+    pass
+
+
+def _now():
+    """
+    :return: the current time in UTC as naive datetime, like the datetimes that pymongo returns
+    """
+    return datetime.datetime.utcnow()
+
+
+class TaskBoard(object):
+    """
+    The tasks of a distributed run in the MongoDB. Every task is a document in the collection memeshark_tasks that a
+    worker claims atomically with a lease, i.e., the worker owns the task until the lease expires. The worker renews
+    the lease while it processes the task, such that the tasks of workers that died are claimed again by other workers
+    once their leases expired. The files of the jobs are published in the GridFS bucket memeshark_jobs and the state of
+    the run in the collection memeshark_runs. The leases are compared with the clocks of the hosts, which must be
+    synchronized much closer than the lease time. Every start of a run with the same name is a new generation of the
+    run, such that the tasks and the state of a previous run are not mistaken for the current ones.
+    :param db: the database (see :class:`pymongo.database.Database`)
+    :param run: name of the run
+    :param generation: the generation of the run that is joined; None if the board is reset or joined later
+    """
+
+    def __init__(self, db, run, generation=None):
+        self.run = run
+        self.generation = generation
+        self.tasks = db['memeshark_tasks']
+        self.runs = db['memeshark_runs']
+        self.files = GridFSBucket(db, 'memeshark_jobs')
+
+    def reset(self):
+        """
+        Removes the tasks and files of previous runs with the same name and marks the run as running with a new
+        generation.
+        """
+        self.tasks.create_index([('run', ASCENDING), ('generation', ASCENDING), ('state', ASCENDING),
+                                 ('priority', ASCENDING), ('critical_path', DESCENDING)])
+        self._remove({'run': self.run})
+        self.generation = ObjectId()
+        self.runs.update_one({'_id': self.run}, {'$set': {'state': 'running', 'generation': self.generation,
+                                                          'started': _now()}}, upsert=True)
+
+    def join(self):
+        """
+        Joins the current generation of the run if the run is running.
+        :return: true if the run was joined; false if the run is finished or was not started yet
+        """
+        run = self.runs.find_one({'_id': self.run})
+        if run is None or run['state'] != 'running':
+            return False
+        self.generation = run['generation']
+        return True
+
+    def finish(self):
+        """
+        Marks the run as finished, such that the workers exit, and removes its tasks and files.
+        """
+        self.runs.update_one({'_id': self.run, 'generation': self.generation},
+                             {'$set': {'state': 'finished', 'finished': _now()}})
+        self._remove({'run': self.run, 'generation': self.generation})
+
+    def is_finished(self):
+        """
+        :return: true if the generation of the run is finished or was replaced by a new start of the run; false if it
+            is running
+        """
+        run = self.runs.find_one({'_id': self.run})
+        return run is None or run['state'] == 'finished' or run.get('generation') != self.generation
+
+    def publish_job(self, job, directory):
+        """
+        Uploads the files of a job.
+        :param job: number of the job
+        :param directory: directory of the files of the job
+        """
+        for name in JOB_FILES:
+            with open(os.path.join(directory, name), 'rb') as f:
+                self.files.upload_from_stream(self._filename(job, name), f,
+                                              metadata={'run': self.run, 'generation': self.generation})
+
+    def download_job(self, job, directory):
+        """
+        Downloads the files of a job unless they exist in the directory. The files are written atomically, such that
+        the workers of a host can download them concurrently.
+        :param job: number of the job
+        :param directory: directory of the files of the job
+        """
+        os.makedirs(os.path.join(directory, 'states'), exist_ok=True)
+        for name in JOB_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                continue
+            tmp_path = '%s.%i.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                self.files.download_to_stream_by_name(self._filename(job, name), f)
+            os.replace(tmp_path, path)
+
+    def add_tasks(self, job, chains, priority, critical_paths):
+        """
+        Adds tasks. Tasks that already exist are not changed, such that a task that is processed again after its lease
+        expired does not add its branches twice.
+        :param job: number of the job
+        :param chains: the chains of the tasks
+        :param priority: priority of the job
+        :param critical_paths: critical paths of the chains
+        """
+        if len(chains) == 0:
+            return
+        self.tasks.bulk_write([UpdateOne({'_id': self._task_id(job, chain)},
+                                         {'$setOnInsert': {'run': self.run, 'generation': self.generation,
+                                                           'job': job, 'chain': chain, 'state': 'ready',
+                                                           'priority': priority,
+                                                           'critical_path': critical_paths[chain], 'attempts': 0,
+                                                           'reported': False}},
+                                         upsert=True) for chain in chains], ordered=False)
+
+    def claim(self, owner, lease_time, max_attempts):
+        """
+        Claims the ready task with the highest priority or a task whose lease expired.
+        :param owner: name of the worker
+        :param lease_time: time in seconds for which the worker owns the task
+        :param max_attempts: number of leases after which a task is not claimed anymore
+        :return: the task as dict; None if no task can be claimed
+        """
+        now = _now()
+        return self.tasks.find_one_and_update(
+            {'run': self.run, 'generation': self.generation,
+             '$or': [{'state': 'ready'},
+                     {'state': 'leased', 'expires': {'$lt': now}, 'attempts': {'$lt': max_attempts}}]},
+            {'$set': {'state': 'leased', 'owner': owner, 'expires': now + datetime.timedelta(seconds=lease_time)},
+             '$inc': {'attempts': 1}},
+            sort=[('priority', ASCENDING), ('critical_path', DESCENDING)], return_document=ReturnDocument.AFTER)
+
+    def renew(self, task_id, owner, lease_time):
+        """
+        Renews the lease of a task.
+        :param task_id: ID of the task
+        :param owner: name of the worker
+        :param lease_time: time in seconds for which the worker owns the task
+        :return: true if the worker still owns the task
+        """
+        result = self.tasks.update_one({'_id': task_id, 'state': 'leased', 'owner': owner},
+                                       {'$set': {'expires': _now() + datetime.timedelta(seconds=lease_time)}})
+        return result.matched_count > 0
+
+    def complete(self, task_id, owner, state, result):
+        """
+        Completes a task with its result.
+        :param task_id: ID of the task
+        :param owner: name of the worker
+        :param state: done or failed
+        :param result: dict with the result of the task
+        :return: true if the worker still owned the task
+        """
+        update = dict(result)
+        update['state'] = state
+        result = self.tasks.update_one({'_id': task_id, 'state': 'leased', 'owner': owner}, {'$set': update})
+        return result.matched_count > 0
+
+    def expire(self, max_attempts):
+        """
+        Fails the tasks whose leases expired too often, e.g., because they crash every worker that processes them.
+        :param max_attempts: number of leases after which a task fails
+        """
+        self.tasks.update_many({'run': self.run, 'generation': self.generation, 'state': 'leased',
+                                'expires': {'$lt': _now()}, 'attempts': {'$gte': max_attempts}},
+                               {'$set': {'state': 'failed', 'error': 'lease expired %i times' % max_attempts}})
+
+    def outstanding(self, job):
+        """
+        :param job: number of the job
+        :return: number of tasks of the job that are ready or leased
+        """
+        return self.tasks.count_documents({'run': self.run, 'generation': self.generation, 'job': job,
+                                           'state': {'$in': ['ready', 'leased']}})
+
+    def results(self):
+        """
+        Fetches the tasks that were completed since the last call.
+        :return: list of the completed tasks as dicts
+        """
+        results = list(self.tasks.find({'run': self.run, 'generation': self.generation,
+                                        'state': {'$in': ['done', 'failed']}, 'reported': False}))
+        if len(results) > 0:
+            self.tasks.update_many({'_id': {'$in': [result['_id'] for result in results]}},
+                                   {'$set': {'reported': True}})
+        return results
+
+    def _remove(self, query):
+        """
+        Removes tasks and files of the run.
+        :param query: query of the tasks; the files are selected by the same fields of their metadata
+        """
+        self.tasks.delete_many(query)
+        for grid_file in list(self.files.find({'metadata.%s' % field: value for field, value in query.items()})):
+            try:
+                self.files.delete(grid_file._id)
+            except NoFile:
+                pass
+
+    def _task_id(self, job, chain):
+        """
+        :param job: number of the job
+        :param chain: the chain
+        :return: the ID of the task of a chain
+        """
+        return '%s:%s:%i:%i' % (self.run, self.generation, job, chain)
+
+    def _filename(self, job, name):
+        """
+        :param job: number of the job
+        :param name: name of the file
+        :return: name of a file of a job in the GridFS
+        """
+        return '%s/%s/job%i/%s' % (self.run, self.generation, job, name)
+
+
+class LeasedTasks(object):
+    """
+    Source of the tasks of a :class:`~memeshark.memeshark.MemeSHARKWorker` in a distributed run, which replaces the
+    task queue and the result queue of a local run. :meth:`get` claims a task from the :class:`TaskBoard` and
+    downloads the files of its job, and :meth:`put` receives the messages that the worker would send to the
+    :class:`~memeshark.scheduler.Scheduler`, i.e., the spawned branches are added as tasks and finished tasks are
+    completed. A background thread renews the lease of the current task. The worker must be connected to the MongoDB
+    before it claims a task. A worker that is started before the run waits until the run is started, and it exits once
+    the run that it joined is finished or started again by another coordinator.
+    :param run: name of the run
+    :param work_dir: working directory of the host (see :func:`~memeshark.scheduler.job_directory`)
+    :param number: number of the worker on the host
+    :param lease_time: time in seconds for which a worker owns a task without renewing the lease
+    :param poll_interval: time in seconds between two attempts to claim a task if none is ready
+    """
+
+    # number of leases after which a task is not claimed anymore
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, run, work_dir, number, lease_time=60.0, poll_interval=1.0):
+        self.run = run
+        self.work_dir = work_dir
+        self.number = number
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+        self.recovered = False
+        self._board = None
+        self._owner = None
+        self._task = None
+        self._finished = []
+        self._jobs = {}
+        self._lock = None
+        self._stop = None
+
+    def get(self):
+        """
+        Claims the next task and waits until a task is ready.
+        :return: tuple of the number of the job and the chain; None if the run that the worker joined is finished
+        """
+        if self._board is None:
+            self._connect()
+        while True:
+            task = self._board.claim(self._owner, self.lease_time, self.MAX_ATTEMPTS)
+            if task is not None:
+                break
+            if self._board.is_finished():
+                return None
+            time.sleep(self.poll_interval)
+
+        if task['job'] not in self._jobs:
+            self._load_job(task['job'])
+        with self._lock:
+            self._task = task
+            self._finished = []
+        self.recovered = task['attempts'] > 1
+        if self.recovered:
+            logging.getLogger("worker%s" % self.number).warning("claimed task %s again after its lease expired",
+                                                                  task['_id'])
+        return task['job'], task['chain']
+
+    def put(self, message):
+        """
+        Handles a message of the worker (see :class:`~memeshark.scheduler.Scheduler`).
+        :param message: the message
+        """
+        if message[0] == 'spawned':
+            _, _, job, spawned, finished = message
+            self._finished.extend(finished)
+            self._board.add_tasks(job, spawned, self._task['priority'], self._jobs[job])
+        elif message[0] == 'done':
+            _, _, _, commits, finished, ces_deleted, ces_total = message
+            self._complete('done', {'commits': commits, 'finished': self._finished + list(finished),
+                                    'ces_deleted': ces_deleted, 'ces_total': ces_total})
+        elif message[0] == 'failed':
+            _, _, _, error, ces_deleted, ces_total = message
+            self._complete('failed', {'error': error, 'ces_deleted': ces_deleted, 'ces_total': ces_total})
+        elif message[0] == 'stats':
+            if self._stop is not None:
+                self._stop.set()
+
+    def renew(self):
+        """
+        Renews the lease of the current task. The worker calls this before it writes, such that a worker that lost its
+        lease does not write concurrently with the worker that claimed the task again.
+        """
+        with self._lock:
+            task = self._task
+        if task is not None and not self._board.renew(task['_id'], self._owner, self.lease_time):
+            raise LeaseError('lease of task %s lost' % task['_id'])
+
+    def _connect(self):
+        """
+        Connects to the task board, waits until the run is started, and starts to renew the leases in the background.
+        """
+        self._board = TaskBoard(get_db(), self.run)
+        if not self._board.join():
+            logging.getLogger("worker%s" % self.number).info("waiting for the start of run %s", self.run)
+            while not self._board.join():
+                time.sleep(self.poll_interval)
+        self._owner = '%s:%i:%i' % (socket.gethostname(), os.getpid(), self.number)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def _load_job(self, job):
+        """
+        Downloads the files of a job and calculates the critical paths of its chains, which are the priorities of the
+        spawned branches.
+        :param job: number of the job
+        """
+        directory = job_directory(self.work_dir, job)
+        self._board.download_job(job, directory)
+        chains = ChainPartition.load(os.path.join(directory, 'chains.bin'))
+        status = CommitStatus.load(os.path.join(directory, 'commit_status.bin'))
+        self._jobs[job] = chains.critical_paths(chains.weights(status.weights()))
+
+    def _complete(self, state, result):
+        """
+        Completes the current task.
+        :param state: done or failed
+        :param result: dict with the result
+        """
+        with self._lock:
+            task = self._task
+            self._task = None
+        if not self._board.complete(task['_id'], self._owner, state, result):
+            logging.getLogger("worker%s" % self.number).warning("task %s was claimed by another worker, its result is "
+                                                                  "dropped", task['_id'])
+
+    def _heartbeat(self):
+        """
+        Renews the lease of the current task until the worker exits.
+        """
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                self.renew()
+            except LeaseError as e:
+                logging.getLogger("worker%s" % self.number).warning(e)
+            except Exception:
+                logging.getLogger("worker%s" % self.number).exception("renewal of the lease failed")
+
+
+class LeaseScheduler(Scheduler):
+    """
+    Scheduler of a distributed run. Instead of dispatching the tasks to local workers, the scheduler publishes the jobs
+    and their initial tasks on the :class:`TaskBoard`, from which the workers of all hosts claim them (see
+    :class:`LeasedTasks`). The scheduler polls the board for completed tasks, records them like the
+    :class:`~memeshark.scheduler.Scheduler`, removes the spill files of the forks whose branches are finished, and
+    finishes a job once none of its tasks is ready or leased anymore. Afterwards, the run is marked as finished, such
+    that the workers exit.
+    :param board: the :class:`TaskBoard` of the run
+    :param work_dir: working directory with the files of the jobs (see :func:`~memeshark.scheduler.job_directory`)
+    :param workers: the local worker processes
+    :param on_finished: function that is called with every finished :class:`~memeshark.scheduler.Job` (optional)
+    :param poll_interval: time in seconds between two polls of the board
+    """
+
+    def __init__(self, board, work_dir, workers, on_finished=None, poll_interval=1.0):
+        Scheduler.__init__(self, workers, None, None, on_finished)
+        self.board = board
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self._terminated = set()
+
+    def add(self, job, tasks):
+        """
+        Publishes a job with its initial tasks.
+        :param job: the :class:`~memeshark.scheduler.Job`
+        :param tasks: the initial chains of the job
+        """
+        if job.status is not None:
+            self.logger.info("project %s: %i code entity states of %i commits to process", job.name, job.no_ces,
+                             job.no_commits)
+        self.jobs[job.number] = job
+        job.start_time = timeit.default_timer()
+        self.board.publish_job(job.number, job_directory(self.work_dir, job.number))
+        self.board.add_tasks(job.number, tasks, job.priority, job.critical_paths)
+
+    def run(self, jobs=None):
+        """
+        Waits until all tasks of the jobs are completed by the workers of all hosts.
+        :param jobs: queue through which further jobs are added as tuples of the :class:`~memeshark.scheduler.Job`
+            and its initial tasks while the scheduler runs; None marks the end of the jobs (optional)
+        """
+        jobs_open = jobs is not None
+        while jobs_open or len(self.jobs) > 0:
+            while jobs_open:
+                try:
+                    added = jobs.get(timeout=self.poll_interval) if len(self.jobs) == 0 else jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if added is None:
+                    jobs_open = False
+                else:
+                    self.add(*added)
+
+            self.board.expire(LeasedTasks.MAX_ATTEMPTS)
+            # the results are fetched after the jobs without outstanding tasks, such that no result of them is missed
+            idle = [job for job in self.jobs.values() if self.board.outstanding(job.number) == 0]
+            for result in self.board.results():
+                self._result(result)
+            for job in idle:
+                self._job_finished(job)
+            self._check_workers()
+            if len(self.jobs) > 0:
+                time.sleep(self.poll_interval)
+
+        self.logger.info("all tasks finished, shutting down workers")
+        self.board.finish()
+        for worker in self.workers:
+            worker.join()
+
+    def _result(self, result):
+        """
+        Records a completed task.
+        :param result: the task as dict
+        """
+        job = self.jobs[result['job']]
+        head = job.commit_graph.node_id(job.chains.head(result['chain']))
+        # the workers add the branches of a fork as tasks, i.e., its consumers are registered with its first result
+        parent = job.chains.parent(result['chain'])
+        if parent >= 0 and parent not in job.consumers:
+            children = job.chains.children(parent)
+            if len(children) > 1 and result['chain'] != children[0]:
+                job.consumers[parent] = len(children) - 1
+        self._release_fork(job, result['chain'])
+        job.ces_deleted += result.get('ces_deleted', 0)
+        job.ces_total += result.get('ces_total', 0)
+        self.ces_deleted += result.get('ces_deleted', 0)
+        self.ces_total += result.get('ces_total', 0)
+        if result['state'] == 'failed':
+            self.failed_tasks += 1
+            job.failed_tasks += 1
+            self.logger.error("%s failed to process task for commit id %s of project %s: %s", result.get('owner'),
+                              head, job.name, result.get('error'))
+            return
+        self._record(job, [tuple(finished) for finished in result['finished']])
+        self.processed_commits += result['commits']
+        job.processed_commits += result['commits']
+        if job.status is not None:
+            self.logger.info("%s finished task for commit id %s of project %s (%i / %i commits, %i / %i code entity "
+                             "states processed)", result['owner'], head, job.name, job.processed_commits,
+                             job.no_commits, job.processed_ces, job.no_ces)
+        else:
+            self.logger.info("%s finished task for commit id %s of project %s (%i / %i commits processed)",
+                             result['owner'], head, job.name, job.processed_commits, job.no_commits)
+
+    def _check_workers(self):
+        """
+        Checks if a local worker terminated. Its tasks are claimed again by other workers once their leases expired.
+        """
+        for worker in self.workers:
+            if worker.number not in self._terminated and worker.exitcode is not None:
+                self._terminated.add(worker.number)
+                self.logger.warning("worker %s terminated unexpectedly with exit code %s, its task is claimed again "
+                                    "once the lease expired", worker.name, worker.exitcode)
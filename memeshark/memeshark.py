@@ -1,18 +1,46 @@
+import cProfile
+import json
 import logging
 import multiprocessing
+import os
+import queue
+import random
+import shutil
 import sys
-import time
+import tempfile
+import threading
 import timeit
+from array import array
 from math import isnan
 from multiprocessing import Queue
 
-import networkx as nx
-from mongoengine import connect, DoesNotExist, connection
+from mongoengine import connect
+from mongoengine.connection import get_db
 from mongoengine.base.datastructures import BaseDict
-from pycoshark.mongomodels import Project, VCSSystem, Commit, CodeEntityState
+from pycoshark.mongomodels import CodeEntityState
 from pycoshark.utils import create_mongodb_uri_string
+from pymongo.errors import OperationFailure
 
+from memeshark.cache import StateCache
 from memeshark.config import setup_logging
+from memeshark.counters import CounterReporter, Counters
+from memeshark.graph import build_commit_graph, ChainPartition, CommitStatus, CompactCommitGraph
+from memeshark.journal import Journal, state_digest
+from memeshark.lease import LeasedTasks, LeaseScheduler, TaskBoard
+from memeshark.merge import propagate_changes
+from memeshark.metrics import fingerprints, unchanged_mask
+from memeshark.prefetch import Prefetcher
+from memeshark.profiling import phases_path, PhaseTimer, profile_path, report_profiles
+from memeshark.scheduler import estimate_makespan, Job, job_directory, Scheduler, WorkerError
+from memeshark.state import CESState, KeyTable
+from memeshark.storage import MongoStorage
+
+
+class ProjectError(Exception):
+    """
+    Exception that is thrown if a project cannot be processed
+    """
+    pass
 
 
 class MemeSHARK(object):
@@ -25,12 +53,17 @@ class MemeSHARK(object):
     ces_total = 0
     ces_deleted_total = 0
 
-    def __init__(self):
+    GRAPH_BATCH_SIZE = 10000
+    MISSING_PARENTS_REPORTED = 10
+
+    def __init__(self, storage=None):
         """
         Default constructor.
+        :param storage: the :class:`~memeshark.storage.ProjectStorage` from which the jobs are prepared; by default,
+            the :class:`~memeshark.storage.MongoStorage` of the configuration
         """
         self.logger = logging.getLogger("main")
-        pass
+        self.storage = storage
 
     def start(self, cfg):
         """
@@ -43,119 +76,549 @@ class MemeSHARK(object):
         # Connect to mongodb
         uri = create_mongodb_uri_string(cfg.user, cfg.password, cfg.host, cfg.port, cfg.authentication_db,
                                         cfg.ssl_enabled)
-        db_client = connect(cfg.database, host=uri, alias='default')
-
-        # Get the id of the project for which the code entities shall be merged
-        try:
-            project_id = Project.objects(name=cfg.project_name).get().id
-        except DoesNotExist:
-            self.logger.error('Project %s not found!' % cfg.project_name)
+        if cfg.dry_run and (cfg.distributed is not None or cfg.join is not None):
+            self.logger.error("a dry run cannot be distributed")
             sys.exit(1)
+        if cfg.join is not None:
+            self._join(cfg, uri)
+            return
+        if self.storage is None:
+            self.storage = MongoStorage(cfg.database, uri, cfg.write_concern)
+        self.storage.connect()
 
-        # Get the VCS systems for the project
-        vcs_systems = VCSSystem.objects(project_id=project_id).get().id
-        self.logger.info("vcs_system_id: %s", vcs_systems)
+        # in the batch mode, the projects are processed by one pool of workers in the order of their estimated size
+        batch = cfg.project_name is None
+        if batch:
+            projects = self._select_projects(cfg)
+        else:
+            projects = [cfg.project_name]
+        ces_size = None
+        if cfg.dry_run:
+            self.logger.info("dry run, nothing is written to the database")
+            ces_size = self._average_ces_size()
 
-        # Get the commits for the project
-        no_commits = Commit.objects(vcs_system_id=vcs_systems).count()
+        # the first project is prepared before the workers are started, the others while the workers run
+        work_dir = tempfile.mkdtemp(prefix='memeshark')
+        remaining = list(enumerate(projects))
+        first = None
+        while first is None and len(remaining) > 0:
+            number, name = remaining.pop(0)
+            try:
+                first = self._prepare(cfg, work_dir, number, name)
+            except ProjectError as e:
+                self.logger.error(e)
+                if not batch:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    sys.exit(1)
+        if first is None:
+            self.logger.info("no commits to process")
+            self.storage.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return
 
-        # Create commit graph
-        commit_graph = self._generate_graph(vcs_systems)
+        generation = None
+        if cfg.distributed is not None:
+            # the run is started before the workers, which would otherwise find the finished state of a previous run
+            # with the same name and exit
+            board = TaskBoard(get_db(), cfg.distributed)
+            board.reset()
+            generation = board.generation
 
         # close connection to MongoDB - otherwise it will not work in the subprocesses
-        db_client.close()
-        connection._dbs = {}
-        connection._connections = {}
-        connection._connection_settings = {}
+        self.storage.close()
 
         # setup workers
         max_workers = cfg.processes
-        task_queue = multiprocessing.JoinableQueue()
-        started_tasks = multiprocessing.Queue()
-        deleted_ces_queue = multiprocessing.Queue()
-        total_ces_queue = multiprocessing.Queue()
-        workers = [MemeSHARKWorker(commit_graph, cfg.database, uri, i, task_queue, started_tasks, deleted_ces_queue,
-                                   total_ces_queue, no_commits) for i in range(0, max_workers)]
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        counters = Counters(max_workers)
+        if cfg.profile is not None:
+            os.makedirs(cfg.profile, exist_ok=True)
+        # a dry run on a sample of the chains starts each sampled chain from the state of its predecessor
+        follow_branches = not cfg.dry_run or cfg.dry_run_sample >= 1
+        workers = self._create_workers(cfg, uri, work_dir, task_queue, result_queue, counters, follow_branches,
+                                       cfg.distributed)
 
         self.logger.info("starting workers")
         for worker in workers:
             worker.start()
-        time.sleep(5)  # brief wait for all processes to be ready
+        reporter = CounterReporter(counters, cfg.metrics_interval, cfg.metrics_file)
+        reporter.start()
 
-        # find nodes without predecessor or with multiple predecessors
-        for i, node in enumerate(commit_graph):
-            if len(commit_graph.pred[node]) != 1:
-                self.logger.info("adding task for start of path with commit id: %s", node)
-                task_queue.put(node)
+        finished_jobs = []
 
-        # wait task queue to be empty
-        task_queue.join()
+        def finish(job):
+            self._finish_job(cfg, work_dir, job, ces_size, not follow_branches)
+            finished_jobs.append(job)
 
-        self.logger.info("all tasks finished, terminating workers")
-        for worker in workers:
-            worker.terminate()
+        if cfg.distributed is not None:
+            # the tasks are published in the database, from which the workers of all hosts claim them
+            connect(cfg.database, host=uri, alias='lease')
+            board = TaskBoard(get_db('lease'), cfg.distributed, generation)
+            scheduler = LeaseScheduler(board, work_dir, workers, finish)
+            self.logger.info("distributed run %s started, further hosts join it with --join %s", cfg.distributed,
+                             cfg.distributed)
+        else:
+            scheduler = Scheduler(workers, task_queue, result_queue, finish)
+        jobs = None
+        if len(remaining) > 0:
+            jobs = queue.Queue()
+            threading.Thread(target=self._prepare_jobs, args=(cfg, work_dir, remaining, jobs),
+                             daemon=True).start()
+        try:
+            scheduler.add(*first)
+            scheduler.run(jobs)
+        except WorkerError as e:
+            self.logger.error(e)
+            for worker in workers:
+                worker.terminate()
+            sys.exit(1)
+        finally:
+            reporter.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+            for job in scheduler.jobs.values():
+                if job.journal is not None:
+                    job.journal.close()
+        if cfg.profile is not None:
+            report_profiles(cfg.profile, max_workers)
 
-        # collect statistics
-        ces_deleted_total = 0
-        while not deleted_ces_queue.empty():
-            ces_deleted_total += deleted_ces_queue.get()
-        ces_total = 0
-        while not total_ces_queue.empty():
-            ces_total += total_ces_queue.get()
+        ces_deleted_total = scheduler.ces_deleted
+        ces_total = scheduler.ces_total
+        if batch:
+            for job in sorted(finished_jobs, key=lambda finished_job: finished_job.number):
+                self.logger.info("project %s: %i commits, deleted %i of %i code entity states in %0.1f s, %i tasks "
+                                 "failed", job.name, job.processed_commits, job.ces_deleted, job.ces_total,
+                                 job.run_time, job.failed_tasks)
+        if not cfg.dry_run:
+            self.logger.info("deleted %i of %i code entity states", ces_deleted_total, ces_total)
+        elapsed = timeit.default_timer() - start_time
+        self.logger.info("Execution time: %0.5f s" % elapsed)
+        if scheduler.failed_tasks > 0:
+            self.logger.error("%i tasks failed", scheduler.failed_tasks)
+            sys.exit(1)
 
-        self.logger.info("deleted %i of %i code entity states", ces_deleted_total, ces_total)
+    def _join(self, cfg, uri):
+        """
+        Joins a distributed run with the workers of this host. The workers claim the tasks of the run until the
+        coordinator marks it as finished.
+        :param cfg: configuration object that is used
+        :param uri: URI of the MongoDB
+        """
+        start_time = timeit.default_timer()
+        self.logger.info("joining distributed run %s with %i workers", cfg.join, cfg.processes)
+        work_dir = tempfile.mkdtemp(prefix='memeshark')
+        counters = Counters(cfg.processes)
+        if cfg.profile is not None:
+            os.makedirs(cfg.profile, exist_ok=True)
+        workers = self._create_workers(cfg, uri, work_dir, None, None, counters, True, cfg.join)
+        for worker in workers:
+            worker.start()
+        reporter = CounterReporter(counters, cfg.metrics_interval, cfg.metrics_file)
+        reporter.start()
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            reporter.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if cfg.profile is not None:
+            report_profiles(cfg.profile, cfg.processes)
         elapsed = timeit.default_timer() - start_time
         self.logger.info("Execution time: %0.5f s" % elapsed)
 
+    def _create_workers(self, cfg, uri, work_dir, task_queue, result_queue, counters, follow_branches, run=None):
+        """
+        Creates the worker processes.
+        :param cfg: configuration object that is used
+        :param uri: URI of the MongoDB
+        :param work_dir: working directory that is shared with the workers
+        :param task_queue: queue from which the workers take their tasks
+        :param result_queue: queue through which the workers report to the scheduler
+        :param counters: the shared :class:`~memeshark.counters.Counters` of the workers
+        :param follow_branches: if false, the workers only merge the chains of their tasks
+        :param run: name of a distributed run from which the workers claim their tasks instead of the task queue
+            (optional)
+        :return: list of the workers
+        """
+        return [MemeSHARKWorker(work_dir, MongoStorage(cfg.database, uri, cfg.write_concern), i, task_queue,
+                                result_queue, cfg.verify_fingerprints, cfg.read_batch_size, cfg.write_batch_size,
+                                cfg.write_flush_interval, cfg.cache_memory, cfg.prefetch_depth, cfg.prefetch_documents,
+                                cfg.dry_run, follow_branches, counters, cfg.profile,
+                                LeasedTasks(run, work_dir, i, cfg.lease_time) if run is not None else None)
+                for i in range(0, cfg.processes)]
+
+    def _select_projects(self, cfg):
+        """
+        Selects the projects of the batch mode and orders them by the estimated size, i.e., the number of commits
+        that are not yet processed. If all projects are selected, only projects with commits that are not yet processed
+        are selected.
+        :param cfg: configuration object that is used
+        :return: list of the names of the projects
+        """
+        names = cfg.projects if cfg.projects else self.storage.project_names()
+        sizes = {}
+        for name in names:
+            vcs_system_ids = self.storage.vcs_system_ids(name)
+            if vcs_system_ids is None or len(vcs_system_ids) == 0:
+                self.logger.error('Project %s or its VCS system not found!' % name)
+                continue
+            if len(vcs_system_ids) > 1:
+                self.logger.error('Project %s has several VCS systems, it is skipped' % name)
+                continue
+            sizes[name] = self.storage.unprocessed_commits(vcs_system_ids[0])
+            self.logger.info("project %s: %i commits not yet processed", name, sizes[name])
+        if not cfg.projects:
+            names = [name for name in names if sizes.get(name, 0) > 0]
+        names = [name for name in names if name in sizes]
+        if cfg.project_order != 'given':
+            names.sort(key=lambda name: sizes[name], reverse=cfg.project_order == 'largest')
+        self.logger.info("%i projects to process: %s", len(names), ", ".join(names))
+        return names
+
+    def _prepare_jobs(self, cfg, work_dir, projects, jobs):
+        """
+        Prepares the jobs of projects with an own connection to the MongoDB while the workers run. The jobs are handed
+        to the scheduler in the order of the projects, followed by None.
+        :param cfg: configuration object that is used
+        :param work_dir: working directory that is shared with the workers
+        :param projects: list of tuples of the numbers of the jobs and the names of the projects
+        :param jobs: queue to which the jobs and their initial tasks are put
+        """
+        self.storage.connect()
+        try:
+            for number, name in projects:
+                try:
+                    prepared = self._prepare(cfg, work_dir, number, name)
+                except ProjectError as e:
+                    self.logger.error(e)
+                    continue
+                except Exception:
+                    self.logger.exception("preparation of project %s failed", name)
+                    continue
+                if prepared is not None:
+                    jobs.put(prepared)
+        finally:
+            self.storage.close()
+            jobs.put(None)
+
+    def _prepare(self, cfg, work_dir, number, project_name):
+        """
+        Prepares the job of a project, i.e., builds its commit graph and decomposes it into chains, and stores the
+        files that the workers load in the directory of the job (see :func:`~memeshark.scheduler.job_directory`).
+        :param cfg: configuration object that is used
+        :param work_dir: working directory that is shared with the workers
+        :param number: number of the job, which is also its priority
+        :param project_name: name of the project
+        :return: tuple of the :class:`~memeshark.scheduler.Job` and its initial tasks; None if no commits are to be
+            processed
+        """
+        # Get the VCS systems of the project for which the code entities shall be merged
+        vcs_system_ids = self.storage.vcs_system_ids(project_name)
+        if vcs_system_ids is None:
+            raise ProjectError('Project %s not found!' % project_name)
+        if len(vcs_system_ids) == 0:
+            raise ProjectError('VCS system of project %s not found!' % project_name)
+        if len(vcs_system_ids) > 1:
+            raise ProjectError('Project %s has several VCS systems!' % project_name)
+        vcs_systems = vcs_system_ids[0]
+        self.logger.info("project %s: vcs_system_id: %s", project_name, vcs_systems)
+
+        # Create commit graph
+        commit_graph, db_processed = self._generate_graph(vcs_systems)
+        no_commits = commit_graph.number_of_nodes()
+        self.logger.info("commit graph with %i commits and %i edges created, %i commits already processed",
+                         no_commits, commit_graph.number_of_edges(), sum(db_processed))
+
+        # store the graph in a file that the workers memory-map, such that they share it read-only
+        directory = job_directory(work_dir, number)
+        os.mkdir(directory)
+        commit_graph.save(os.path.join(directory, 'commit_graph.bin'))
+
+        # in incremental runs, only the commits that are not yet processed are merged
+        processed = None
+        if cfg.incremental:
+            processed = bytearray(db_processed)
+
+        # chains that are recorded as finished in the journal are skipped without querying their commits
+        journal = None
+        if cfg.journal is not None and cfg.dry_run:
+            self.logger.warning("the journal is not used in a dry run")
+        elif cfg.journal is not None:
+            # in the batch mode, every project has its own journal
+            journal_path = cfg.journal if cfg.project_name is not None else '%s.%s' % (cfg.journal, project_name)
+            journal = Journal(journal_path)
+            journaled, digests = journal.load(commit_graph)
+            self.logger.info("journal %s: %i commits already processed", journal_path, sum(journaled))
+            if not self._verify_journal(commit_graph, journaled, digests):
+                shutil.rmtree(directory, ignore_errors=True)
+                raise ProjectError("the journal %s does not match the database, remove it to resume without the "
+                                   "journal" % journal_path)
+            if processed is None:
+                processed = journaled
+            else:
+                processed = bytearray(a | b for a, b in zip(processed, journaled))
+
+        if processed is not None:
+            no_commits -= sum(processed)
+            self.logger.info("%i commits to process", no_commits)
+
+        # decompose the graph into linear chains that are the tasks of the workers
+        chains = ChainPartition.from_graph(commit_graph, processed)
+        tasks = [chain for chain in chains if chains.parent(chain) < 0]
+        self.logger.info("commit graph decomposed into %i chains (%i paths, %i branches)", len(chains), len(tasks),
+                         len(chains) - len(tasks))
+        if processed is not None:
+            frontier = sum(1 for task in tasks if commit_graph.in_degree(chains.head(task)) == 1)
+            self.logger.info("%i chains continue from the state of an already processed commit", frontier)
+        if len(chains) == 0:
+            self.logger.info("project %s: no commits to process", project_name)
+            shutil.rmtree(directory, ignore_errors=True)
+            if journal is not None:
+                journal.remove()
+            return None
+
+        # the status of the commits is shared with the workers, such that they do not query it per commit
+        status = CommitStatus(db_processed, self._count_ces(commit_graph, db_processed if processed is None else
+                                                            bytearray(a | b for a, b in zip(db_processed, processed))))
+        status.save(os.path.join(directory, 'commit_status.bin'))
+
+        # prioritize the chains by their critical path, i.e., the longest remaining work
+        chain_weights = chains.weights(status.weights())
+        critical_paths = chains.critical_paths(chain_weights)
+        chains.sort_children(critical_paths)
+        chains.save(os.path.join(directory, 'chains.bin'))
+        # the workers only calculate the digests of the states of the finished chains if they are journaled
+        with open(os.path.join(directory, 'job.json'), 'w') as f:
+            json.dump({'journal': journal is not None}, f)
+        self._log_makespan(chains, chain_weights, critical_paths, cfg.processes)
+
+        # a dry run may only merge a sample of the chains, each starting from the state of its predecessor
+        if cfg.dry_run and cfg.dry_run_sample < 1:
+            tasks = sorted(random.Random(0).sample(range(0, len(chains)),
+                                                   max(1, int(round(cfg.dry_run_sample * len(chains))))))
+            self.logger.info("sampled %i of %i chains", len(tasks), len(chains))
+
+        # directory in which the workers share the states of fork commits
+        cache_directory = os.path.join(directory, 'states')
+        os.mkdir(cache_directory)
+        job = Job(number, project_name, commit_graph, chains, critical_paths, no_commits, cache_directory, journal,
+                  status, number)
+        return job, tasks
+
+    def _finish_job(self, cfg, work_dir, job, ces_size, sampled):
+        """
+        Completes a finished job, i.e., removes its files and its journal and reports its statistics.
+        :param cfg: configuration object that is used
+        :param work_dir: working directory that is shared with the workers
+        :param job: the :class:`~memeshark.scheduler.Job`
+        :param ces_size: the average size of the code entity states in bytes for a dry run (optional)
+        :param sampled: true if only a sample of the chains was merged in a dry run
+        """
+        shutil.rmtree(job_directory(work_dir, job.number), ignore_errors=True)
+        if job.journal is not None:
+            job.journal.close()
+            if job.failed_tasks == 0:
+                job.journal.remove()
+        if cfg.dry_run:
+            self._report_dry_run(job, ces_size, sampled)
+        else:
+            self.logger.info("project %s finished: deleted %i of %i code entity states in %0.1f s", job.name,
+                             job.ces_deleted, job.ces_total, job.run_time)
+
     def _generate_graph(self, vcs_id):
         """
-        Generates the commit graph for a VCS system.
+        Generates the commit graph for a VCS system. The commits are streamed from the storage, which also determines
+        which commits were already processed, i.e., have code entity states.
         :param vcs_id: ID of the VCS system
-        :return: the commit graph
+        :return: tuple of the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`) and a bytearray with one
+            byte per node that is 1 if the commit was already processed
         """
-        g = nx.DiGraph()
-        # first we add all nodes to the graph
-        for c in Commit.objects.only('id').timeout(False).filter(vcs_system_id=vcs_id):
-            g.add_node(c.id)
+        processed_nodes = []
 
-        # after that we draw all edges
-        for c in Commit.objects.only('id', 'parents').timeout(False).filter(vcs_system_id=vcs_id):
-            for p in c.parents:
-                try:
-                    p1 = Commit.objects.only('id').timeout(False).get(vcs_system_id=vcs_id, revision_hash=p)
-                    g.add_edge(p1.id, c.id)
-                except DoesNotExist:
-                    self.logger.warning("parent of a commit is missing (commit id: %s - revision_hash: %s)", c.id, p)
-                    pass
-        return g
+        def commits(stream):
+            # the nodes are numbered in the order in which the commits are streamed
+            for node, commit in enumerate(stream):
+                if commit['processed']:
+                    processed_nodes.append(node)
+                yield commit
+
+        g, missing = build_commit_graph(commits(self.storage.graph_commits(vcs_id, self.GRAPH_BATCH_SIZE)))
+
+        if len(missing) > 0:
+            self.logger.warning("%i parents of commits are missing, e.g., %s", len(missing),
+                                ", ".join("commit id: %s - revision_hash: %s" % (commit_id, revision_hash)
+                                          for commit_id, revision_hash in missing[:self.MISSING_PARENTS_REPORTED]))
+        processed = bytearray(len(g))
+        for node in processed_nodes:
+            processed[node] = 1
+        return g, processed
+
+    def _verify_journal(self, commit_graph, journaled, digests):
+        """
+        Verifies that the states of the finished chains in the journal from which unfinished chains continue match the
+        states in the database.
+        :param commit_graph: the commit graph
+        :param journaled: one byte per node that is 1 if the node is in a finished chain of the journal
+        :param digests: mapping from the last nodes of the finished chains to the digests of their states
+        :return: true if all states match, false otherwise
+        """
+        reader = self.storage.reader()
+        for node, digest in digests.items():
+            if digest is None or all(journaled[successor] for successor in commit_graph.succ(node)):
+                continue
+            if state_digest(reader.code_entity_state_ids(commit_graph.node_id(node))) != digest:
+                self.logger.error("state of commit %s differs from the journal", commit_graph.node_id(node))
+                return False
+        return True
+
+    def _count_ces(self, commit_graph, processed):
+        """
+        Counts the code entity states of each commit that is not yet processed, which are used as weights for the
+        scheduling and for the progress.
+        :param commit_graph: the commit graph
+        :param processed: one byte per node that is not zero if the node is already processed and not counted
+        :return: array with the number of code entity states for each node; empty if the counts are not available
+        """
+        counts = array('q', bytes(8 * len(commit_graph)))
+        nodes = [node for node in commit_graph if processed[node] == 0]
+        try:
+            for start in range(0, len(nodes), self.GRAPH_BATCH_SIZE):
+                commit_ids = [commit_graph.node_id(node) for node in nodes[start:start + self.GRAPH_BATCH_SIZE]]
+                for commit_id, count in self.storage.count_ces(commit_ids).items():
+                    counts[commit_graph.index(commit_id)] += count
+        except OperationFailure as e:
+            self.logger.warning("could not count code entity states, using the number of commits as weights: %s", e)
+            return array('q')
+        return counts
+
+    def _average_ces_size(self):
+        """
+        :return: the average size of the code entity states in bytes; None if the size is not available
+        """
+        try:
+            return self.storage.average_ces_size()
+        except OperationFailure as e:
+            self.logger.warning("could not determine the size of the code entity states: %s", e)
+            return None
+
+    def _report_dry_run(self, job, ces_size, sampled):
+        """
+        Reports the code entity states that a run would delete, the storage that would be freed, and the throughput of
+        a project. If only a sample of the chains was merged, the numbers are extrapolated by the numbers of code entity
+        states.
+        :param job: the finished :class:`~memeshark.scheduler.Job` of the dry run
+        :param ces_size: the average size of the code entity states in bytes (optional)
+        :param sampled: true if only a sample of the chains was merged
+        """
+        ces_deleted = job.ces_deleted
+        ces_total = job.ces_total
+        commits = job.processed_commits
+        self.logger.info("project %s: dry run merged %i commits with %i code entity states, %i would be deleted "
+                         "(%0.1f%%)", job.name, commits, ces_total, ces_deleted,
+                         100.0 * ces_deleted / ces_total if ces_total > 0 else 0)
+        if sampled and job.status is not None and ces_total > 0:
+            ces_deleted = int(round(ces_deleted * job.no_ces / ces_total))
+            ces_total = job.no_ces
+            commits = job.no_commits
+            self.logger.info("projected for all chains: %i of %i code entity states would be deleted", ces_deleted,
+                             ces_total)
+        if ces_size is not None:
+            self.logger.info("projected storage freed: %0.1f MB (average size of code entity states: %i bytes)",
+                             ces_deleted * ces_size / (1024 * 1024), ces_size)
+        if job.run_time > 0:
+            self.logger.info("throughput without writes: %0.1f commits/s, %0.1f code entity states/s, projected "
+                             "runtime: %0.0f s", job.processed_commits / job.run_time, job.ces_total / job.run_time,
+                             job.run_time * commits / job.processed_commits if job.processed_commits > 0 else 0)
+
+    def _log_makespan(self, chains, chain_weights, critical_paths, processes):
+        """
+        Logs the critical path of the commit graph and the estimated makespans for different numbers of processes.
+        :param chains: the chains of the commit graph
+        :param chain_weights: weights of the chains
+        :param critical_paths: critical paths of the chains
+        :param processes: number of processes that are used
+        """
+        total_work = sum(chain_weights)
+        critical_path = max(critical_paths) if len(chains) > 0 else 0
+        self.logger.info("total work: %0.0f, critical path: %0.0f, maximal speedup: %0.2f", total_work, critical_path,
+                         total_work / critical_path if critical_path > 0 else 1)
+        candidates = sorted(set([processes] + [2 ** i for i in range(0, 7)]))
+        for candidate in candidates:
+            makespan = estimate_makespan(chains, chain_weights, critical_paths, candidate)
+            self.logger.info("estimated makespan with %i processes: %0.0f (speedup %0.2f)%s", candidate, makespan,
+                             total_work / makespan if makespan > 0 else 1,
+                             " <- selected" if candidate == processes else "")
 
 
 class MemeSHARKWorker(multiprocessing.Process):
     """
     Setup of workers
-    :param commit_graph: the commit graph
-    :param database: name of the MongoDB
-    :param uri: URI of the MongoDB
+    :param work_dir: working directory with one directory per job (see :func:`~memeshark.scheduler.job_directory`)
+        that contains the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`), its chains (see
+        :class:`~memeshark.graph.ChainPartition`), the status of the commits (see
+        :class:`~memeshark.graph.CommitStatus`), and the spill files of the :class:`~memeshark.cache.StateCache`
+    :param storage: the :class:`~memeshark.storage.Storage` of the commits and code entity states, e.g., a
+        :class:`~memeshark.storage.MongoStorage`
     :param number: number of the worker
-    :param task_queue: queue with tasks (i.e. starts of paths/branches)
-    :param started_tasks: queue that counts the processed commits
-    :param deleted_ces_queue: queue that counts the deleted CES for the project
-    :param total_ces_queue: queue that counts the total CES for the project
-    :param no_commits: number of commits of the project
+    :param task_queue: queue with tasks (i.e. tuples of jobs and chains that start paths/branches); None tells the
+        worker to exit
+    :param result_queue: queue through which finished tasks and the statistics are reported to the
+        :class:`~memeshark.scheduler.Scheduler`
+    :param verify_fingerprints: if true, the fingerprint verdicts are verified by comparing the code entity states
+    :param read_batch_size: number of code entity states that are fetched per round-trip
+    :param write_batch_size: number of write operations after which the buffered writes are sent
+    :param write_flush_interval: time in seconds after which the buffered writes are sent
+    :param cache_memory: memory budget of the :class:`~memeshark.cache.StateCache` in bytes
+    :param prefetch_depth: number of commits that are read ahead (see :class:`~memeshark.prefetch.Prefetcher`); 0
+        disables the read-ahead
+    :param prefetch_documents: maximal number of code entity states that are read ahead
+    :param dry_run: if true, the code entity states are merged without writing to the database
+    :param follow_branches: if false, only the chain of a task is merged and its branches are not spawned
+    :param counters: the shared :class:`~memeshark.counters.Counters` of the workers (optional)
+    :param profile_directory: directory to which the worker writes its cProfile dump and the times of its phases (see
+        :mod:`memeshark.profiling`); None disables the profiling
+    :param leases: the :class:`~memeshark.lease.LeasedTasks` from which the worker claims its tasks in a distributed
+        run instead of the task queue and to which it reports instead of the result queue; None for local runs
     """
 
-    def __init__(self, commit_graph, database, uri, number, task_queue, started_tasks, deleted_ces_queue,
-                 total_ces_queue, no_commits):
+    def __init__(self, work_dir, storage, number, task_queue, result_queue, verify_fingerprints=False,
+                 read_batch_size=5000, write_batch_size=1000, write_flush_interval=5.0, cache_memory=256 * 1024 * 1024,
+                 prefetch_depth=2, prefetch_documents=100000, dry_run=False, follow_branches=True, counters=None,
+                 profile_directory=None, leases=None):
         multiprocessing.Process.__init__(self)
-        self.commit_graph = commit_graph
-        self.database = database
-        self.uri = uri
+        self.work_dir = work_dir
+        self.job = None
+        self.commit_graph = None
+        self.chains = None
+        self.status = None
+        self.journal = False
+        self.storage = storage
+        self.number = number
         self.alias = "worker%s" % number
-        self.task_queue = task_queue
-        self.no_commits = no_commits
-        self.started_tasks = started_tasks
-        self.deleted_ces_queue = deleted_ces_queue
-        self.total_ces_queue = total_ces_queue
+        self.leases = leases
+        self.task_queue = task_queue if leases is None else leases
+        self.result_queue = result_queue if leases is None else leases
+        self.verify_fingerprints = verify_fingerprints
+        self.read_batch_size = read_batch_size
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        self.cache_memory = cache_memory
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_documents = prefetch_documents
+        self.dry_run = dry_run
+        self.follow_branches = follow_branches
+        self.counters = counters
+        self.worker_counters = None
+        self.profile_directory = profile_directory
+        self.phases = None
+        self.reader = None
+        self.writer = None
+        self.keys = None
+        self.cache = None
+        self.processed_commits = 0
+        self.finished_chains = []
+        self.ces_deleted = 0
+        self.ces_total = 0
 
     def run(self):
         """
@@ -163,176 +626,337 @@ class MemeSHARKWorker(multiprocessing.Process):
         """
         setup_logging()
         self.logger = logging.getLogger(self.alias)
-        connect(self.database, host=self.uri, alias='default')
+        self.phases = PhaseTimer(self.profile_directory is not None)
+        if self.profile_directory is None:
+            self._run()
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            self._run()
+        finally:
+            profile.disable()
+            profile.dump_stats(profile_path(self.profile_directory, self.number))
+            self.phases.save(phases_path(self.profile_directory, self.number))
+
+    def _run(self):
+        """
+        Processes tasks until the worker is told to exit.
+        """
+        self.storage.connect()
+        if self.counters is not None:
+            self.worker_counters = self.counters.worker(self.number)
+        self.reader = self.storage.reader(self.read_batch_size, self.worker_counters)
+        self.writer = self._write_buffer()
         self.logger.info("ready")
-        isIdle = False
 
         while True:
-            if self.task_queue.empty():
-                if not isIdle:
-                    self.logger.info("queue empty - worker idle")
-                    isIdle = True
-                time.sleep(5)
+            task = self.task_queue.get()
+            if task is None:
+                break
+
+            job, chain = task
+            if job != self.job:
+                self._load_job(job)
+            self.processed_commits = 0
+            self.finished_chains = []
+            ces_deleted = self.ces_deleted
+            ces_total = self.ces_total
+            try:
+                self._process_task(chain)
+                with self.phases.phase('write'):
+                    self.writer.flush()
+            except Exception as e:
+                self.logger.exception("processing of task for node %s failed",
+                                      self.commit_graph.node_id(self.chains.head(chain)))
+                self.writer = self._write_buffer()
+                self.result_queue.put(('failed', self.number, task, repr(e), self.ces_deleted - ces_deleted,
+                                       self.ces_total - ces_total))
                 continue
+            self.result_queue.put(('done', self.number, task, self.processed_commits, self.finished_chains,
+                                   self.ces_deleted - ces_deleted, self.ces_total - ces_total))
+
+        self.logger.info("no tasks left, exiting")
+        self.result_queue.put(('stats', self.number, self.ces_deleted, self.ces_total))
+
+    def _write_buffer(self):
+        """
+        :return: a new write buffer of the storage (see :meth:`~memeshark.storage.Storage.writer`); in a distributed
+            run, the lease of the task is renewed before every bulk write
+        """
+        return self.storage.writer(self.write_batch_size, self.write_flush_interval, self.worker_counters,
+                                   self.leases.renew if self.leases is not None else None, self.phases)
+
+    def _load_job(self, job):
+        """
+        Loads the commit graph, the chains, the status of the commits, and the options of a job. The states of the
+        previous job that the worker cached are dropped, the workers of its remaining branches read them from the spill
+        files.
+        :param job: number of the job
+        """
+        directory = job_directory(self.work_dir, job)
+        self.job = job
+        self.commit_graph = CompactCommitGraph.load(os.path.join(directory, 'commit_graph.bin'))
+        self.chains = ChainPartition.load(os.path.join(directory, 'chains.bin'))
+        self.status = CommitStatus.load(os.path.join(directory, 'commit_status.bin'))
+        with open(os.path.join(directory, 'job.json'), 'r') as f:
+            self.journal = json.load(f)['journal']
+        self.keys = KeyTable()
+        self.cache = StateCache(os.path.join(directory, 'states'), self.cache_memory, self.keys)
+
+    def _process_task(self, chain):
+        """
+        Processes a task, i.e., a chain and the chains of its branches. The worker continues with the first branch while
+        it holds the state of the fork commit in memory. The other branches are handed back to the scheduler, such that
+        idle workers can steal them. The chains whose writes are flushed are reported together with the digests of their
+        last states for the :class:`~memeshark.journal.Journal`; the digests are None if the job is not journaled.
+        :param chain: index of the chain (see :class:`~memeshark.graph.ChainPartition`)
+        """
+        ces_past_state = None
+        while True:
+            if self.leases is not None and self.leases.recovered:
+                self._refresh_status(chain)
+            ces_current_state = self._merge_chain(chain, ces_past_state)
+            # the state is empty if the chain was already processed and its successors, too
+            digest = None
+            if self.journal and len(ces_current_state) > 0:
+                digest = state_digest([ces_state.id for ces_state in ces_current_state.values()])
+            self.finished_chains.append((chain, digest))
+            children = self.chains.children(chain)
+            if len(children) == 0 or not self.follow_branches:
+                return
+            if len(children) > 1:
+                # the workers that steal the branches fetch the state of the fork commit from the cache
+                self.cache.put(self.commit_graph.node_id(self.chains.tail(chain)), ces_current_state,
+                               len(children) - 1)
+                with self.phases.phase('write'):
+                    self.writer.flush()
+                for child in children[1:]:
+                    self.logger.info("Adding task for start of branch with commit id: %s",
+                                     self.commit_graph.node_id(self.chains.head(child)))
+                self.result_queue.put(('spawned', self.number, self.job, list(children[1:]), self.finished_chains))
+                self.finished_chains = []
+            chain = children[0]
+            ces_past_state = ces_current_state
+
+    def _refresh_status(self, chain):
+        """
+        Marks the commits of a chain as processed that a worker processed before it lost the lease of the task, such
+        that their states are read from the database instead of merging them again. Because the commits are written
+        before the code entity states (see :class:`~memeshark.writer.WriteBuffer`), the code entity states of a commit
+        are only deleted if the commit is processed.
+        :param chain: index of the chain (see :class:`~memeshark.graph.ChainPartition`)
+        """
+        nodes = {self.commit_graph.node_id(node): node for node in self.chains.nodes(chain)
+                 if not self.status.is_processed(node)}
+        processed = [nodes[commit_id] for commit_id in self.storage.processed_commits(list(nodes))]
+        if len(processed) > 0:
+            self.logger.info("%i commits of the chain starting with node %s were already processed", len(processed),
+                             self.commit_graph.node_id(self.chains.head(chain)))
+            self.status = self.status.mark_processed(processed)
+
+    def _merge_chain(self, chain, ces_past_state):
+        """
+        Merges the code entity states of all nodes of a chain.
+        :param chain: index of the chain (see :class:`~memeshark.graph.ChainPartition`)
+        :param ces_past_state: the state of the predecessor of the chain; None if it must be fetched from the database
+        :return: the state of the last node of the chain
+        """
+        nodes = self.chains.nodes(chain)
+        is_path = self.commit_graph.in_degree(nodes[0]) != 1
+        prefetcher = None
+        if self.prefetch_depth > 0:
+            prefetcher = Prefetcher([(self.commit_graph.node_id(node), self._read(node))
+                                     for node in nodes[int(is_path):]], self.prefetch_depth, self.prefetch_documents)
+        try:
+            if is_path:
+                self.logger.info("start of path starting with node %s", self.commit_graph.node_id(nodes[0]))
+                ces_current_state = self._merge_path(nodes[0])
             else:
-                if isIdle:
-                    self.logger.info("worker leaving idle state")
-                    isIdle = False
-                start_node = self.task_queue.get()
-
-            if len(self.commit_graph.pred[start_node]) != 1:
-                self.logger.info("start of path starting with node %s", start_node)
-                self._merge_path(start_node)
-            else:
-                # fetch past state for parent
-                self.logger.info("start merging for branch starting with node %s", start_node)
-                ces_past_state = {}
-                for pred in self.commit_graph.pred[start_node]:
-                    pred_commit = Commit.objects(id=pred).get()
-                    for i, ces in enumerate(CodeEntityState.objects(id__in=pred_commit.code_entity_states)):
-                        ces_past_state[ces.long_name + ces.file_id.__str__()] = ces
-                self._merge_node(start_node, ces_past_state)
-            self.task_queue.task_done()
+                self.logger.info("start merging for branch starting with node %s",
+                                 self.commit_graph.node_id(nodes[0]))
+                if ces_past_state is None:
+                    pred = self.commit_graph.pred(nodes[0])[0]
+                    ces_past_state = self.cache.get(self.commit_graph.node_id(pred))
+                    if ces_past_state is None:
+                        with self.phases.phase('read'):
+                            ces_past_state = self._fetch_state(pred)
+                ces_current_state = self._merge_node(nodes[0], ces_past_state, prefetcher)
+            for node in nodes[1:]:
+                ces_current_state = self._merge_node(node, ces_current_state, prefetcher)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        return ces_current_state
+
+    def _read(self, node):
+        """
+        Determines which code entity states are required to merge a node based on the status of the commits at the
+        start of the run (see :class:`~memeshark.graph.CommitStatus`).
+        :param node: the node
+        :return: function that reads the code entity states as dicts; None if nothing must be read, i.e., if the node
+            and all its successors are already processed
+        """
+        commit_id = self.commit_graph.node_id(node)
+        if not self.status.is_processed(node):
+            return lambda: self.reader.ces_of_commit(commit_id)
+        if all(self.status.is_processed(successor) for successor in self.commit_graph.succ(node)):
+            return None
+        return lambda: self.reader.ces_by_ids(self.reader.code_entity_state_ids(commit_id))
+
+    def _fetch_state(self, node):
+        """
+        Fetches the state of an already processed node from the database. In a dry run, the state of a node that is
+        not processed is read from its own code entity states, which have the same keys and fingerprints.
+        :param node: the node
+        :return: the code entity states (see :class:`~memeshark.state.CESState`)
+        """
+        if self.dry_run and not self.status.is_processed(node):
+            return self._state(self.reader.ces_of_commit(self.commit_graph.node_id(node)))
+        ces_ids = self.reader.code_entity_state_ids(self.commit_graph.node_id(node))
+        return self._state(self.reader.ces_by_ids(ces_ids))
 
     def _merge_path(self, start_node):
         """
         Starts the merging of code entity states for a path in the commit graph.
         In the sense of the memeSHARK, a path starts with a commit that does not have exactly one parent and ends if a
-        commit either has no successor or also not exactly one parent.
+        commit either has no successor or also not exactly one parent. All code entity states of the first commit are
+        kept.
         :param start_node: node at the beginning of a path
+        :return: the code entity states of the node (see :class:`~memeshark.state.CESState`)
         """
-        self.started_tasks.put(1)
-        current_progress = self.started_tasks.qsize()
-        self.logger.info("merging for node %s (%i / %i)", start_node, current_progress, self.no_commits)
-        ces_current_state = {}
-        for ces in CodeEntityState.objects(commit_id=start_node):
-            ces_current_state[ces.long_name + ces.file_id.__str__()] = ces
-
-        self._add_ces_to_commit(start_node, ces_current_state)
-        self.deleted_ces_queue.put(0)
-        self.total_ces_queue.put(len(ces_current_state))
+        commit_id = self.commit_graph.node_id(start_node)
+        self.processed_commits += 1
+        self._count('commits')
+        self.logger.info("merging for node %s", commit_id)
+        with self.phases.phase('read'):
+            ces_documents = list(self.reader.ces_of_commit(commit_id))
+        with self.phases.phase('compare'):
+            ces_current_state = self._state(ces_documents)
 
-        successor = self.commit_graph.succ[start_node]
+        if not self.dry_run:
+            with self.phases.phase('write'):
+                self._add_ces_to_commit(commit_id, ces_current_state)
+        self.ces_total += len(ces_current_state)
+        return ces_current_state
 
-        for i, succnode in enumerate(successor):
-            self._merge_node(succnode, ces_current_state)
-
-    def _merge_node(self, node, ces_past_state):
+    def _merge_node(self, node, ces_past_state, prefetcher=None):
         """
         Merges code entity states for the current node in the commit graph.
         :param node: the current node
-        :param ces_past_state: the code entity states
-        """
-        while len(self.commit_graph.pred[node]) == 1:
-            self.started_tasks.put(1)
-            current_progress = self.started_tasks.qsize()
-            self.logger.info("merging for node %s (%i / %i)", node, current_progress, self.no_commits)
-            ces_current_state = {}  # contains CES that will be added to commit
-            ces_map = {}  # for updating self-references
-            ces_unchanged = []  # stores CES to be deleted
-            ces_unchanged_parents = {}  # parents of the CES to be deleted
-            ces_changed = []  # stores CES that are updated
-            ces_this = {}  # map from IDs from current commit to CES
-
-            # check if CES are already appended to commit, if yes fetch current state from commit and skip merging
-            current_commit = Commit.objects(id=node).get()
-            if len(current_commit.code_entity_states) > 0:
-                self.logger.info("node %s already processed", node)
-                # check if follower is also already processed
-                is_processed = True
-                for i, succnode in enumerate(self.commit_graph.succ[node]):
-                    succ_commit = Commit.objects(id=succnode).get()
-                    if not len(succ_commit.code_entity_states) > 0:
-                        is_processed = False
-                # only fetch CES if follower is not processed
-                if not is_processed:
-                    for i, ces in enumerate(CodeEntityState.objects(id__in=current_commit.code_entity_states)):
-                        ces_current_state[ces.long_name + ces.file_id.__str__()] = ces
+        :param ces_past_state: the code entity states of the predecessor (see :class:`~memeshark.state.CESState`)
+        :param prefetcher: the :class:`~memeshark.prefetch.Prefetcher` that reads the node ahead (optional)
+        :return: the code entity states of the node
+        """
+        commit_id = self.commit_graph.node_id(node)
+        self.processed_commits += 1
+        self._count('commits')
+        self.logger.info("merging for node %s", commit_id)
+        ces_current_state = {}  # contains CES that will be added to commit
+        ces_map = {}  # for updating self-references
+        ces_unchanged = []  # stores CES to be deleted
+        ces_unchanged_parents = {}  # parents of the CES to be deleted
+        ces_changed = []  # stores CES that are updated
+        ces_this = {}  # map from IDs from current commit to the keys of their code entities
+        ces_this_state = {}  # map from IDs from current commit to their compact state
+
+        with self.phases.phase('read'):
+            if prefetcher is not None:
+                ces_documents = prefetcher.get(commit_id)
             else:
-                for ces in CodeEntityState.objects(commit_id=node):
-                    ces_this[ces.id] = ces
-                    if ces.long_name + ces.file_id.__str__() not in ces_past_state:
-                        ces_current_state[ces.long_name + ces.file_id.__str__()] = ces
-                        ces_map[ces.id] = ces.id
-                        ces_changed.append(ces.id)
+                read = self._read(node)
+                ces_documents = list(read()) if read is not None else None
+
+        # check if CES are already appended to commit, if yes use the current state from commit and skip merging
+        if self.status.is_processed(node):
+            self.logger.info("node %s already processed", commit_id)
+            # the CES are only fetched if a follower is not processed
+            if ces_documents is not None:
+                with self.phases.phase('compare'):
+                    ces_current_state = self._state(ces_documents)
+        else:
+            with self.phases.phase('compare'):
+                ces_past_documents = None
+                if self.verify_fingerprints:
+                    ces_past_documents = {ces['_id']: ces for ces in self.reader.ces_by_ids(
+                        [ces_past.id for ces_past in ces_past_state.values()])}
+                self._count('ces_compared', len(ces_documents))
+                keys = [self._key(ces) for ces in ces_documents]
+                ces_fingerprints = fingerprints(ces_documents)
+                unchanged = unchanged_mask([ces_past_state[key].fingerprint if key in ces_past_state else None
+                                            for key in keys], ces_fingerprints)
+                for ces, key, ces_fingerprint, is_unchanged in zip(ces_documents, keys, ces_fingerprints, unchanged):
+                    ces_this[ces['_id']] = key
+                    ces_this_state[ces['_id']] = self._ces_state(ces, ces_fingerprint)
+                    if key not in ces_past_state:
+                        ces_current_state[key] = ces_this_state[ces['_id']]
+                        ces_map[ces['_id']] = ces['_id']
+                        ces_changed.append(ces['_id'])
                     else:
-                        ces_past = ces_past_state[ces.long_name + ces.file_id.__str__()]
-                        if not self._compare_dicts(ces_past, ces,
-                                                   {'id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids'}):
-                            ces_current_state[ces.long_name + ces.file_id.__str__()] = ces
-                            ces_map[ces.id] = ces.id
-                            ces_changed.append(ces.id)
+                        ces_past = ces_past_state[key]
+                        if not self._is_unchanged(ces_past, ces, is_unchanged, ces_past_documents):
+                            ces_current_state[key] = ces_this_state[ces['_id']]
+                            ces_map[ces['_id']] = ces['_id']
+                            ces_changed.append(ces['_id'])
                         else:
-                            ces_current_state[ces.long_name + ces.file_id.__str__()] = ces_past
-                            ces_map[ces.id] = ces_past.id
-                            ces_unchanged.append(ces.id)
-                            ces_unchanged_parents[ces.id] = ces.ce_parent_id
-
-                # check if parent changed; if yes, the CES must be updated, too
-                saved_children = True
-                while saved_children:
-                    saved_children = False
-                    for ces in ces_unchanged:
-                        if ces_unchanged_parents[ces] in ces_changed:
-                            saved_children = True
-                            ces_object = ces_this[ces]
-                            ces_map[ces] = ces_object
-                            ces_current_state[ces_object.long_name + ces_object.file_id.__str__()] = ces_object
-                            ces_changed.append(ces)
-                            ces_unchanged.remove(ces)
-
-                self._add_ces_to_commit(node, ces_current_state)
-                self._update_ces(node, ces_current_state, ces_unchanged, ces_map)
-                self._delete_unchanged_ces(ces_unchanged, len(ces_current_state))
-
-            # in case there is only on successor use iterative approach
-            if len(self.commit_graph.succ[node]) == 1:
-                ces_past_state = ces_current_state
-                for i, succnode in enumerate(self.commit_graph.succ[node]):
-                    node = succnode
-            # add new job to queue for branches to enable parallelism for branches
+                            ces_current_state[key] = ces_past
+                            ces_map[ces['_id']] = ces_past.id
+                            ces_unchanged.append(ces['_id'])
+                            ces_unchanged_parents[ces['_id']] = ces.get('ce_parent_id')
+
+            # check if parent changed; if yes, the CES must be updated, too
+            with self.phases.phase('propagate'):
+                saved_children = propagate_changes(ces_unchanged, ces_unchanged_parents, ces_changed)
+                if len(saved_children) > 0:
+                    for ces in saved_children:
+                        ces_map[ces] = ces
+                        ces_current_state[ces_this[ces]] = ces_this_state[ces]
+                    saved_children = set(saved_children)
+                    ces_unchanged = [ces for ces in ces_unchanged if ces not in saved_children]
+
+            if self.dry_run:
+                self._count_unchanged_ces(ces_unchanged, len(ces_current_state))
             else:
-                for i, succnode in enumerate(self.commit_graph.succ[node]):
-                    num_pred = len(self.commit_graph.pred[succnode])
-                    if num_pred == 1:
-                        self.logger.info("Adding task for start of branch with commit id: %s", succnode)
-                        self.task_queue.put(succnode)
-                    else:
-                        self.logger.info("Skipping merging for start of branch, because of #parents!=1 (%i): %s",
-                                         num_pred, succnode)
-                return
+                # the writer measures the deletes that it sends as the deleting phase
+                with self.phases.phase('write'):
+                    self._add_ces_to_commit(commit_id, ces_current_state)
+                    self._update_ces(commit_id, ces_current_state, ces_unchanged, ces_map, ces_this)
+                    self._delete_unchanged_ces(ces_unchanged, len(ces_current_state))
+        return ces_current_state
 
-    def _add_ces_to_commit(self, node, current_state):
+    def _add_ces_to_commit(self, commit_id, current_state):
         """
         Adds a list of current code entity state IDs to a commit
-        :param node: the commit
+        :param commit_id: the commit
         :param current_state: the code entity stats
         """
         self.logger.info("adding code entity states to commit")
-        commit = Commit.objects(id=node).get()
         ids = []
-        for i, ces in current_state.items():
-            ids.append(ces.id)
-        commit.code_entity_states = ids
-        commit.save()
+        for i, ces_state in current_state.items():
+            ids.append(ces_state.id)
+        self.writer.set_code_entity_states(commit_id, ids)
 
-    def _update_ces(self, node, ces_current_state, ces_unchanged, ces_map):
+    def _update_ces(self, commit_id, ces_current_state, ces_unchanged, ces_map, ces_this):
         """
         Updates the code entity states that are not deleted. This is required because the parents may change.
-        :param node: the commit
+        :param commit_id: the commit
         :param ces_current_state: the current code entity states
         :param ces_unchanged: the code entity states that did not change in a commit and are, therefore, deleted
         :param ces_map: a mapping of the IDs of code entity states in this commits to their representation that is kept
+        :param ces_this: a mapping of the IDs of code entity states in this commit to the keys of their code entities
         """
         self.logger.info("updating broken parent references")
-        for i, ces in ces_current_state.items():
-            if ces.commit_id != node:
+        for key, ces_state in ces_current_state.items():
+            if ces_state.id not in ces_this:
                 continue  # skip CES from previous commits
 
             # updated CES references
-            if ces.ce_parent_id in ces_unchanged:
-                ces.ce_parent_id = ces_map[ces.ce_parent_id]
-                ces.save()
+            if ces_state.parent_id in ces_unchanged:
+                parent_id = ces_map[ces_state.parent_id]
+                self.writer.set_parent(ces_state.id, parent_id)
+                self._count('ces_updated')
+                ces_current_state[key] = ces_state._replace(parent_id=parent_id)
 
     def _delete_unchanged_ces(self, ces_unchanged, no_ces):
         """
@@ -341,9 +965,112 @@ class MemeSHARKWorker(multiprocessing.Process):
         :param no_ces: the total number of code entity states for this commit
         """
         self.logger.info("deleting %i of %i code entity states", len(ces_unchanged), no_ces)
-        self.total_ces_queue.put(no_ces)
-        self.deleted_ces_queue.put(len(ces_unchanged))
-        CodeEntityState.objects(id__in=ces_unchanged).delete()
+        self._count_unchanged_ces(ces_unchanged, no_ces)
+        self.writer.delete_ces(ces_unchanged)
+
+    def _count_unchanged_ces(self, ces_unchanged, no_ces):
+        """
+        Counts the code entity states that did not change in the current commit for the statistics.
+        :param ces_unchanged: the IDs of the unchanged code entity states.
+        :param no_ces: the total number of code entity states for this commit
+        """
+        self.ces_total += no_ces
+        self.ces_deleted += len(ces_unchanged)
+        self._count('ces_deleted', len(ces_unchanged))
+
+    def _count(self, counter, value=1):
+        """
+        Increments a shared counter of the worker if the counters are enabled.
+        :param counter: name of the counter (see :class:`~memeshark.counters.Counters`)
+        :param value: increment
+        """
+        if self.worker_counters is not None:
+            self.worker_counters.add(counter, value)
+
+    def _key(self, ces):
+        """
+        Interns the key of the code entity of a code entity state.
+        :param ces: the code entity state as dict
+        :return: the integer key (see :class:`~memeshark.state.KeyTable`)
+        """
+        return self.keys.intern(ces['long_name'], ces['file_id'])
+
+    def _state(self, documents):
+        """
+        Creates the state of a commit from its code entity states.
+        :param documents: iterable of the code entity states as dicts
+        :return: the code entity states (see :class:`~memeshark.state.CESState`)
+        """
+        documents = list(documents)
+        state = {}
+        for ces, ces_fingerprint in zip(documents, fingerprints(documents)):
+            state[self._key(ces)] = self._ces_state(ces, ces_fingerprint)
+        return state
+
+    def _ces_state(self, ces, ces_fingerprint):
+        """
+        Creates the compact state of a code entity state that is kept to compare it with its next state.
+        :param ces: the code entity state as dict
+        :param ces_fingerprint: the fingerprint of the code entity state (see :mod:`memeshark.metrics`)
+        :return: the state (see :class:`~memeshark.state.CESState`)
+        """
+        return CESState(ces_fingerprint, ces['_id'], ces.get('ce_parent_id'))
+
+    def _is_unchanged(self, ces_past, ces, unchanged, ces_past_documents=None):
+        """
+        Checks if a code entity state did not change, i.e., if the fingerprints of the states are equal (see
+        :func:`~memeshark.metrics.unchanged_mask`). If the documents of the past states are given, the verdict is
+        verified with :meth:`_compare_dicts` and the verdict of :meth:`_compare_dicts` is used in case of disagreement.
+        The fields that the stored documents have but :class:`~pycoshark.mongomodels.CodeEntityState` does not declare
+        are compared by :meth:`_compare_undeclared`.
+        :param ces_past: the past state (see :class:`~memeshark.state.CESState`)
+        :param ces: the current code entity state as dict
+        :param unchanged: true if the fingerprints of the past and the current state are equal
+        :param ces_past_documents: mapping from the IDs of the past states to the code entity states as dicts (optional)
+        :return: true if unchanged, false otherwise
+        """
+        unchanged = bool(unchanged)
+        if ces_past_documents is not None:
+            ces_past_document = ces_past_documents[ces_past.id]
+            compared = self._compare_undeclared(ces_past_document, ces) and \
+                self._compare_dicts(self._document(ces_past_document), self._document(ces),
+                                    {'id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids'})
+            if compared != unchanged:
+                self.logger.error("fingerprint and comparison disagree for code entity state %s (past state: %s, "
+                                  "fingerprint unchanged: %s, comparison unchanged: %s)", ces['_id'], ces_past.id,
+                                  unchanged, compared)
+                unchanged = compared
+        return unchanged
+
+    def _document(self, ces):
+        """
+        Creates the document of a code entity state without the fields that
+        :class:`~pycoshark.mongomodels.CodeEntityState` does not declare, which would raise FieldDoesNotExist.
+        :param ces: the code entity state as dict
+        :return: the :class:`~pycoshark.mongomodels.CodeEntityState`
+        """
+        return CodeEntityState._from_son({field: value for field, value in ces.items()
+                                          if field in CodeEntityState._reverse_db_field_map})
+
+    def _compare_undeclared(self, ces1, ces2):
+        """
+        Compares the fields of two code entity states that :class:`~pycoshark.mongomodels.CodeEntityState` does not
+        declare by their values. Like for the declared fields, a field that is None or empty is the same as a field
+        that is not set.
+        :param ces1: first code entity state as dict
+        :param ces2: second code entity state as dict
+        :return: true if match, false otherwise
+        """
+        for field in set(ces1) | set(ces2):
+            if field in CodeEntityState._reverse_db_field_map:
+                continue
+            value1 = ces1.get(field)
+            value2 = ces2.get(field)
+            if value1 in (None, [], {}) and value2 in (None, [], {}):
+                continue
+            if value1 != value2:
+                return False
+        return True
 
     def _compare_dicts(self, obj1, obj2, excluded_keys):
         """
@@ -376,7 +1103,7 @@ class MemeSHARKWorker(multiprocessing.Process):
             try:
                 value1 = obj1[key]
                 value2 = obj2[key]
-                if isnan(value1) and isnan(value2):
+                if isinstance(value1, float) and isinstance(value2, float) and isnan(value1) and isnan(value2):
                     continue
                 if value1 != value2:
                     return False
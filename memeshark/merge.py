@@ -0,0 +1,22 @@
+def propagate_changes(ces_unchanged, ces_unchanged_parents, ces_changed):
+    """
+    Determines the unchanged code entity states that must be kept because their parent is kept, i.e., changed or
+    itself kept. The changes are propagated down the tree of the parent references in one traversal over an index
+    of the children by parent.
+    :param ces_unchanged: IDs of the unchanged code entity states
+    :param ces_unchanged_parents: mapping from the IDs of the unchanged code entity states to the IDs of their parents
+    :param ces_changed: IDs of the changed code entity states
+    :return: list of the IDs of the unchanged code entity states that must be kept, in the order of the traversal
+    """
+    children = {}
+    for ces in ces_unchanged:
+        children.setdefault(ces_unchanged_parents[ces], []).append(ces)
+
+    saved = []
+    stack = [ces for ces in ces_changed if ces in children]
+    while len(stack) > 0:
+        for ces in children.pop(stack.pop(), ()):
+            saved.append(ces)
+            if ces in children:
+                stack.append(ces)
+    return saved
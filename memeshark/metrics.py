@@ -0,0 +1,81 @@
+from memeshark.fingerprint import fingerprint, is_numeric, key_hash, METRICS_FIELD, NAN_BITS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _splitmix64(values):
+    """
+    Vectorized :func:`~memeshark.fingerprint.splitmix64` that wraps around modulo 2^64.
+    :param values: array of uint64
+    :return: array of the mixed uint64
+    """
+    values = values + numpy.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def metrics_digests(schema, values):
+    """
+    Calculates the :func:`~memeshark.fingerprint.metrics_digest` of many code entity states with the same metrics.
+    :param schema: names of the metrics
+    :param values: float array with one row per code entity state and one column per metric
+    :return: uint64 array with the digests
+    """
+    values = values.copy()
+    nan = numpy.isnan(values)
+    values[values == 0] = 0.0
+    bits = values.view(numpy.uint64)
+    bits[nan] = NAN_BITS
+    keys = numpy.array([key_hash(key) for key in schema], dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        return _splitmix64(bits ^ keys[numpy.newaxis, :]).sum(axis=1, dtype=numpy.uint64)
+
+
+def fingerprints(documents):
+    """
+    Calculates the fingerprints of all code entity states of a commit. The numeric metrics are aligned into one float
+    array per schema, i.e., per set of metric names, and their digests are calculated at once. Metrics that are not
+    numeric and all other fields are fingerprinted by :func:`~memeshark.fingerprint.fingerprint`. Without NumPy, all
+    fingerprints are calculated by :func:`~memeshark.fingerprint.fingerprint`.
+    :param documents: list of code entity states as dicts
+    :return: list of fingerprints
+    """
+    if numpy is None:
+        return [fingerprint(ces) for ces in documents]
+
+    schemas = {}
+    for i, ces in enumerate(documents):
+        metrics = ces.get(METRICS_FIELD)
+        if metrics and is_numeric(metrics):
+            schemas.setdefault(tuple(sorted(metrics)), []).append(i)
+
+    digests = [None] * len(documents)
+    for schema, indices in schemas.items():
+        values = numpy.array([[documents[i][METRICS_FIELD][key] for key in schema] for i in indices],
+                             dtype=numpy.float64)
+        for i, digest in zip(indices, metrics_digests(schema, values).tolist()):
+            digests[i] = digest
+    return [fingerprint(ces, digest=digest) for ces, digest in zip(documents, digests)]
+
+
+def unchanged_mask(past_fingerprints, current_fingerprints):
+    """
+    Compares the fingerprints of the past and the current states of code entities at once.
+    :param past_fingerprints: list of the fingerprints of the past states; None if a code entity has no past state
+    :param current_fingerprints: list of the fingerprints of the current states
+    :return: boolean array (list without NumPy) that is true for unchanged code entities; the changed code entities
+        are the negation
+    """
+    if numpy is None:
+        return [past == current for past, current in zip(past_fingerprints, current_fingerprints)]
+
+    if len(current_fingerprints) == 0:
+        return numpy.zeros(0, dtype=bool)
+    present = numpy.array([past is not None for past in past_fingerprints], dtype=bool)
+    past = numpy.frombuffer(b''.join(past or bytes(16) for past in past_fingerprints), dtype=numpy.uint64)
+    current = numpy.frombuffer(b''.join(current_fingerprints), dtype=numpy.uint64)
+    return present & (past == current).reshape(-1, 2).all(axis=1)
@@ -0,0 +1,477 @@
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import timeit
+from array import array
+
+import bson
+from bson import ObjectId
+from pycoshark.mongomodels import Project, VCSSystem, Commit, CodeEntityState
+
+from memeshark.cache import StateCache
+from memeshark.counters import CounterReporter, Counters
+from memeshark.dump import BSONFile, CODEC_OPTIONS, read_collection
+from memeshark.graph import build_commit_graph, ChainPartition, CommitStatus
+from memeshark.memeshark import MemeSHARK, MemeSHARKWorker
+from memeshark.profiling import report_profiles
+from memeshark.reader import StateReader
+from memeshark.state import KeyTable
+from memeshark.storage import Storage
+
+
+class DumpReader(object):
+    """
+    Reads the code entity states of a project from the memory-mapped code_entity_state collection of a mongodump like
+    the :class:`~memeshark.reader.StateReader` reads them from the MongoDB. The collection is indexed in one pass
+    without decoding the code entity states: the offsets and IDs of the code entity states of the commits that are
+    merged, and the offsets of the code entity states that are referenced by already processed commits whose states
+    are read.
+    :param ces_file: the :class:`~memeshark.dump.BSONFile` of the code entity states
+    :param commit_ids: IDs of the commits whose code entity states are merged
+    :param states: dict from the IDs of already processed commits whose states are read to the lists of the IDs of
+        their code entity states
+    """
+
+    def __init__(self, ces_file, commit_ids, states):
+        self.ces_file = ces_file
+        self.states = states
+        self._offsets = {commit_id: array('q') for commit_id in commit_ids}
+        self._ids = {commit_id: bytearray() for commit_id in commit_ids}
+        self._by_id = {}
+        referenced = set(ces_id for ces_ids in states.values() for ces_id in ces_ids)
+        for offset in ces_file:
+            fields = ces_file.object_ids(offset, (b'_id', b'commit_id'))
+            ces_id = fields[b'_id']
+            offsets = self._offsets.get(fields.get(b'commit_id'))
+            if offsets is not None:
+                offsets.append(offset)
+                self._ids[fields[b'commit_id']] += ces_id.binary
+            if ces_id in referenced:
+                self._by_id[ces_id] = offset
+
+    def count(self, commit_id):
+        """
+        :param commit_id: ID of a commit that is merged
+        :return: the number of code entity states of the commit
+        """
+        return len(self._offsets[commit_id])
+
+    def positions(self, commit_id):
+        """
+        :param commit_id: ID of a commit that is merged
+        :return: dict from the IDs of the code entity states of the commit to their offsets in the dump
+        """
+        ids = self._ids[commit_id]
+        return {ObjectId(bytes(ids[12 * i:12 * (i + 1)])): offset for i, offset in enumerate(self._offsets[commit_id])}
+
+    def code_entity_state_ids(self, commit_id):
+        """
+        Returns the IDs of the code entity states of a commit that were added by the memeSHARK.
+        :param commit_id: ID of the commit
+        :return: list of IDs; empty if the commit was not yet processed
+        """
+        return self.states.get(commit_id, [])
+
+    def ces_of_commit(self, commit_id):
+        """
+        Decodes all code entity states that were collected for a commit.
+        :param commit_id: ID of the commit
+        :return: iterable of dicts
+        """
+        for offset in self._offsets.get(commit_id, ()):
+            yield self._decode(offset)
+
+    def ces_by_ids(self, ids):
+        """
+        Decodes code entity states that are referenced by already processed commits.
+        :param ids: list of IDs
+        :return: iterable of dicts
+        """
+        for ces_id in ids:
+            offset = self._by_id.get(ces_id)
+            if offset is not None:
+                yield self._decode(offset)
+
+    def _decode(self, offset):
+        """
+        Decodes a code entity state without the fields that the :class:`~memeshark.reader.StateReader` does not read.
+        :param offset: offset of the code entity state
+        :return: the code entity state as dict
+        """
+        ces = self.ces_file.decode(offset)
+        for field in StateReader.CES_PROJECTION:
+            ces.pop(field, None)
+        return ces
+
+
+class DumpWriter(object):
+    """
+    Collects the writes of the merging like the :class:`~memeshark.writer.WriteBuffer` for the output of an offline
+    compaction. The lists of code entity states of the commits are spooled to a file, and the deleted code entity
+    states and the changed parents are kept by the offsets of the code entity states in the dump. As in
+    :meth:`~memeshark.memeshark.MemeSHARKWorker._merge_node`, the code entity states that are updated or deleted must
+    belong to the commit whose code entity states were set last.
+    :param reader: the :class:`DumpReader` of the code entity states
+    :param spool_path: path of the file to which the lists of code entity states are spooled
+    """
+
+    def __init__(self, reader, spool_path):
+        self.reader = reader
+        self.spool_path = spool_path
+        self.commits = {}
+        self.deleted = array('q')
+        self.parents = {}
+        self._spool = open(spool_path, 'wb')
+        self._commit = None
+        self._positions = None
+
+    def __len__(self):
+        return 0
+
+    def set_code_entity_states(self, commit_id, ces_ids):
+        """
+        Sets the list of current code entity states of a commit.
+        :param commit_id: ID of the commit
+        :param ces_ids: IDs of the code entity states
+        """
+        self.commits[commit_id] = self._spool.tell()
+        self._spool.write(bson.encode({'code_entity_states': ces_ids}))
+        self._commit = commit_id
+        self._positions = None
+
+    def set_parent(self, ces_id, parent_id):
+        """
+        Sets the parent of a code entity state.
+        :param ces_id: ID of the code entity state
+        :param parent_id: ID of the new parent
+        """
+        self.parents[self._position(ces_id)] = parent_id
+
+    def delete_ces(self, ces_ids):
+        """
+        Deletes code entity states.
+        :param ces_ids: IDs of the code entity states
+        """
+        for ces_id in ces_ids:
+            self.deleted.append(self._position(ces_id))
+
+    def flush(self):
+        """
+        Flushes the spooled lists of code entity states.
+        """
+        self._spool.flush()
+
+    def close(self):
+        """
+        Closes the spool file.
+        """
+        self._spool.close()
+
+    def _position(self, ces_id):
+        """
+        :param ces_id: ID of a code entity state of the commit whose code entity states were set last
+        :return: the offset of the code entity state in the dump
+        """
+        if self._positions is None:
+            self._positions = self.reader.positions(self._commit)
+        return self._positions[ces_id]
+
+
+class DumpStorage(Storage):
+    """
+    The code entity states of a mongodump that are merged by an :class:`OfflineWorker`.
+    :param reader: the :class:`DumpReader`
+    :param writer: the :class:`DumpWriter`
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    def reader(self, batch_size=5000, counters=None):
+        """
+        :return: the :class:`DumpReader`
+        """
+        return self._reader
+
+    def writer(self, max_operations=1000, max_delay=5.0, counters=None, guard=None, phases=None):
+        """
+        :return: the :class:`DumpWriter`
+        """
+        return self._writer
+
+    def processed_commits(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: the IDs of the commits whose states are read from the dump or that were merged since
+        """
+        return [commit_id for commit_id in commit_ids
+                if len(self._reader.code_entity_state_ids(commit_id)) > 0 or commit_id in self._writer.commits]
+
+
+class OfflineWorker(MemeSHARKWorker):
+    """
+    Worker that merges all chains of a commit graph in the current process without a MongoDB, e.g., with the
+    :class:`DumpStorage` of a mongodump or a :class:`~memeshark.storage.MemoryStorage`. The merging is the same as in
+    the workers of a run against the MongoDB. The branches that the worker spawns are processed before the other tasks,
+    such that the states of their fork commits are still in memory.
+    :param work_dir: working directory for the spill files of the :class:`~memeshark.cache.StateCache`
+    :param storage: the :class:`~memeshark.storage.Storage` of the commits and code entity states
+    :param commit_graph: the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`)
+    :param chains: the chains of the commit graph (see :class:`~memeshark.graph.ChainPartition`)
+    :param status: the status of the commits (see :class:`~memeshark.graph.CommitStatus`)
+    :param cache_memory: memory budget of the :class:`~memeshark.cache.StateCache` in bytes
+    :param counters: the shared :class:`~memeshark.counters.Counters` (optional)
+    :param profile_directory: directory to which the worker writes its cProfile dump and the times of its phases (see
+        :mod:`memeshark.profiling`); None disables the profiling
+    """
+
+    def __init__(self, work_dir, storage, commit_graph, chains, status, cache_memory=256 * 1024 * 1024,
+                 counters=None, profile_directory=None):
+        # the storage is read in the merging thread, there is no latency that a read-ahead could hide
+        MemeSHARKWorker.__init__(self, work_dir, storage, 0, None, queue.Queue(), cache_memory=cache_memory,
+                                 prefetch_depth=0, counters=counters, profile_directory=profile_directory)
+        self.job = 0
+        self.commit_graph = commit_graph
+        self.chains = chains
+        self.status = status
+
+    def _run(self):
+        """
+        Merges all chains.
+        """
+        self.storage.connect()
+        if self.counters is not None:
+            self.worker_counters = self.counters.worker(self.number)
+        self.reader = self.storage.reader(self.read_batch_size, self.worker_counters)
+        self.writer = self._write_buffer()
+        self.keys = KeyTable()
+        self.cache = StateCache(os.path.join(self.work_dir, 'states'), self.cache_memory, self.keys)
+        tasks = [chain for chain in self.chains if self.chains.parent(chain) < 0]
+        tasks.reverse()
+        while len(tasks) > 0:
+            # nothing is journaled, the finished chains are dropped
+            self.finished_chains = []
+            self._process_task(tasks.pop())
+            while not self.result_queue.empty():
+                tasks.extend(reversed(self.result_queue.get()[3]))
+        self.writer.flush()
+
+
+class OfflineMemeSHARK(object):
+    """
+    Merges the code entity states of a project in the BSON files of a mongodump instead of the MongoDB, such that the
+    merging does not wait for the database. The commit and code_entity_state collections are written to an output
+    directory with the lists of code entity states of the commits, without the deleted code entity states, and with the
+    changed parents, ready to replace the collections with mongorestore --drop. The documents that are not changed are
+    copied without decoding them.
+    """
+
+    def __init__(self):
+        """
+        Default constructor.
+        """
+        self.logger = logging.getLogger("main")
+
+    def start(self, cfg):
+        """
+        Executes the offline compaction.
+        :param cfg: configuration object that is used
+        """
+        self.logger.setLevel(cfg.get_debug_level())
+        start_time = timeit.default_timer()
+        if cfg.project_name is None:
+            self.logger.error("the offline compaction requires --project-name")
+            sys.exit(1)
+        if cfg.offline_output is None or os.path.realpath(cfg.offline_output) == os.path.realpath(cfg.offline):
+            self.logger.error("the offline compaction requires an --offline-output directory other than the dump")
+            sys.exit(1)
+        if cfg.dry_run or cfg.distributed is not None:
+            self.logger.error("an offline compaction cannot be a dry run or distributed")
+            sys.exit(1)
+        if cfg.verify_fingerprints:
+            self.logger.warning("the fingerprints are not verified in an offline compaction")
+        if cfg.journal is not None:
+            self.logger.warning("the journal is not used in an offline compaction")
+
+        paths = {}
+        for model in (Project, VCSSystem, Commit, CodeEntityState):
+            paths[model] = os.path.join(cfg.offline, '%s.bson' % model._get_collection_name())
+            if not os.path.exists(paths[model]):
+                self.logger.error("%s not found, the dump must not be compressed", paths[model])
+                sys.exit(1)
+
+        # Get the id of the project for which the code entities shall be merged
+        projects = [project['_id'] for project in read_collection(paths[Project])
+                    if project.get('name') == cfg.project_name]
+        if len(projects) == 0:
+            self.logger.error('Project %s not found!' % cfg.project_name)
+            sys.exit(1)
+        vcs_systems = [vcs['_id'] for vcs in read_collection(paths[VCSSystem]) if vcs.get('project_id') == projects[0]]
+        if len(vcs_systems) == 0:
+            self.logger.error('VCS system of project %s not found!' % cfg.project_name)
+            sys.exit(1)
+        self.logger.info("vcs_system_id: %s", vcs_systems[0])
+
+        commit_file = BSONFile(paths[Commit])
+        ces_file = BSONFile(paths[CodeEntityState])
+        work_dir = tempfile.mkdtemp(prefix='memeshark')
+        try:
+            worker = self._merge(cfg, commit_file, ces_file, vcs_systems[0], work_dir)
+            os.makedirs(cfg.offline_output, exist_ok=True)
+            if worker is None:
+                self.logger.info("no commits to process, the collections are copied")
+                shutil.copyfile(paths[Commit], os.path.join(cfg.offline_output, os.path.basename(paths[Commit])))
+                shutil.copyfile(paths[CodeEntityState],
+                                os.path.join(cfg.offline_output, os.path.basename(paths[CodeEntityState])))
+            else:
+                self._write_commits(commit_file, worker.writer, os.path.join(cfg.offline_output,
+                                                                             os.path.basename(paths[Commit])))
+                self._write_ces(ces_file, worker.writer, os.path.join(cfg.offline_output,
+                                                                      os.path.basename(paths[CodeEntityState])))
+                self.logger.info("deleted %i of %i code entity states", worker.ces_deleted, worker.ces_total)
+            for model in (Commit, CodeEntityState):
+                metadata_path = os.path.join(cfg.offline, '%s.metadata.json' % model._get_collection_name())
+                if os.path.exists(metadata_path):
+                    shutil.copy(metadata_path, cfg.offline_output)
+        finally:
+            commit_file.close()
+            ces_file.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        self.logger.info("compacted collections written to %s", cfg.offline_output)
+        elapsed = timeit.default_timer() - start_time
+        self.logger.info("Execution time: %0.5f s" % elapsed)
+
+    def _merge(self, cfg, commit_file, ces_file, vcs_id, work_dir):
+        """
+        Merges the code entity states of the commits of a VCS system.
+        :param cfg: configuration object that is used
+        :param commit_file: the :class:`~memeshark.dump.BSONFile` of the commits
+        :param ces_file: the :class:`~memeshark.dump.BSONFile` of the code entity states
+        :param vcs_id: ID of the VCS system
+        :param work_dir: working directory
+        :return: the :class:`OfflineWorker` after the merging; None if no commits are to be processed
+        """
+        commit_graph, db_processed, offsets = self._read_commits(commit_file, vcs_id)
+        no_commits = commit_graph.number_of_nodes()
+        self.logger.info("commit graph with %i commits and %i edges created, %i commits already processed",
+                         no_commits, commit_graph.number_of_edges(), sum(db_processed))
+
+        # in incremental runs, only the commits that are not yet processed are merged
+        processed = None
+        if cfg.incremental:
+            processed = bytearray(db_processed)
+            self.logger.info("%i commits to process", no_commits - sum(processed))
+        chains = ChainPartition.from_graph(commit_graph, processed)
+        self.logger.info("commit graph decomposed into %i chains", len(chains))
+        if len(chains) == 0:
+            return None
+
+        # the states of already processed commits are only read if they have successors that are not processed
+        states = {}
+        for node in commit_graph:
+            if db_processed[node] and any(db_processed[successor] == 0 for successor in commit_graph.succ(node)):
+                states[commit_graph.node_id(node)] = commit_file.decode(offsets[node]).get('code_entity_states') or []
+        # the code entity states of a commit are read if the commit is merged or, in a run that is not incremental, if
+        # a path starts with it
+        merged = [node for node in commit_graph if not db_processed[node] or processed is None]
+        reader = DumpReader(ces_file, [commit_graph.node_id(node) for node in merged], states)
+        counts = array('q', bytes(8 * no_commits))
+        for node in merged:
+            if not db_processed[node]:
+                counts[node] = reader.count(commit_graph.node_id(node))
+        self.logger.info("%i code entity states of %i commits indexed", sum(counts), len(merged))
+
+        os.mkdir(os.path.join(work_dir, 'states'))
+        writer = DumpWriter(reader, os.path.join(work_dir, 'commits.bson'))
+        counters = Counters(1)
+        if cfg.profile is not None:
+            os.makedirs(cfg.profile, exist_ok=True)
+        worker = OfflineWorker(work_dir, DumpStorage(reader, writer), commit_graph, chains,
+                               CommitStatus(db_processed, counts), cfg.cache_memory, counters, cfg.profile)
+        reporter = CounterReporter(counters, cfg.metrics_interval, cfg.metrics_file)
+        reporter.start()
+        try:
+            worker.run()
+        finally:
+            writer.close()
+            reporter.stop()
+        # the worker sets up the logging again
+        self.logger.setLevel(cfg.get_debug_level())
+        if cfg.profile is not None:
+            report_profiles(cfg.profile, 1)
+        return worker
+
+    def _read_commits(self, commit_file, vcs_id):
+        """
+        Builds the commit graph of a VCS system from the dump.
+        :param commit_file: the :class:`~memeshark.dump.BSONFile` of the commits
+        :param vcs_id: ID of the VCS system
+        :return: tuple of the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`), a bytearray with one
+            byte per node that is 1 if the commit was already processed, and the offsets of the commits in the dump
+        """
+        processed = bytearray()
+        offsets = array('q')
+
+        def commits():
+            # the nodes are numbered in the order of the commits in the dump
+            for offset in commit_file:
+                if commit_file.object_ids(offset, (b'vcs_system_id',)).get(b'vcs_system_id') != vcs_id:
+                    continue
+                commit = commit_file.decode(offset)
+                processed.append(int(len(commit.get('code_entity_states') or []) > 0))
+                offsets.append(offset)
+                yield commit
+
+        commit_graph, missing = build_commit_graph(commits())
+        if len(missing) > 0:
+            self.logger.warning("%i parents of commits are missing, e.g., %s", len(missing),
+                                ", ".join("commit id: %s - revision_hash: %s" % (commit_id, revision_hash)
+                                          for commit_id, revision_hash in missing[:MemeSHARK.MISSING_PARENTS_REPORTED]))
+        return commit_graph, processed, offsets
+
+    def _write_commits(self, commit_file, writer, path):
+        """
+        Writes the commits with their lists of code entity states.
+        :param commit_file: the :class:`~memeshark.dump.BSONFile` of the commits
+        :param writer: the :class:`DumpWriter` of the merging
+        :param path: path of the output file
+        """
+        spool = BSONFile(writer.spool_path)
+        try:
+            with open(path, 'wb') as f:
+                for offset in commit_file:
+                    spool_offset = writer.commits.get(commit_file.object_ids(offset, (b'_id',)).get(b'_id'))
+                    if spool_offset is None:
+                        f.write(commit_file.raw(offset))
+                        continue
+                    commit = commit_file.decode(offset)
+                    commit['code_entity_states'] = spool.decode(spool_offset)['code_entity_states']
+                    f.write(bson.encode(commit, codec_options=CODEC_OPTIONS))
+        finally:
+            spool.close()
+        self.logger.info("%i commits updated", len(writer.commits))
+
+    def _write_ces(self, ces_file, writer, path):
+        """
+        Writes the code entity states without the deleted ones and with the changed parents.
+        :param ces_file: the :class:`~memeshark.dump.BSONFile` of the code entity states
+        :param writer: the :class:`DumpWriter` of the merging
+        :param path: path of the output file
+        """
+        deleted = sorted(writer.deleted)
+        next_deleted = 0
+        with open(path, 'wb') as f:
+            for offset in ces_file:
+                if next_deleted < len(deleted) and deleted[next_deleted] == offset:
+                    next_deleted += 1
+                    continue
+                parent_id = writer.parents.get(offset)
+                if parent_id is None:
+                    f.write(ces_file.raw(offset))
+                else:
+                    f.write(ces_file.replace_object_id(offset, b'ce_parent_id', parent_id))
+        self.logger.info("%i code entity states deleted, %i parents updated", len(deleted), len(writer.parents))
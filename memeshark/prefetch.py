@@ -0,0 +1,83 @@
+import collections
+import threading
+
+
+class Prefetcher(object):
+    """
+    Reads the commits of a chain ahead in a background thread while the worker merges the current commit, such that
+    the reads from the MongoDB overlap with the comparisons and writes. For every commit, a function reads the code
+    entity states that are required to merge the commit. The read-ahead is bounded by a number of commits and a number
+    of documents. The results must be fetched with :meth:`get` in the order of the commits and the prefetcher must be
+    closed with :meth:`close`.
+    :param reads: list of tuples of the IDs of the commits in the order in which they are merged and the functions that
+        read their code entity states; the function is None if nothing must be read for a commit
+    :param depth: maximal number of commits that are read ahead
+    :param max_documents: maximal number of code entity states that are read ahead; the next commit is always read
+    """
+
+    def __init__(self, reads, depth, max_documents):
+        self.reads = reads
+        self.depth = depth
+        self.max_documents = max_documents
+        self._condition = threading.Condition()
+        self._results = collections.deque()
+        self._documents = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self, commit_id):
+        """
+        Waits for the read-ahead of the next commit.
+        :param commit_id: ID of the next commit
+        :return: list of the code entity states that were read for the commit; None if nothing was read
+        """
+        with self._condition:
+            while len(self._results) == 0:
+                self._condition.wait()
+            prefetched_id, documents, error = self._results.popleft()
+            if documents is not None:
+                self._documents -= len(documents)
+            self._condition.notify_all()
+        if error is not None:
+            raise error
+        if prefetched_id != commit_id:
+            raise ValueError('commit %s was requested, but commit %s was read ahead' % (commit_id, prefetched_id))
+        return documents
+
+    def close(self):
+        """
+        Stops the read-ahead and waits for the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        """
+        Reads the commits ahead until all commits are read, the prefetcher is closed, or a read failed.
+        """
+        for commit_id, read in self.reads:
+            with self._condition:
+                while not self._closed and len(self._results) > 0 and \
+                        (len(self._results) >= self.depth or self._documents >= self.max_documents):
+                    self._condition.wait()
+                if self._closed:
+                    return
+
+            documents = None
+            error = None
+            try:
+                if read is not None:
+                    documents = list(read())
+            except Exception as e:
+                error = e
+
+            with self._condition:
+                self._results.append((commit_id, documents, error))
+                if documents is not None:
+                    self._documents += len(documents)
+                self._condition.notify_all()
+            if error is not None:
+                return
@@ -0,0 +1,188 @@
+import io
+import json
+import logging
+import os
+import pstats
+import timeit
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time that a worker spends in the phases of merging a commit, i.e., reading, comparing, propagating
+    changed parents, writing, and deleting. The reads are measured in the merging thread, i.e., a read that was
+    completed ahead by the :class:`~memeshark.prefetch.Prefetcher` costs only the time that the worker waits for it.
+    The writes include the bulk writes that are triggered while the operations are buffered, except for the bulk
+    deletes, which the write buffer measures as the deleting. A phase that is entered within another phase is not
+    counted for the enclosing phase. If the timer is disabled, the phases are not measured.
+    :param enabled: true if the phases are measured
+    """
+
+    PHASES = ('read', 'compare', 'propagate', 'write', 'delete')
+
+    # phases that wait for the MongoDB
+    DB_PHASES = ('read', 'write', 'delete')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self._null = _NullPhase()
+        self._active = []
+
+    def phase(self, name):
+        """
+        :param name: name of the phase (see :attr:`PHASES`)
+        :return: context manager that adds its duration to the phase
+        """
+        if not self.enabled:
+            return self._null
+        return _Phase(self.seconds, name, self._active)
+
+    def save(self, path):
+        """
+        Saves the accumulated times as JSON.
+        :param path: path of the file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.seconds, f)
+
+
+class _Phase(object):
+    """
+    Measures one execution of a phase (see :meth:`PhaseTimer.phase`). The enclosing phase is paused while the phase is
+    active.
+    :param seconds: dict from the names of the phases to their accumulated times
+    :param name: name of the phase
+    :param active: stack of the active phases of the timer
+    """
+
+    def __init__(self, seconds, name, active):
+        self.seconds = seconds
+        self.name = name
+        self.active = active
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        if len(self.active) > 0:
+            self.active[-1]._stop(self.start)
+        self.active.append(self)
+        return self
+
+    def __exit__(self, *args):
+        now = timeit.default_timer()
+        self._stop(now)
+        self.active.pop()
+        if len(self.active) > 0:
+            self.active[-1].start = now
+        return False
+
+    def _stop(self, now):
+        """
+        Adds the time since the phase was entered or resumed to the phase.
+        :param now: the current time
+        """
+        self.seconds[self.name] += now - self.start
+        self.start = now
+
+
+class _NullPhase(object):
+    """
+    Phase of a disabled :class:`PhaseTimer`.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def profile_path(directory, worker):
+    """
+    :param directory: directory of the profiles
+    :param worker: number of the worker
+    :return: path of the cProfile dump of the worker
+    """
+    return os.path.join(directory, 'worker%i.prof' % worker)
+
+
+def phases_path(directory, worker):
+    """
+    :param directory: directory of the profiles
+    :param worker: number of the worker
+    :return: path of the phase times of the worker (see :class:`PhaseTimer`)
+    """
+    return os.path.join(directory, 'worker%i.phases.json' % worker)
+
+
+def _is_db_function(function):
+    """
+    Checks if a function of a profile belongs to the communication with the MongoDB, i.e., to pymongo, bson, or the
+    sockets.
+    :param function: tuple of the file, the line, and the name of the function
+    :return: true if the function belongs to the communication with the MongoDB
+    """
+    filename, _, name = function
+    for module in ('pymongo', 'bson', 'socket', 'ssl', 'selectors'):
+        if module in filename or module in name:
+            return True
+    return False
+
+
+def report_profiles(directory, workers, top=30):
+    """
+    Merges the profiles and the phase times of all workers into one report. The merged profile is written to
+    memeshark.prof and the report to report.txt in the directory. The report states whether the workers spent more
+    time waiting for the MongoDB or computing in Python. The profiles only cover the merging threads of the workers,
+    not the threads of the :class:`~memeshark.prefetch.Prefetcher`.
+    :param directory: directory of the profiles
+    :param workers: number of workers
+    :param top: number of functions of the report
+    """
+    logger = logging.getLogger("main")
+    stats = None
+    phases = dict.fromkeys(PhaseTimer.PHASES, 0.0)
+    for worker in range(0, workers):
+        path = profile_path(directory, worker)
+        if os.path.exists(path):
+            if stats is None:
+                stats = pstats.Stats(path, stream=io.StringIO())
+            else:
+                stats.add(path)
+        path = phases_path(directory, worker)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for phase, seconds in json.load(f).items():
+                    phases[phase] = phases.get(phase, 0.0) + seconds
+    if stats is None:
+        logger.warning("no profiles of the workers found in %s", directory)
+        return
+
+    stats.dump_stats(os.path.join(directory, 'memeshark.prof'))
+    total = sum(phases.values())
+    db_seconds = sum(phases[phase] for phase in PhaseTimer.DB_PHASES)
+    profile_total = sum(entry[2] for entry in stats.stats.values())
+    profile_db = sum(entry[2] for function, entry in stats.stats.items() if _is_db_function(function))
+
+    lines = ["phases of all workers:"]
+    for phase in PhaseTimer.PHASES:
+        lines.append("  %-10s %10.2f s %5.1f%%" % (phase, phases[phase], 100.0 * phases[phase] / total if total > 0
+                                                   else 0))
+    lines.append("time in pymongo, bson, and sockets: %0.2f of %0.2f s (%0.1f%%)" %
+                 (profile_db, profile_total, 100.0 * profile_db / profile_total if profile_total > 0 else 0))
+    verdict = "bound by the latency of the MongoDB" if db_seconds > total - db_seconds else "bound by Python CPU"
+    lines.append("verdict: %s (%0.1f%% of the merging waits for the MongoDB)" %
+                 (verdict, 100.0 * db_seconds / total if total > 0 else 0))
+    lines.append("note: cProfile covers only the merging thread of the workers; the reads ahead of the prefetch threads "
+                 "are not profiled and count only as the waits of the merging thread in the read phase")
+    for line in lines:
+        logger.info(line)
+
+    stats.stream = io.StringIO()
+    stats.sort_stats('cumulative').print_stats(top)
+    stats.sort_stats('tottime').print_stats(top)
+    report_path = os.path.join(directory, 'report.txt')
+    with open(report_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+        f.write(stats.stream.getvalue())
+    logger.info("merged profile written to %s", report_path)
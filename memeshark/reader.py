@@ -0,0 +1,87 @@
+import timeit
+
+from pycoshark.mongomodels import Commit, CodeEntityState
+
+
+class StateReader(object):
+    """
+    Reads commits and code entity states directly from the pymongo collections. The documents are returned as plain
+    dicts with the names of the fields in the database (e.g., _id instead of id) and only contain the fields that are
+    required for merging, i.e., no mongoengine documents are constructed.
+    :param batch_size: number of documents that are fetched per round-trip and maximal number of IDs per $in query
+    :param counters: the counters of the worker that record the round-trips (see
+        :class:`~memeshark.counters.WorkerCounters`; optional)
+    """
+
+    # fields that are neither required for the keys, the references, nor the fingerprints of code entity states
+    CES_PROJECTION = {'s_key': False, 'commit_id': False, 'cg_ids': False}
+
+    def __init__(self, batch_size=5000, counters=None):
+        self.batch_size = batch_size
+        self.counters = counters
+        self.commit_collection = Commit._get_collection()
+        self.ces_collection = CodeEntityState._get_collection()
+
+    def code_entity_state_ids(self, commit_id):
+        """
+        Fetches the IDs of the code entity states of a commit that were added by the memeSHARK.
+        :param commit_id: ID of the commit
+        :return: list of IDs; empty if the commit was not yet processed
+        """
+        start = timeit.default_timer()
+        commit = self.commit_collection.find_one({'_id': commit_id}, {'_id': False, 'code_entity_states': True})
+        if self.counters is not None:
+            self.counters.record('find_commits', timeit.default_timer() - start, int(commit is not None))
+        if commit is None:
+            return []
+        return commit.get('code_entity_states') or []
+
+    def ces_of_commit(self, commit_id):
+        """
+        Fetches all code entity states that were collected for a commit.
+        :param commit_id: ID of the commit
+        :return: iterable of dicts
+        """
+        return self._timed(self.ces_collection.find({'commit_id': commit_id}, self.CES_PROJECTION,
+                                                    batch_size=self.batch_size))
+
+    def ces_by_ids(self, ids):
+        """
+        Fetches code entity states by their IDs. Large lists of IDs are split into multiple $in queries.
+        :param ids: list of IDs
+        :return: iterable of dicts
+        """
+        for start in range(0, len(ids), self.batch_size):
+            for ces in self._timed(self.ces_collection.find({'_id': {'$in': ids[start:start + self.batch_size]}},
+                                                            self.CES_PROJECTION, batch_size=self.batch_size)):
+                yield ces
+
+    def _timed(self, cursor):
+        """
+        Records the time that is spent in the round-trips of a cursor of code entity states, i.e., without the time
+        that the caller spends between the documents. The round-trips are derived from the batch size.
+        :param cursor: the cursor
+        :return: iterable of dicts
+        """
+        if self.counters is None:
+            return cursor
+        return self._timed_documents(cursor)
+
+    def _timed_documents(self, cursor):
+        """
+        Generator of :meth:`_timed`.
+        :param cursor: the cursor
+        :return: iterable of dicts
+        """
+        elapsed = 0.0
+        documents = 0
+        iterator = iter(cursor)
+        while True:
+            start = timeit.default_timer()
+            ces = next(iterator, None)
+            elapsed += timeit.default_timer() - start
+            if ces is None:
+                break
+            documents += 1
+            yield ces
+        self.counters.record('find_ces', elapsed, documents, documents // self.batch_size + 1)
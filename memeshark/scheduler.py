@@ -0,0 +1,327 @@
+import heapq
+import logging
+import os
+import queue
+import timeit
+
+from memeshark.cache import remove_state
+
+
+def job_directory(work_dir, job):
+    """
+    :param work_dir: working directory that the coordinator shares with the workers
+    :param job: number of the job
+    :return: directory of the files of the job, i.e., the commit graph, the chains, the status of the commits, the
+        options of the job, and the cached states
+    """
+    return os.path.join(work_dir, 'job%i' % job)
+
+
+class WorkerError(Exception):
+    """
+    Exception that is thrown if a worker terminated before all tasks were finished
+    """
+    pass
+
+
+def estimate_makespan(chains, chain_weights, critical_paths, processes):
+    """
+    Estimates the makespan by simulating the scheduling of the chains with a given number of processes, i.e., the
+    longest remaining work is dispatched first and a worker continues with the first child of a finished chain.
+    :param chains: the chains (see :class:`~memeshark.graph.ChainPartition`), children sorted by critical path
+    :param chain_weights: weights of the chains
+    :param critical_paths: critical paths of the chains
+    :param processes: number of processes
+    :return: the estimated makespan in the unit of the weights
+    """
+    ready = [(-critical_paths[chain], chain) for chain in chains if chains.parent(chain) < 0]
+    heapq.heapify(ready)
+    running = []
+    idle = processes
+    now = 0.0
+    while len(ready) > 0 or len(running) > 0:
+        while idle > 0 and len(ready) > 0:
+            _, chain = heapq.heappop(ready)
+            heapq.heappush(running, (now + chain_weights[chain], chain))
+            idle -= 1
+        now, chain = heapq.heappop(running)
+        children = chains.children(chain)
+        if len(children) > 0:
+            heapq.heappush(running, (now + chain_weights[children[0]], children[0]))
+            for child in children[1:]:
+                heapq.heappush(ready, (-critical_paths[child], child))
+        else:
+            idle += 1
+    return now
+
+
+class Job(object):
+    """
+    The chains of one project that are scheduled and the progress of the project. The tasks of a job are tuples of the
+    number of the job and a chain.
+    :param number: number of the job
+    :param name: name of the project
+    :param commit_graph: the commit graph (see :class:`~memeshark.graph.CompactCommitGraph`)
+    :param chains: the chains of the commit graph that are the tasks (see :class:`~memeshark.graph.ChainPartition`)
+    :param critical_paths: critical paths of the chains that are used as priorities
+    :param no_commits: number of commits of the project, used for the progress
+    :param cache_directory: directory of the spill files of the :class:`~memeshark.cache.StateCache`, which are
+        removed once all branches of a fork are finished
+    :param journal: the :class:`~memeshark.journal.Journal` in which the finished chains are recorded (optional)
+    :param status: the :class:`~memeshark.graph.CommitStatus` with the numbers of code entity states that are used for
+        the progress (optional)
+    :param priority: priority of the job; the ready tasks of jobs with a lower priority are dispatched first
+    """
+
+    def __init__(self, number, name, commit_graph, chains, critical_paths, no_commits, cache_directory, journal=None,
+                 status=None, priority=0):
+        self.number = number
+        self.name = name
+        self.commit_graph = commit_graph
+        self.chains = chains
+        self.critical_paths = critical_paths
+        self.no_commits = no_commits
+        self.cache_directory = cache_directory
+        self.journal = journal
+        self.status = status if status is not None and status.has_ces_counts() else None
+        self.priority = priority
+        self.no_ces = 0
+        if self.status is not None:
+            self.no_ces = sum(self.status.ces_count(node) for chain in chains for node in chains.nodes(chain))
+        self.processed_ces = 0
+        self.processed_commits = 0
+        self.failed_tasks = 0
+        self.ces_deleted = 0
+        self.ces_total = 0
+        self.consumers = {}
+        self.outstanding = 0
+        self.start_time = None
+        self.run_time = 0.0
+
+
+class Scheduler(object):
+    """
+    Dispatches tasks to the workers and tracks their completion. The workers report the tasks that they spawn as well
+    as every finished task through the result queue. Tasks are only dispatched if a worker is idle, and the ready task
+    of the job with the lowest priority and the longest critical path is dispatched first, such that the workers
+    continue with the tasks of other jobs if a job has no ready tasks. A job is finished once none of its tasks is
+    outstanding anymore. The scheduler knows that all jobs are exhausted once no task is outstanding and no job can be
+    added anymore, sends one sentinel (None) per worker, and collects the statistics that the workers return when they
+    exit.
+    :param workers: the worker processes
+    :param task_queue: queue from which the workers take their tasks
+    :param result_queue: queue through which the workers report to the scheduler
+    :param on_finished: function that is called with every finished :class:`Job` (optional)
+    """
+
+    # time in seconds after which the scheduler checks if the workers are still alive while it waits for results
+    LIVENESS_INTERVAL = 5
+
+    # time in seconds after which the scheduler checks for new jobs while workers are idle
+    JOB_INTERVAL = 0.1
+
+    def __init__(self, workers, task_queue, result_queue, on_finished=None):
+        self.logger = logging.getLogger("main")
+        self.workers = workers
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.on_finished = on_finished
+        self.jobs = {}
+        self.ready = []
+        self.pending = 0
+        self.processed_commits = 0
+        self.failed_tasks = 0
+        self.ces_deleted = 0
+        self.ces_total = 0
+        self._finished = set()
+
+    def add(self, job, tasks):
+        """
+        Adds a job with its initial tasks.
+        :param job: the :class:`Job`
+        :param tasks: the initial chains of the job
+        """
+        if job.status is not None:
+            self.logger.info("project %s: %i code entity states of %i commits to process", job.name, job.no_ces,
+                             job.no_commits)
+        self.jobs[job.number] = job
+        job.start_time = timeit.default_timer()
+        for chain in tasks:
+            self._add((job.number, chain))
+        if len(tasks) == 0:
+            self._job_finished(job)
+
+    def run(self, jobs=None):
+        """
+        Dispatches the tasks of the jobs and all tasks that are spawned by the workers until all jobs are finished.
+        Afterwards, the workers are shut down.
+        :param jobs: queue through which further jobs are added as tuples of the :class:`Job` and its initial tasks
+            while the scheduler runs; None marks the end of the jobs (optional)
+        """
+        jobs_open = jobs is not None
+        self._dispatch()
+        while jobs_open or self.pending > 0 or len(self.ready) > 0:
+            while jobs_open:
+                # new jobs are only awaited if the workers are idle
+                try:
+                    block = self.pending == 0 and len(self.ready) == 0
+                    added = jobs.get(block=block, timeout=self.LIVENESS_INTERVAL if block else None)
+                except queue.Empty:
+                    if block:
+                        self._check_workers()
+                        continue
+                    break
+                if added is None:
+                    jobs_open = False
+                else:
+                    self.add(*added)
+                    self._dispatch()
+            if self.pending == 0 and len(self.ready) == 0:
+                continue
+
+            idle = jobs_open and self.pending < len(self.workers)
+            message = self._receive(self.JOB_INTERVAL if idle else self.LIVENESS_INTERVAL, not idle)
+            if message is None:
+                continue
+            if message[0] == 'spawned':
+                _, number, job_number, spawned, finished = message
+                job = self.jobs[job_number]
+                self._record(job, finished)
+                job.consumers[job.chains.parent(spawned[0])] = len(spawned)
+                for spawned_task in spawned:
+                    self._add((job_number, spawned_task))
+            elif message[0] == 'done':
+                _, number, task, commits, finished, ces_deleted, ces_total = message
+                job = self.jobs[task[0]]
+                self._record(job, finished)
+                self.pending -= 1
+                self.processed_commits += commits
+                job.processed_commits += commits
+                job.ces_deleted += ces_deleted
+                job.ces_total += ces_total
+                if job.status is not None:
+                    self.logger.info("worker%i finished task for commit id %s of project %s (%i / %i commits, %i / %i "
+                                     "code entity states processed)", number,
+                                     job.commit_graph.node_id(job.chains.head(task[1])), job.name,
+                                     job.processed_commits, job.no_commits, job.processed_ces, job.no_ces)
+                else:
+                    self.logger.info("worker%i finished task for commit id %s of project %s (%i / %i commits "
+                                     "processed)", number, job.commit_graph.node_id(job.chains.head(task[1])),
+                                     job.name, job.processed_commits, job.no_commits)
+            elif message[0] == 'failed':
+                _, number, task, error, ces_deleted, ces_total = message
+                job = self.jobs[task[0]]
+                self.pending -= 1
+                self.failed_tasks += 1
+                job.failed_tasks += 1
+                job.ces_deleted += ces_deleted
+                job.ces_total += ces_total
+                self.logger.error("worker%i failed to process task for commit id %s of project %s: %s", number,
+                                  job.commit_graph.node_id(job.chains.head(task[1])), job.name, error)
+            if message[0] in ('done', 'failed'):
+                self._consumed(message[2])
+            self._dispatch()
+
+        self.logger.info("all tasks finished, shutting down workers")
+        for _ in self.workers:
+            self.task_queue.put(None)
+        while len(self._finished) < len(self.workers):
+            message = self._receive(self.LIVENESS_INTERVAL)
+            if message[0] == 'stats':
+                _, number, ces_deleted, ces_total = message
+                self.ces_deleted += ces_deleted
+                self.ces_total += ces_total
+                self._finished.add(number)
+        for worker in self.workers:
+            worker.join()
+
+    def _record(self, job, finished):
+        """
+        Records chains whose writes are flushed in the journal and in the progress.
+        :param job: the job of the chains
+        :param finished: list of tuples of the chains and the digests of their last states
+        """
+        for chain, digest in finished:
+            if job.status is not None:
+                job.processed_ces += sum(job.status.ces_count(node) for node in job.chains.nodes(chain))
+            if job.journal is None:
+                continue
+            job.journal.record(job.commit_graph.node_id(job.chains.head(chain)),
+                               job.commit_graph.node_id(job.chains.tail(chain)), job.chains.length(chain), digest)
+
+    def _consumed(self, task):
+        """
+        Removes the cached state of the fork before a task once all branches of the fork are finished and finishes the
+        job of the task once none of its tasks is outstanding anymore.
+        :param task: the finished task
+        """
+        job = self.jobs[task[0]]
+        self._release_fork(job, task[1])
+        job.outstanding -= 1
+        if job.outstanding == 0:
+            self._job_finished(job)
+
+    def _release_fork(self, job, chain):
+        """
+        Removes the cached state of the fork before a finished branch once all branches of the fork are finished.
+        :param job: the job of the branch
+        :param chain: the chain of the finished branch
+        """
+        parent = job.chains.parent(chain)
+        if parent in job.consumers:
+            job.consumers[parent] -= 1
+            if job.consumers[parent] == 0:
+                del job.consumers[parent]
+                remove_state(job.cache_directory, job.commit_graph.node_id(job.chains.tail(parent)))
+
+    def _job_finished(self, job):
+        """
+        Removes a finished job.
+        :param job: the job
+        """
+        job.run_time = timeit.default_timer() - job.start_time
+        del self.jobs[job.number]
+        if self.on_finished is not None:
+            self.on_finished(job)
+
+    def _add(self, task):
+        """
+        Adds a task to the ready tasks.
+        :param task: the task
+        """
+        job = self.jobs[task[0]]
+        job.outstanding += 1
+        heapq.heappush(self.ready, (job.priority, -job.critical_paths[task[1]], task))
+
+    def _dispatch(self):
+        """
+        Hands the ready tasks with the highest priorities to the idle workers.
+        """
+        while self.pending < len(self.workers) and len(self.ready) > 0:
+            _, _, task = heapq.heappop(self.ready)
+            self.pending += 1
+            self.task_queue.put(task)
+
+    def _receive(self, timeout, wait=True):
+        """
+        Waits for the next message of a worker.
+        :param timeout: time in seconds after which the workers are checked
+        :param wait: if false, None is returned if no message arrived within the timeout
+        :return: the message
+        """
+        while True:
+            try:
+                return self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                self._check_workers()
+                if not wait:
+                    return None
+
+    def _check_workers(self):
+        """
+        Checks if a worker terminated before it was told to exit.
+        """
+        for worker in self.workers:
+            if worker.number not in self._finished and worker.exitcode is not None:
+                raise WorkerError('worker %s terminated unexpectedly with exit code %s' %
+                                  (worker.name, worker.exitcode))
@@ -0,0 +1,41 @@
+from collections import namedtuple
+
+# compact state of a code entity that is kept to compare the code entity with its next state; the state of a commit is
+# a dict from the integer keys of the code entities (see KeyTable) to their CESState
+CESState = namedtuple('CESState', ['fingerprint', 'id', 'parent_id'])
+
+
+class KeyTable(object):
+    """
+    Run-wide table that interns the keys of code entities, i.e., it maps (long_name, file_id) to a small integer once.
+    The states of the commits are dicts that are indexed by these integers, such that the keys are neither rebuilt nor
+    stored again for every commit.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def intern(self, long_name, file_id):
+        """
+        :param long_name: long name of the code entity
+        :param file_id: ID of the file of the code entity
+        :return: the integer key of the code entity
+        """
+        key = (long_name, file_id)
+        index = self._index.get(key)
+        if index is None:
+            index = len(self._keys)
+            self._index[key] = index
+            self._keys.append(key)
+        return index
+
+    def key(self, index):
+        """
+        :param index: integer key of a code entity
+        :return: tuple of the long name and the file ID of the code entity
+        """
+        return self._keys[index]
@@ -0,0 +1,428 @@
+from abc import ABC, abstractmethod
+
+import bson
+from mongoengine import connect, disconnect
+from pycoshark.mongomodels import CodeEntityState, Commit, Project, VCSSystem
+
+from memeshark.profiling import PhaseTimer
+from memeshark.reader import StateReader
+from memeshark.writer import WriteBuffer
+
+
+class Storage(ABC):
+    """
+    Storage of the commits and code entity states that the workers merge. A storage creates the readers and the write
+    buffers of a worker, such that the merging of :class:`~memeshark.memeshark.MemeSHARKWorker` is independent of
+    where the documents are stored. The readers have the interface of the :class:`~memeshark.reader.StateReader` and
+    the write buffers the interface of the :class:`~memeshark.writer.WriteBuffer`. A storage without one of the
+    abstract methods cannot be created.
+    """
+
+    def connect(self):
+        """
+        Connects to the storage in the current process.
+        """
+        pass
+
+    def close(self):
+        """
+        Closes the connection of the current process, e.g., before the worker processes are forked.
+        """
+        pass
+
+    @abstractmethod
+    def reader(self, batch_size=5000, counters=None):
+        """
+        :param batch_size: number of documents that are fetched per round-trip
+        :param counters: the counters of the worker that record the round-trips (see
+            :class:`~memeshark.counters.WorkerCounters`; optional)
+        :return: a reader of the code entity states
+        """
+        pass
+
+    @abstractmethod
+    def writer(self, max_operations=1000, max_delay=5.0, counters=None, guard=None, phases=None):
+        """
+        :param max_operations: number of buffered operations after which the buffer is flushed
+        :param max_delay: time in seconds after which the buffer is flushed
+        :param counters: the counters of the worker that record the writes (see
+            :class:`~memeshark.counters.WorkerCounters`; optional)
+        :param guard: function that is called before buffered operations are written (optional)
+        :param phases: the :class:`~memeshark.profiling.PhaseTimer` of the worker, which measures the deletes
+            (optional)
+        :return: a buffer for the writes
+        """
+        pass
+
+    @abstractmethod
+    def processed_commits(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: the IDs of the commits that have code entity states, i.e., were already processed
+        """
+        pass
+
+
+class ProjectStorage(Storage):
+    """
+    Storage that also has the projects and their VCS systems, from which the :class:`~memeshark.memeshark.MemeSHARK`
+    selects the projects and builds the commit graphs of its jobs.
+    """
+
+    @abstractmethod
+    def project_names(self):
+        """
+        :return: the names of all projects
+        """
+        pass
+
+    @abstractmethod
+    def vcs_system_ids(self, project_name):
+        """
+        :param project_name: name of a project
+        :return: the IDs of the VCS systems of the project; None if the project does not exist
+        """
+        pass
+
+    @abstractmethod
+    def unprocessed_commits(self, vcs_system_id):
+        """
+        :param vcs_system_id: ID of a VCS system
+        :return: the number of commits of the VCS system that do not have code entity states
+        """
+        pass
+
+    @abstractmethod
+    def graph_commits(self, vcs_system_id, batch_size=10000):
+        """
+        Streams the commits of a VCS system for the commit graph.
+        :param vcs_system_id: ID of the VCS system
+        :param batch_size: number of commits that are fetched per round-trip
+        :return: iterable of dicts with the keys _id, revision_hash, parents, and processed, which is true if the commit
+            has code entity states
+        """
+        pass
+
+    @abstractmethod
+    def count_ces(self, commit_ids):
+        """
+        Counts the code entity states that were collected for commits.
+        :param commit_ids: list of IDs of commits
+        :return: dict from the IDs of the commits to their numbers of code entity states; commits without code entity
+            states may be missing
+        :raises OperationFailure: if the code entity states cannot be counted
+        """
+        pass
+
+    @abstractmethod
+    def average_ces_size(self):
+        """
+        :return: the average size of the code entity states in bytes; None if there are no code entity states
+        :raises OperationFailure: if the size cannot be determined
+        """
+        pass
+
+
+class MongoStorage(ProjectStorage):
+    """
+    Stores the commits and code entity states in the collections of the MongoDB.
+    :param database: name of the MongoDB
+    :param uri: URI of the MongoDB
+    :param write_concern: write concern (w) of the bulk writes
+    """
+
+    def __init__(self, database, uri, write_concern=1):
+        self.database = database
+        self.uri = uri
+        self.write_concern = write_concern
+
+    def connect(self):
+        """
+        Connects the default alias of mongoengine to the MongoDB.
+        """
+        connect(self.database, host=self.uri, alias='default')
+
+    def close(self):
+        """
+        Closes the connection of the default alias of mongoengine, which must not be shared with forked processes.
+        """
+        disconnect(alias='default')
+
+    def reader(self, batch_size=5000, counters=None):
+        """
+        :return: a :class:`~memeshark.reader.StateReader`
+        """
+        return StateReader(batch_size, counters)
+
+    def writer(self, max_operations=1000, max_delay=5.0, counters=None, guard=None, phases=None):
+        """
+        :return: a :class:`~memeshark.writer.WriteBuffer`
+        """
+        return WriteBuffer(max_operations, max_delay, self.write_concern, counters, guard, phases)
+
+    def processed_commits(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: the IDs of the commits that have code entity states
+        """
+        return [commit['_id'] for commit in Commit._get_collection().find(
+            {'_id': {'$in': commit_ids}, 'code_entity_states.0': {'$exists': True}}, {'_id': 1})]
+
+    def project_names(self):
+        """
+        :return: the names of all projects
+        """
+        return [project.name for project in Project.objects.only('name')]
+
+    def vcs_system_ids(self, project_name):
+        """
+        :param project_name: name of a project
+        :return: the IDs of the VCS systems of the project; None if the project does not exist
+        """
+        project = Project.objects(name=project_name).only('id').first()
+        if project is None:
+            return None
+        return [vcs_system.id for vcs_system in VCSSystem.objects(project_id=project.id).only('id')]
+
+    def unprocessed_commits(self, vcs_system_id):
+        """
+        :param vcs_system_id: ID of a VCS system
+        :return: the number of commits of the VCS system that do not have code entity states
+        """
+        return Commit._get_collection().count_documents({'vcs_system_id': vcs_system_id,
+                                                         'code_entity_states.0': {'$exists': False}})
+
+    def graph_commits(self, vcs_system_id, batch_size=10000):
+        """
+        Streams the commits of a VCS system with a single projected cursor, which also determines which commits were
+        already processed.
+        :param vcs_system_id: ID of the VCS system
+        :param batch_size: number of commits that are fetched per round-trip
+        :return: iterable of dicts with the keys _id, revision_hash, parents, and processed
+        """
+        cursor = Commit._get_collection().aggregate([
+            {'$match': {'vcs_system_id': vcs_system_id}},
+            {'$project': {'revision_hash': 1, 'parents': 1,
+                          'processed': {'$gt': [{'$size': {'$ifNull': ['$code_entity_states', []]}}, 0]}}}],
+            allowDiskUse=True, batchSize=batch_size)
+        try:
+            for commit in cursor:
+                yield commit
+        finally:
+            cursor.close()
+
+    def count_ces(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: dict from the IDs of the commits to their numbers of code entity states
+        """
+        return {result['_id']: result['count'] for result in CodeEntityState._get_collection().aggregate([
+            {'$match': {'commit_id': {'$in': commit_ids}}},
+            {'$group': {'_id': '$commit_id', 'count': {'$sum': 1}}}])}
+
+    def average_ces_size(self):
+        """
+        :return: the average size of the code entity states in bytes from the statistics of the collection
+        """
+        collection = CodeEntityState._get_collection()
+        return collection.database.command('collStats', collection.name).get('avgObjSize')
+
+
+class MemoryStorage(ProjectStorage):
+    """
+    Stores the commits and code entity states in dicts of the current process, e.g., to benchmark the merging without
+    the round-trips to a MongoDB. The writes are applied immediately and the documents are only visible to workers that
+    run in the same process (see :class:`~memeshark.offline.OfflineWorker`). The reads are not recorded in the counters.
+    :param commits: iterable of the commits as dicts
+    :param code_entity_states: iterable of the code entity states as dicts
+    :param projects: iterable of the projects as dicts
+    :param vcs_systems: iterable of the VCS systems as dicts
+    """
+
+    def __init__(self, commits=(), code_entity_states=(), projects=(), vcs_systems=()):
+        self.projects = list(projects)
+        self.vcs_systems = list(vcs_systems)
+        self.commits = {}
+        self.code_entity_states = {}
+        self._ces_of_commit = {}
+        for commit in commits:
+            self.commits[commit['_id']] = commit
+        for ces in code_entity_states:
+            self.code_entity_states[ces['_id']] = ces
+            self._ces_of_commit.setdefault(ces['commit_id'], []).append(ces['_id'])
+
+    def reader(self, batch_size=5000, counters=None):
+        """
+        :return: a :class:`MemoryReader`
+        """
+        return MemoryReader(self)
+
+    def writer(self, max_operations=1000, max_delay=5.0, counters=None, guard=None, phases=None):
+        """
+        :return: a :class:`MemoryWriter`
+        """
+        return MemoryWriter(self, phases)
+
+    def processed_commits(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: the IDs of the commits that have code entity states
+        """
+        return [commit_id for commit_id in commit_ids
+                if len(self.commits.get(commit_id, {}).get('code_entity_states') or []) > 0]
+
+    def project_names(self):
+        """
+        :return: the names of all projects
+        """
+        return [project['name'] for project in self.projects]
+
+    def vcs_system_ids(self, project_name):
+        """
+        :param project_name: name of a project
+        :return: the IDs of the VCS systems of the project; None if the project does not exist
+        """
+        project_ids = [project['_id'] for project in self.projects if project['name'] == project_name]
+        if len(project_ids) == 0:
+            return None
+        return [vcs_system['_id'] for vcs_system in self.vcs_systems if vcs_system['project_id'] == project_ids[0]]
+
+    def unprocessed_commits(self, vcs_system_id):
+        """
+        :param vcs_system_id: ID of a VCS system
+        :return: the number of commits of the VCS system that do not have code entity states
+        """
+        return sum(1 for commit in self.commits.values() if commit.get('vcs_system_id') == vcs_system_id and
+                   len(commit.get('code_entity_states') or []) == 0)
+
+    def graph_commits(self, vcs_system_id, batch_size=10000):
+        """
+        :param vcs_system_id: ID of the VCS system
+        :param batch_size: not used
+        :return: list of dicts with the keys _id, revision_hash, parents, and processed
+        """
+        return [{'_id': commit['_id'], 'revision_hash': commit['revision_hash'], 'parents': commit['parents'],
+                 'processed': len(commit.get('code_entity_states') or []) > 0}
+                for commit in self.commits.values() if commit.get('vcs_system_id') == vcs_system_id]
+
+    def count_ces(self, commit_ids):
+        """
+        :param commit_ids: list of IDs of commits
+        :return: dict from the IDs of the commits to their numbers of code entity states
+        """
+        return {commit_id: len(self.ces_ids_of_commit(commit_id)) for commit_id in commit_ids}
+
+    def average_ces_size(self):
+        """
+        :return: the average size of the BSON documents of the code entity states in bytes; None if there are none
+        """
+        if len(self.code_entity_states) == 0:
+            return None
+        return sum(len(bson.encode(ces)) for ces in self.code_entity_states.values()) / len(self.code_entity_states)
+
+    def ces_ids_of_commit(self, commit_id):
+        """
+        :param commit_id: ID of a commit
+        :return: the IDs of the code entity states that were collected for the commit and are not deleted
+        """
+        return [ces_id for ces_id in self._ces_of_commit.get(commit_id, ()) if ces_id in self.code_entity_states]
+
+
+class MemoryReader(object):
+    """
+    Reads the code entity states of a :class:`MemoryStorage` like the :class:`~memeshark.reader.StateReader`, i.e., as
+    dicts without the fields that are not required for merging.
+    :param storage: the :class:`MemoryStorage`
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def code_entity_state_ids(self, commit_id):
+        """
+        Returns the IDs of the code entity states of a commit that were added by the memeSHARK.
+        :param commit_id: ID of the commit
+        :return: list of IDs; empty if the commit was not yet processed
+        """
+        commit = self.storage.commits.get(commit_id)
+        if commit is None:
+            return []
+        return list(commit.get('code_entity_states') or [])
+
+    def ces_of_commit(self, commit_id):
+        """
+        Returns all code entity states that were collected for a commit.
+        :param commit_id: ID of the commit
+        :return: iterable of dicts
+        """
+        for ces_id in self.storage.ces_ids_of_commit(commit_id):
+            yield self._project(self.storage.code_entity_states[ces_id])
+
+    def ces_by_ids(self, ids):
+        """
+        Returns code entity states by their IDs.
+        :param ids: list of IDs
+        :return: iterable of dicts
+        """
+        for ces_id in ids:
+            ces = self.storage.code_entity_states.get(ces_id)
+            if ces is not None:
+                yield self._project(ces)
+
+    def _project(self, ces):
+        """
+        :param ces: a stored code entity state
+        :return: a copy of the code entity state without the fields of :attr:`StateReader.CES_PROJECTION`
+        """
+        return {field: value for field, value in ces.items() if field not in StateReader.CES_PROJECTION}
+
+
+class MemoryWriter(object):
+    """
+    Applies the writes of a worker to a :class:`MemoryStorage` with the interface of the
+    :class:`~memeshark.writer.WriteBuffer`. Nothing is buffered, i.e., :meth:`flush` does nothing.
+    :param storage: the :class:`MemoryStorage`
+    :param phases: the :class:`~memeshark.profiling.PhaseTimer` of the worker, which measures the deletes (optional)
+    """
+
+    def __init__(self, storage, phases=None):
+        self.storage = storage
+        self.phases = phases if phases is not None else PhaseTimer(False)
+
+    def __len__(self):
+        return 0
+
+    def set_code_entity_states(self, commit_id, ces_ids):
+        """
+        Sets the list of current code entity states of a commit.
+        :param commit_id: ID of the commit
+        :param ces_ids: IDs of the code entity states
+        """
+        commit = self.storage.commits.get(commit_id)
+        if commit is not None:
+            commit['code_entity_states'] = list(ces_ids)
+
+    def set_parent(self, ces_id, parent_id):
+        """
+        Sets the parent of a code entity state.
+        :param ces_id: ID of the code entity state
+        :param parent_id: ID of the new parent
+        """
+        ces = self.storage.code_entity_states.get(ces_id)
+        if ces is not None:
+            ces['ce_parent_id'] = parent_id
+
+    def delete_ces(self, ces_ids):
+        """
+        Deletes code entity states.
+        :param ces_ids: IDs of the code entity states
+        """
+        with self.phases.phase('delete'):
+            for ces_id in ces_ids:
+                self.storage.code_entity_states.pop(ces_id, None)
+
+    def flush(self):
+        """
+        Does nothing, the writes are already applied.
+        """
+        pass
@@ -0,0 +1,112 @@
+import timeit
+
+from pycoshark.mongomodels import Commit, CodeEntityState
+from pymongo import UpdateOne, DeleteMany
+from pymongo.write_concern import WriteConcern
+
+from memeshark.profiling import PhaseTimer
+
+
+class WriteBuffer(object):
+    """
+    Collects the writes of a worker and sends them to the MongoDB as unordered bulk writes. The buffer is flushed if
+    it contains a given number of operations or if the oldest buffered operation is older than a given delay. All
+    buffered writes must be flushed with :meth:`flush` before other processes rely on them.
+    :param max_operations: number of buffered operations after which the buffer is flushed
+    :param max_delay: time in seconds after which the buffer is flushed
+    :param write_concern: write concern (w) that is used for the bulk writes, e.g., 1 or 'majority'
+    :param counters: the counters of the worker that record the bulk writes (see
+        :class:`~memeshark.counters.WorkerCounters`; optional)
+    :param guard: function that is called before the buffered operations are sent and raises an exception if they
+        must not be sent, e.g., because the worker lost the lease of its task in a distributed run (optional)
+    :param phases: the :class:`~memeshark.profiling.PhaseTimer` of the worker, which measures the bulk deletes as the
+        deleting phase (optional)
+    """
+
+    # maximal number of IDs per DeleteMany operation
+    MAX_DELETE_IDS = 10000
+
+    def __init__(self, max_operations=1000, max_delay=5.0, write_concern=1, counters=None, guard=None, phases=None):
+        self.max_operations = max_operations
+        self.counters = counters
+        self.guard = guard
+        self.phases = phases if phases is not None else PhaseTimer(False)
+        self.max_delay = max_delay
+        write_concern = WriteConcern(w=write_concern)
+        self.commit_collection = Commit._get_collection().with_options(write_concern=write_concern)
+        self.ces_collection = CodeEntityState._get_collection().with_options(write_concern=write_concern)
+        self._commit_operations = []
+        self._ces_operations = []
+        self._delete_operations = []
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._commit_operations) + len(self._ces_operations) + len(self._delete_operations)
+
+    def set_code_entity_states(self, commit_id, ces_ids):
+        """
+        Sets the list of current code entity states of a commit.
+        :param commit_id: ID of the commit
+        :param ces_ids: IDs of the code entity states
+        """
+        self._commit_operations.append(UpdateOne({'_id': commit_id}, {'$set': {'code_entity_states': ces_ids}}))
+        self._added()
+
+    def set_parent(self, ces_id, parent_id):
+        """
+        Sets the parent of a code entity state.
+        :param ces_id: ID of the code entity state
+        :param parent_id: ID of the new parent
+        """
+        self._ces_operations.append(UpdateOne({'_id': ces_id}, {'$set': {'ce_parent_id': parent_id}}))
+        self._added()
+
+    def delete_ces(self, ces_ids):
+        """
+        Deletes code entity states.
+        :param ces_ids: IDs of the code entity states
+        """
+        for start in range(0, len(ces_ids), self.MAX_DELETE_IDS):
+            self._delete_operations.append(DeleteMany({'_id': {'$in': ces_ids[start:start + self.MAX_DELETE_IDS]}}))
+            self._added()
+
+    def flush(self):
+        """
+        Sends all buffered operations to the MongoDB. The deletes are sent as a separate bulk write after the updates of
+        the code entity states, such that they are measured as their own phase.
+        """
+        if self.guard is not None and len(self) > 0:
+            self.guard()
+        if len(self._commit_operations) > 0:
+            self._bulk_write('write_commits', self.commit_collection, self._commit_operations)
+            self._commit_operations = []
+        if len(self._ces_operations) > 0:
+            self._bulk_write('write_ces', self.ces_collection, self._ces_operations)
+            self._ces_operations = []
+        if len(self._delete_operations) > 0:
+            with self.phases.phase('delete'):
+                self._bulk_write('write_ces', self.ces_collection, self._delete_operations)
+            self._delete_operations = []
+        self._oldest = None
+
+    def _bulk_write(self, operation, collection, operations):
+        """
+        Sends operations as one unordered bulk write and records it in the counters.
+        :param operation: name of the operation for the counters
+        :param collection: the collection
+        :param operations: the operations
+        """
+        start = timeit.default_timer()
+        collection.bulk_write(operations, ordered=False)
+        if self.counters is not None:
+            self.counters.record(operation, timeit.default_timer() - start, len(operations))
+
+    def _added(self):
+        """
+        Flushes the buffer if one of the thresholds is reached.
+        """
+        now = timeit.default_timer()
+        if self._oldest is None:
+            self._oldest = now
+        if len(self) >= self.max_operations or now - self._oldest >= self.max_delay:
+            self.flush()
@@ -14,7 +14,8 @@ setup(
     author='Steffen Herbold',
     author_email='herbold@cs.uni-goettingen.de',
     description='Condense code entities to remove duplicates',
-    install_requires=['mongoengine', 'pymongo', 'pycoshark>=1.2.6', 'networkx>=2.0', 'dictdiffer'],
+    install_requires=['mongoengine', 'pymongo', 'pycoshark>=1.2.6', 'dictdiffer'],
+    extras_require={'numpy': ['numpy']},
     url='https://github.com/smartshark/memeSHARK',
     download_url='https://github.com/smartshark/memeSHARK/zipball/master',
     packages=find_packages(),
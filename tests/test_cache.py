@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bson import ObjectId
+
+from memeshark.cache import state_path, StateCache
+from memeshark.graph import ChainPartition, CompactCommitGraph
+from memeshark.scheduler import Job, Scheduler
+from memeshark.state import CESState, KeyTable
+
+
+class StateCacheTest(unittest.TestCase):
+    """
+    Tests the memory budget, the spill files, and the consumers of the states of a
+    :class:`~memeshark.cache.StateCache`.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.keys = KeyTable()
+        self.file_id = ObjectId()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _state(self, size, keys=None):
+        """
+        :param size: number of code entity states
+        :param keys: the :class:`~memeshark.state.KeyTable` in which the keys are interned (optional)
+        :return: a state with new code entity states; the first one has no parent
+        """
+        keys = keys if keys is not None else self.keys
+        state = {}
+        for number in range(size):
+            key = keys.intern('fä.C%i' % number, self.file_id)
+            state[key] = CESState(bytes([number]) * 16, ObjectId(), ObjectId() if number > 0 else None)
+        return state
+
+    def _named(self, state, keys=None):
+        """
+        :return: the state with the long names and file IDs instead of the integer keys
+        """
+        keys = keys if keys is not None else self.keys
+        return {keys.key(key): ces_state for key, ces_state in state.items()}
+
+    def test_lru_eviction(self):
+        cache = StateCache(self.directory, 2 * 2 * StateCache.ENTRY_SIZE, self.keys)
+        a, b, c = ObjectId(), ObjectId(), ObjectId()
+        states = {a: self._state(2), b: self._state(2), c: self._state(2)}
+        cache.put(a, states[a], 2)
+        cache.put(b, states[b], 2)
+        self.assertEqual(cache.memory_used, 4 * StateCache.ENTRY_SIZE)
+        # the state of a is used, such that the state of b is the least recently used one
+        self.assertIs(cache.get(a), states[a])
+        cache.put(c, states[c], 2)
+        self.assertEqual(list(cache._states), [a, c])
+        self.assertEqual(cache.memory_used, 4 * StateCache.ENTRY_SIZE)
+        # the evicted state is read from its spill file
+        evicted = cache.get(b)
+        self.assertIsNot(evicted, states[b])
+        self.assertEqual(evicted, states[b])
+        self.assertIs(cache.get(c), states[c])
+
+    def test_state_larger_than_budget_is_only_spilled(self):
+        cache = StateCache(self.directory, StateCache.ENTRY_SIZE, self.keys)
+        commit_id = ObjectId()
+        state = self._state(2)
+        cache.put(commit_id, state, 1)
+        self.assertEqual(len(cache._states), 0)
+        self.assertEqual(cache.memory_used, 0)
+        self.assertTrue(os.path.exists(state_path(self.directory, commit_id)))
+        self.assertEqual(cache.get(commit_id), state)
+
+    def test_spill_file_round_trip(self):
+        cache = StateCache(self.directory, 0, self.keys)
+        commit_id = ObjectId()
+        state = self._state(5)
+        cache.put(commit_id, state, 2)
+        self.assertEqual(cache.get(commit_id), state)
+        # a worker that steals a branch has its own keys
+        other_keys = KeyTable()
+        other_keys.intern('g.D', ObjectId())
+        stolen = StateCache(self.directory, 1024 * 1024, other_keys).get(commit_id)
+        self.assertEqual(self._named(stolen, other_keys), self._named(state))
+        self.assertIsNone(StateCache(self.directory, 0, KeyTable()).get(ObjectId()))
+
+    def test_consumers(self):
+        cache = StateCache(self.directory, 1024 * 1024, self.keys)
+        commit_id = ObjectId()
+        state = self._state(3)
+        cache.put(commit_id, state, 3)
+        for _ in range(3):
+            self.assertIn(commit_id, cache._states)
+            self.assertIs(cache.get(commit_id), state)
+        # the last consumer releases the memory, the spill file remains for the workers that steal branches
+        self.assertNotIn(commit_id, cache._states)
+        self.assertEqual(cache.memory_used, 0)
+        self.assertEqual(cache.get(commit_id), state)
+
+
+class ReleaseForkTest(unittest.TestCase):
+    """
+    Tests that the :class:`~memeshark.scheduler.Scheduler` removes the spill file of a fork once all its branches are
+    finished.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_release_fork(self):
+        # a - b - c
+        #      \
+        #       d
+        #      \
+        #       e
+        parents = {'a': '', 'b': 'a', 'c': 'b', 'd': 'b', 'e': 'b'}
+        commits = [{'_id': ObjectId(), 'revision_hash': revision_hash, 'parents': list(parents[revision_hash])}
+                   for revision_hash in 'abcde']
+        commit_graph, _ = CompactCommitGraph.from_commits(commits)
+        chains = ChainPartition.from_graph(commit_graph)
+        job = Job(0, 'p', commit_graph, chains, [1] * len(chains), len(commits), self.directory)
+        fork = [chain for chain in chains if chains.parent(chain) < 0][0]
+        branches = list(chains.children(fork))
+        self.assertEqual(len(branches), 3)
+        keys = KeyTable()
+        StateCache(self.directory, 0, keys).put(commits[1]['_id'], {keys.intern('f', ObjectId()): CESState(
+            bytes(16), ObjectId(), None)}, len(branches) - 1)
+        path = state_path(self.directory, commits[1]['_id'])
+
+        # the worker that finishes the fork continues with the first branch and spawns the others, its task does not
+        # consume the cached state
+        scheduler = Scheduler([], None, None)
+        job.consumers[fork] = len(branches) - 1
+        scheduler._release_fork(job, fork)
+        scheduler._release_fork(job, branches[1])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(job.consumers, {fork: 1})
+        scheduler._release_fork(job, branches[2])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(job.consumers, {})
@@ -0,0 +1,158 @@
+import collections
+import math
+import random
+import unittest
+
+from bson import ObjectId
+
+from benchmark import generate_history
+from consistency_checker import normal_quantile, sample_commits, stratified_upper_bound, wilson_upper_bound
+from tests.test_graph import commits_of, FORK_AND_MERGE
+
+
+class CommitCollection(object):
+    """
+    Collection of commits with the two queries of :func:`~consistency_checker.sample_commits`, i.e., the verbose
+    commits are found with their parents and the condensed commits are aggregated to their numbers of code entity
+    states.
+    :param commits: the commits as dicts
+    """
+
+    def __init__(self, commits):
+        self.commits = commits
+
+    def find(self, query, projection=None):
+        return [commit for commit in self.commits if commit['vcs_system_id'] == query['vcs_system_id']]
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        vcs_system_id = pipeline[0]['$match']['vcs_system_id']
+        return [{'revision_hash': commit['revision_hash'], 'count': len(commit.get('code_entity_states') or [])}
+                for commit in self.commits if commit['vcs_system_id'] == vcs_system_id]
+
+
+class BoundsTest(unittest.TestCase):
+    """
+    Tests the quantiles of the normal distribution and the upper bounds of the rates of errors of the sampled
+    consistency checks.
+    """
+
+    def test_normal_quantile(self):
+        self.assertAlmostEqual(normal_quantile(0.5), 0.0, places=9)
+        self.assertAlmostEqual(normal_quantile(0.95), 1.6448536270, places=8)
+        self.assertAlmostEqual(normal_quantile(0.975), 1.9599639845, places=8)
+        self.assertAlmostEqual(normal_quantile(0.99), 2.3263478740, places=8)
+        self.assertAlmostEqual(normal_quantile(0.05), -normal_quantile(0.95), places=9)
+
+    def test_no_errors(self):
+        # the Wilson upper bound of 0 errors in n trials is z^2 / (n + z^2)
+        z = normal_quantile(0.95)
+        for trials in (1, 10, 100, 1000):
+            self.assertAlmostEqual(wilson_upper_bound(0, trials, 0.95), z * z / (trials + z * z))
+        self.assertAlmostEqual(wilson_upper_bound(0, 100, 0.95), 0.026343, places=6)
+        self.assertAlmostEqual(wilson_upper_bound(0, 100, 0.99), 0.051340, places=6)
+
+    def test_upper_bound_solves_score_equation(self):
+        # the upper bound p solves (errors / trials - p)^2 = z^2 p (1 - p) / trials above the observed rate
+        z = normal_quantile(0.95)
+        for errors, trials in ((1, 10), (5, 100), (50, 100), (2.5, 40.0)):
+            bound = wilson_upper_bound(errors, trials, 0.95)
+            self.assertGreater(bound, errors / trials)
+            self.assertAlmostEqual((errors / trials - bound) ** 2, z * z * bound * (1 - bound) / trials)
+        self.assertEqual(wilson_upper_bound(10, 10, 0.95), 1.0)
+        self.assertEqual(wilson_upper_bound(0, 0, 0.95), 1.0)
+
+    def test_stratified_upper_bound(self):
+        # one stratum is a simple random sample
+        self.assertEqual(stratified_upper_bound([(1000, 100, 5)], 0.95),
+                         (0.05, 100.0, wilson_upper_bound(5, 100, 0.95)))
+        # two strata of the same size with the same rate that are sampled with different rates
+        rate, effective_trials, bound = stratified_upper_bound([(100, 10, 1), (100, 40, 4), (50, 0, 0)], 0.95)
+        self.assertAlmostEqual(rate, 0.1)
+        self.assertAlmostEqual(effective_trials, 1 / (0.25 / 10 + 0.25 / 40))
+        self.assertAlmostEqual(bound, wilson_upper_bound(rate * effective_trials, effective_trials, 0.95))
+        # the rate of a small stratum counts with its size, not with its share of the sample
+        rate, _, _ = stratified_upper_bound([(900, 10, 0), (100, 10, 10)], 0.95)
+        self.assertAlmostEqual(rate, 0.1)
+        self.assertEqual(stratified_upper_bound([(100, 0, 0)], 0.95), (0.0, 0.0, 1.0))
+
+
+class SampleCommitsTest(unittest.TestCase):
+    """
+    Tests the stratified sample of the commits of :func:`~consistency_checker.sample_commits`.
+    """
+
+    def setUp(self):
+        self.vcs_system_verbose = ObjectId()
+        self.vcs_system_condensed = ObjectId()
+
+    def _collections(self, commits, entities):
+        """
+        :param commits: the verbose commits
+        :param entities: function from the index of a commit to its number of code entities
+        :return: tuple of the verbose and the condensed collections of the commits, which share their revision hashes
+        """
+        verbose = [dict(commit, vcs_system_id=self.vcs_system_verbose) for commit in commits]
+        # commits of another VCS system are not sampled
+        verbose.append({'_id': ObjectId(), 'revision_hash': 'x', 'parents': [], 'vcs_system_id': ObjectId()})
+        condensed = [{'_id': ObjectId(), 'revision_hash': commit['revision_hash'], 'vcs_system_id':
+                      self.vcs_system_condensed, 'code_entity_states': [ObjectId() for _ in range(entities(index))]}
+                     for index, commit in enumerate(commits)]
+        return CommitCollection(verbose), CommitCollection(condensed)
+
+    def _sample(self, commits, entities, size, seed=0):
+        verbose, condensed = self._collections(commits, entities)
+        return sample_commits(verbose, condensed, self.vcs_system_verbose, self.vcs_system_condensed, size, seed)
+
+    def test_positions(self):
+        commits = commits_of(FORK_AND_MERGE)
+        sample, strata = self._sample(commits, lambda index: 0, len(commits))
+        # all commits have the same number of code entities, which is not below any quartile
+        positions = {commit['revision_hash']: commit['stratum'] for commit in sample}
+        self.assertEqual(positions, {'a': ('root', 3), 'b': ('fork', 3), 'c': ('linear', 3), 'd': ('linear', 3),
+                                     'e': ('linear', 3), 'f': ('linear', 3), 'g': ('merge', 3), 'h': ('linear', 3)})
+        self.assertEqual(strata, {('root', 3): 1, ('fork', 3): 1, ('linear', 3): 5, ('merge', 3): 1})
+        self.assertEqual([commit['_id'] for commit in sample], [commit['_id'] for commit in commits])
+
+    def test_strata_are_sampled_proportionally_but_at_least_once(self):
+        commits = generate_history(400, branch_probability=0.1, merge_probability=0.3, seed=4, shuffle=True)
+        counts = [random.Random(index).randrange(1000) for index in range(len(commits))]
+        sample, strata = self._sample(commits, lambda index: counts[index], 40)
+        self.assertEqual(sum(strata.values()), len(commits))
+        # the quartiles of the numbers of code entities split the commits into four strata of about the same size
+        quartiles = collections.Counter()
+        for (_, quartile), size in strata.items():
+            quartiles[quartile] += size
+        self.assertEqual(sorted(quartiles), [0, 1, 2, 3])
+        self.assertTrue(all(90 <= size <= 110 for size in quartiles.values()))
+
+        sampled = collections.Counter(commit['stratum'] for commit in sample)
+        self.assertEqual(set(sampled), set(strata))
+        for stratum, size in strata.items():
+            self.assertEqual(sampled[stratum], min(size, max(1, int(round(40 * size / len(commits))))))
+        # the sample keeps the order of the database and contains every commit at most once
+        indices = {commit['_id']: index for index, commit in enumerate(commits)}
+        positions = [indices[commit['_id']] for commit in sample]
+        self.assertEqual(positions, sorted(set(positions)))
+        self.assertTrue(all(commit['revision_hash'] == commits[indices[commit['_id']]]['revision_hash']
+                            for commit in sample))
+
+    def test_seed(self):
+        commits = generate_history(200, branch_probability=0.1, merge_probability=0.3, seed=5, shuffle=True)
+        first, _ = self._sample(commits, lambda index: index % 7, 20, seed=1)
+        second, _ = self._sample(commits, lambda index: index % 7, 20, seed=1)
+        other, _ = self._sample(commits, lambda index: index % 7, 20, seed=2)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_upper_bound_of_sample(self):
+        commits = generate_history(200, branch_probability=0.1, merge_probability=0.3, seed=6, shuffle=True)
+        sample, strata = self._sample(commits, lambda index: index, 50)
+        sampled = collections.Counter(commit['stratum'] for commit in sample)
+        rate, effective_trials, bound = stratified_upper_bound(
+            [(size, sampled[stratum], 0) for stratum, size in strata.items()], 0.95)
+        # a sample without errors bounds the rate like a simple random sample of the effective size
+        self.assertEqual(rate, 0.0)
+        self.assertLessEqual(effective_trials, len(sample) + 1e-9)
+        z = normal_quantile(0.95)
+        self.assertAlmostEqual(bound, z * z / (effective_trials + z * z))
+        self.assertTrue(math.isfinite(bound))
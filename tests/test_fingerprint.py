@@ -0,0 +1,189 @@
+import logging
+import unittest
+
+from bson import ObjectId
+from pycoshark.mongomodels import CodeEntityState
+
+from benchmark import generate_history
+from memeshark import metrics
+from memeshark.fingerprint import fingerprint, MAX_EXACT_INTEGER, metrics_digest
+from memeshark.memeshark import MemeSHARKWorker
+from memeshark.metrics import fingerprints, metrics_digests, unchanged_mask
+from memeshark.state import CESState
+from memeshark.storage import MemoryStorage
+from tests.test_offline import code_entity_states
+
+NAN = float('nan')
+
+
+def state(**fields):
+    """
+    :param fields: fields of the code entity state that differ from the defaults; fields that are Ellipsis are not set
+    :return: a code entity state as dict with new IDs
+    """
+    ces_id = ObjectId()
+    ces = {'_id': ces_id, 's_key': str(ces_id), 'long_name': 'f0.C0.m0', 'commit_id': ObjectId(),
+           'file_id': ObjectId('5b0d5e3c9a3f1b2c3d4e5f60'), 'ce_type': 'method', 'ce_parent_id': ObjectId(),
+           'metrics': {'loc': 1.0}}
+    for field, value in fields.items():
+        if value is Ellipsis:
+            ces.pop(field, None)
+        else:
+            ces[field] = value
+    return ces
+
+
+class FingerprintTest(unittest.TestCase):
+    """
+    Tests that the fingerprints (see :mod:`memeshark.fingerprint` and :mod:`memeshark.metrics`) consider two code entity
+    states as unchanged if and only if :meth:`~memeshark.memeshark.MemeSHARKWorker._compare_dicts` does.
+    """
+
+    def setUp(self):
+        self.worker = MemeSHARKWorker(None, MemoryStorage(), 0, None, None)
+        self.worker.logger = logging.getLogger('worker0')
+
+    def _compared(self, ces1, ces2):
+        """
+        :return: the verdict of the comparison of the documents of the original memeSHARK
+        """
+        return self.worker._compare_dicts(CodeEntityState._from_son(ces1), CodeEntityState._from_son(ces2),
+                                          {'id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids'})
+
+    def assertAgree(self, ces1, ces2, unchanged):
+        """
+        Asserts that the comparison, the fingerprints of single states, and the fingerprints of many states all
+        consider two code entity states as unchanged or as changed.
+        :param ces1: past code entity state
+        :param ces2: current code entity state
+        :param unchanged: the expected verdict
+        """
+        self.assertEqual(self._compared(ces1, ces2), unchanged)
+        self.assertEqual(fingerprint(ces1) == fingerprint(ces2), unchanged)
+        past, current = fingerprints([ces1]), fingerprints([ces2])
+        self.assertEqual(past, [fingerprint(ces1)])
+        self.assertEqual(current, [fingerprint(ces2)])
+        self.assertEqual(bool(unchanged_mask(past, current)[0]), unchanged)
+
+    def test_nan_metrics(self):
+        self.assertAgree(state(metrics={'loc': NAN, 'cc': 1.0}), state(metrics={'loc': NAN, 'cc': 1.0}), True)
+        self.assertAgree(state(metrics={'loc': NAN}), state(metrics={'loc': 1.0}), False)
+        self.assertAgree(state(metrics={'loc': float('-nan')}), state(metrics={'loc': NAN}), True)
+
+    def test_numbers(self):
+        self.assertAgree(state(metrics={'loc': 1}), state(metrics={'loc': 1.0}), True)
+        self.assertAgree(state(metrics={'loc': 0.0}), state(metrics={'loc': -0.0}), True)
+        self.assertAgree(state(metrics={'loc': 0}), state(metrics={'loc': -0.0}), True)
+        self.assertAgree(state(metrics={'loc': 1.0}), state(metrics={'loc': 1.5}), False)
+        self.assertAgree(state(start_line=3), state(start_line=3.0), True)
+
+    def test_missing_metric(self):
+        self.assertAgree(state(metrics={'loc': 1.0, 'cc': 2.0}), state(metrics={'loc': 1.0}), False)
+        self.assertAgree(state(metrics={'loc': 1.0}), state(metrics={'loc': 1.0, 'cc': NAN}), False)
+        self.assertAgree(state(metrics={'loc': 1.0}), state(metrics={'cc': 1.0}), False)
+
+    def test_none_and_empty_fields(self):
+        self.assertAgree(state(ce_type=None), state(ce_type=Ellipsis), True)
+        self.assertAgree(state(start_line=None), state(start_line=Ellipsis), True)
+        self.assertAgree(state(imports=[]), state(imports=Ellipsis), True)
+        self.assertAgree(state(linter=[]), state(), True)
+        self.assertAgree(state(test_type={}), state(), True)
+        self.assertAgree(state(metrics={}), state(metrics=Ellipsis), True)
+        self.assertAgree(state(imports=['os']), state(imports=Ellipsis), False)
+        self.assertAgree(state(ce_type='class'), state(ce_type=None), False)
+
+    def test_dicts_and_lists(self):
+        linter = [{'l_ty': 'W0612', 'ln': 3}, {'l_ty': 'C0111', 'ln': 1}]
+        self.assertAgree(state(linter=linter), state(linter=[dict(warning) for warning in linter]), True)
+        self.assertAgree(state(linter=linter), state(linter=list(reversed(linter))), False)
+        self.assertAgree(state(linter=linter), state(linter=linter[:1]), False)
+        self.assertAgree(state(linter=[{'l_ty': 'W0612', 'ln': 3}]), state(linter=[{'l_ty': 'W0612', 'ln': 4}]),
+                         False)
+        self.assertAgree(state(test_type={'unit': True, 'framework': 'junit'}),
+                         state(test_type={'framework': 'junit', 'unit': True}), True)
+        self.assertAgree(state(test_type={'unit': True}), state(test_type={'unit': False}), False)
+        self.assertAgree(state(test_type={'unit': True}), state(test_type={'unit': True, 'framework': 'junit'}),
+                         False)
+        self.assertAgree(state(imports=['os', 'sys']), state(imports=['os', 'sys']), True)
+        self.assertAgree(state(imports=['os', 'sys']), state(imports=['sys', 'os']), False)
+
+    def test_large_integers(self):
+        self.assertAgree(state(metrics={'loc': MAX_EXACT_INTEGER + 1}), state(metrics={'loc': MAX_EXACT_INTEGER + 1}),
+                         True)
+        # equal as floats, but not as integers
+        self.assertAgree(state(metrics={'loc': MAX_EXACT_INTEGER + 1}), state(metrics={'loc': MAX_EXACT_INTEGER}),
+                         False)
+        self.assertAgree(state(metrics={'loc': MAX_EXACT_INTEGER + 1}),
+                         state(metrics={'loc': float(MAX_EXACT_INTEGER + 1)}), False)
+        self.assertAgree(state(metrics={'loc': MAX_EXACT_INTEGER}), state(metrics={'loc': float(MAX_EXACT_INTEGER)}),
+                         True)
+        self.assertAgree(state(metrics={'loc': -2 ** 63, 'cc': 1.0}), state(metrics={'loc': -2 ** 63, 'cc': 1.0}),
+                         True)
+
+    def test_non_numeric_metrics(self):
+        self.assertAgree(state(metrics={'loc': 1.0, 'lang': 'java'}), state(metrics={'loc': 1, 'lang': 'java'}), True)
+        self.assertAgree(state(metrics={'loc': 1.0, 'lang': 'java'}), state(metrics={'loc': 1.0, 'lang': 'c'}), False)
+        self.assertAgree(state(metrics={'loc': NAN, 'lang': 'java'}), state(metrics={'loc': NAN, 'lang': 'java'}),
+                         True)
+
+    def test_generated_states(self):
+        commits = generate_history(30, branch_probability=0.2, merge_probability=0.3, seed=0, shuffle=False)
+        states = code_entity_states(commits, 0)
+        by_key = {}
+        for ces in states:
+            by_key.setdefault((ces['long_name'], ces['file_id']), []).append(ces)
+        pairs = [(past, current) for versions in by_key.values() for past, current in zip(versions, versions[1:])]
+        mask = unchanged_mask(fingerprints([past for past, _ in pairs]),
+                              fingerprints([current for _, current in pairs]))
+        for (past, current), unchanged in zip(pairs, mask):
+            self.assertEqual(bool(unchanged), self._compared(past, current))
+        self.assertTrue(any(mask))
+        self.assertFalse(all(mask))
+
+    @unittest.skipIf(metrics.numpy is None, 'NumPy is not installed')
+    def test_metrics_digests(self):
+        schema = ('cc', 'loc', 'nom')
+        rows = [(1.0, 2.0, 3.0), (NAN, 0.0, -0.0), (-0.0, NAN, 1e300), (5e-324, -1.5, float(MAX_EXACT_INTEGER)),
+                (float('inf'), float('-inf'), 0.1)]
+        digests = metrics_digests(schema, metrics.numpy.array(rows, dtype=metrics.numpy.float64)).tolist()
+        self.assertEqual(digests, [metrics_digest(dict(zip(schema, row))) for row in rows])
+        self.assertEqual(digests[1], metrics_digest({'cc': float('-nan'), 'loc': -0.0, 'nom': 0}))
+
+
+class VerifyFingerprintsTest(unittest.TestCase):
+    """
+    Tests the verification of the fingerprints by :meth:`~memeshark.memeshark.MemeSHARKWorker._is_unchanged`.
+    """
+
+    def setUp(self):
+        self.worker = MemeSHARKWorker(None, MemoryStorage(), 0, None, None, verify_fingerprints=True)
+        self.worker.logger = logging.getLogger('worker0')
+
+    def _is_unchanged(self, past, current):
+        """
+        :return: the verified verdict for two code entity states as dicts, which must agree with the fingerprints
+        """
+        unchanged = fingerprint(past) == fingerprint(current)
+        ces_past = CESState(fingerprint(past), past['_id'], past['ce_parent_id'])
+        verdict = self.worker._is_unchanged(ces_past, current, unchanged, {past['_id']: past})
+        self.assertEqual(verdict, unchanged)
+        return verdict
+
+    def test_agreement(self):
+        self.assertTrue(self._is_unchanged(state(metrics={'loc': NAN}), state(metrics={'loc': NAN})))
+        self.assertFalse(self._is_unchanged(state(metrics={'loc': 1.0}), state(metrics={'loc': 2.0})))
+
+    def test_disagreement_uses_comparison(self):
+        past, current = state(), state(metrics={'loc': 2.0})
+        ces_past = CESState(fingerprint(past), past['_id'], past['ce_parent_id'])
+        with self.assertLogs('worker0', 'ERROR'):
+            self.assertFalse(self.worker._is_unchanged(ces_past, current, True, {past['_id']: past}))
+
+    def test_undeclared_fields(self):
+        # fields that the model does not declare are compared by their values instead of raising FieldDoesNotExist
+        self.assertTrue(self._is_unchanged(state(language='java'), state(language='java')))
+        self.assertFalse(self._is_unchanged(state(language='java'), state(language='c')))
+        self.assertFalse(self._is_unchanged(state(language='java'), state()))
+        self.assertTrue(self._is_unchanged(state(language=None), state()))
+        self.assertTrue(self._is_unchanged(state(tags=[]), state(tags={})))
+        self.assertTrue(self._is_unchanged(state(tags=['a', {'b': 1}]), state(tags=['a', {'b': 1.0}])))
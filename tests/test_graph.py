@@ -0,0 +1,214 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from bson import ObjectId
+
+from benchmark import generate_history
+from memeshark.graph import build_commit_graph, ChainPartition, CommitStatus, CompactCommitGraph
+
+# a - b - c - e - g - h
+#      \          /
+#       d ------ f
+FORK_AND_MERGE = {'a': '', 'b': 'a', 'c': 'b', 'd': 'b', 'e': 'c', 'f': 'd', 'g': 'ef', 'h': 'g'}
+
+
+def commits_of(parents):
+    """
+    :param parents: dict from the revision hashes of the commits to the revision hashes of their parents
+    :return: list of commits as dicts in the order of the revision hashes
+    """
+    return [{'_id': ObjectId(), 'revision_hash': revision_hash, 'parents': list(parents[revision_hash])}
+            for revision_hash in sorted(parents)]
+
+
+class CompactCommitGraphTest(unittest.TestCase):
+    """
+    Tests the building of the :class:`~memeshark.graph.CompactCommitGraph` from a stream of commits and its files.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _edges(self, commit_graph, commits):
+        """
+        :return: set of (child, parent) pairs of the revision hashes of the edges of the graph
+        """
+        hashes = {commit['_id']: commit['revision_hash'] for commit in commits}
+        return set((hashes[commit_graph.node_id(node)], hashes[commit_graph.node_id(parent)])
+                   for node in commit_graph for parent in commit_graph.pred(node))
+
+    def test_nodes_are_numbered_in_stream_order(self):
+        commits = commits_of(FORK_AND_MERGE)
+        random.Random(0).shuffle(commits)
+        commit_graph, missing = build_commit_graph(iter(commits))
+        self.assertEqual(missing, [])
+        self.assertEqual(commit_graph.number_of_nodes(), 8)
+        self.assertEqual(commit_graph.number_of_edges(), 8)
+        self.assertEqual([commit_graph.node_id(node) for node in commit_graph], [commit['_id'] for commit in commits])
+        self.assertEqual([commit_graph.index(commit['_id']) for commit in commits], list(range(8)))
+        self.assertEqual(self._edges(commit_graph, commits),
+                         set((child, parent) for child, parents in FORK_AND_MERGE.items() for parent in parents))
+
+    def test_adjacency(self):
+        commits = commits_of(FORK_AND_MERGE)
+        commit_graph, _ = CompactCommitGraph.from_commits(commits)
+        node = {commit['revision_hash']: commit_graph.index(commit['_id']) for commit in commits}
+        # the parents of a merge keep their order
+        self.assertEqual(list(commit_graph.pred(node['g'])), [node['e'], node['f']])
+        self.assertEqual(sorted(commit_graph.succ(node['b'])), [node['c'], node['d']])
+        self.assertEqual(list(commit_graph.pred(node['a'])), [])
+        self.assertEqual(list(commit_graph.succ(node['h'])), [])
+        self.assertEqual([commit_graph.in_degree(node[revision_hash]) for revision_hash in 'abcdefgh'],
+                         [0, 1, 1, 1, 1, 1, 2, 1])
+        self.assertEqual([commit_graph.out_degree(node[revision_hash]) for revision_hash in 'abcdefgh'],
+                         [1, 2, 1, 1, 1, 1, 1, 0])
+
+    def test_missing_and_duplicate_parents(self):
+        commits = commits_of({'a': '', 'b': 'aa', 'c': 'bx'})
+        commit_graph, missing = CompactCommitGraph.from_commits(commits)
+        self.assertEqual(missing, [(commits[2]['_id'], 'x')])
+        self.assertEqual(commit_graph.number_of_edges(), 2)
+        self.assertEqual(list(commit_graph.pred(1)), [0])
+        self.assertEqual(list(commit_graph.pred(2)), [1])
+
+    def test_generated_history(self):
+        commits = generate_history(200, branch_probability=0.1, merge_probability=0.2, seed=1, shuffle=True)
+        commit_graph, missing = build_commit_graph(commits)
+        self.assertEqual(missing, [])
+        self.assertEqual(len(commit_graph), len(commits))
+        self.assertEqual(self._edges(commit_graph, commits),
+                         set((commit['revision_hash'], parent) for commit in commits for parent in commit['parents']))
+        self.assertEqual(sum(commit_graph.in_degree(node) for node in commit_graph),
+                         sum(commit_graph.out_degree(node) for node in commit_graph))
+
+    def test_csr_arrays(self):
+        commit_graph, _ = CompactCommitGraph.from_commits(commits_of(FORK_AND_MERGE))
+        self.assertEqual(list(commit_graph._pred_offsets), [0, 0, 1, 2, 3, 4, 5, 7, 8])
+        self.assertEqual(list(commit_graph._pred_indices), [0, 1, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(commit_graph._succ_offsets), [0, 1, 3, 4, 5, 6, 7, 8, 8])
+        self.assertEqual(list(commit_graph._succ_indices), [1, 2, 3, 4, 5, 6, 6, 7])
+
+    def test_save_and_load(self):
+        commits = generate_history(100, branch_probability=0.1, merge_probability=0.2, seed=2, shuffle=True)
+        commit_graph, _ = build_commit_graph(commits)
+        path = os.path.join(self.work_dir, 'commit_graph.bin')
+        commit_graph.save(path)
+        loaded = CompactCommitGraph.load(path)
+        # the arrays are read-only views of the memory-mapped file
+        self.assertIsInstance(loaded._pred_indices, memoryview)
+        self.assertTrue(loaded._pred_indices.readonly)
+        self.assertEqual(len(loaded), len(commit_graph))
+        self.assertEqual(loaded.number_of_edges(), commit_graph.number_of_edges())
+        for node in commit_graph:
+            self.assertEqual(loaded.node_id(node), commit_graph.node_id(node))
+            self.assertEqual(loaded.index(commit_graph.node_id(node)), node)
+            self.assertEqual(list(loaded.pred(node)), list(commit_graph.pred(node)))
+            self.assertEqual(list(loaded.succ(node)), list(commit_graph.succ(node)))
+
+        status = CommitStatus(bytearray([1, 0] * 50), array('q', range(100)))
+        status.save(os.path.join(self.work_dir, 'commit_status.bin'))
+        loaded = CommitStatus.load(os.path.join(self.work_dir, 'commit_status.bin'))
+        self.assertEqual(loaded.processed(), bytearray([1, 0] * 50))
+        self.assertEqual([loaded.ces_count(node) for node in range(100)], list(range(100)))
+        self.assertEqual(list(loaded.weights()), [1.0 + node for node in range(100)])
+        self.assertEqual(loaded.mark_processed([1]).processed()[:4], bytearray([1, 1, 1, 0]))
+        self.assertFalse(CommitStatus(bytearray(2), array('q')).has_ces_counts())
+
+    def test_not_an_array_file(self):
+        path = os.path.join(self.work_dir, 'commit_graph.bin')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            CompactCommitGraph.load(path)
+
+
+class ChainPartitionTest(unittest.TestCase):
+    """
+    Tests the decomposition of a commit graph into the chains of a :class:`~memeshark.graph.ChainPartition`.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.commits = commits_of(FORK_AND_MERGE)
+        self.commit_graph, _ = CompactCommitGraph.from_commits(self.commits)
+        self.node = {commit['revision_hash']: self.commit_graph.index(commit['_id']) for commit in self.commits}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _chains(self, chains):
+        """
+        :return: dict from the revision hashes of the nodes of the chains to the revision hashes of the nodes of their
+            parents ('' for chains without parent)
+        """
+        hashes = {node: revision_hash for revision_hash, node in self.node.items()}
+
+        def name(chain):
+            return ''.join(hashes[node] for node in chains.nodes(chain))
+
+        return {name(chain): name(chains.parent(chain)) if chains.parent(chain) >= 0 else '' for chain in chains}
+
+    def _chain(self, chains, name):
+        """
+        :return: the index of the chain whose head is the node with the revision hash
+        """
+        return [chain for chain in chains if chains.head(chain) == self.node[name]][0]
+
+    def test_forks_and_merges(self):
+        chains = ChainPartition.from_graph(self.commit_graph)
+        # a chain ends at a fork and a merge starts a path
+        self.assertEqual(self._chains(chains), {'ab': '', 'ce': 'ab', 'df': 'ab', 'gh': ''})
+        ab = self._chain(chains, 'a')
+        self.assertEqual(sorted(chains.children(ab)), sorted([self._chain(chains, 'c'), self._chain(chains, 'd')]))
+        self.assertEqual(list(chains.children(self._chain(chains, 'c'))), [])
+        self.assertEqual(chains.tail(ab), self.node['b'])
+        self.assertEqual(chains.length(ab), 2)
+        self.assertEqual(sum(chains.length(chain) for chain in chains), len(self.commit_graph))
+
+    def test_processed_nodes(self):
+        processed = bytearray(len(self.commit_graph))
+        for revision_hash in 'abc':
+            processed[self.node[revision_hash]] = 1
+        chains = ChainPartition.from_graph(self.commit_graph, processed)
+        # the chains after processed nodes start from the state in the database
+        self.assertEqual(self._chains(chains), {'e': '', 'df': '', 'gh': ''})
+
+    def test_critical_paths(self):
+        chains = ChainPartition.from_graph(self.commit_graph)
+        node_weights = array('d', [1.0] * len(self.commit_graph))
+        node_weights[self.node['f']] = 5.0
+        chain_weights = chains.weights(node_weights)
+        ab, ce, df, gh = (self._chain(chains, name) for name in 'acdg')
+        self.assertEqual([chain_weights[chain] for chain in (ab, ce, df, gh)], [2, 2, 6, 2])
+        self.assertEqual(list(chains.weights()), [chains.length(chain) for chain in chains])
+        critical_paths = chains.critical_paths(chain_weights)
+        self.assertEqual([critical_paths[chain] for chain in (ab, ce, df, gh)], [8, 2, 6, 2])
+        # the worker continues with the branch on the critical path
+        chains.sort_children(critical_paths)
+        self.assertEqual(list(chains.children(ab)), [df, ce])
+
+    def test_save_and_load(self):
+        commits = generate_history(100, branch_probability=0.2, merge_probability=0.2, seed=3, shuffle=True)
+        commit_graph, _ = build_commit_graph(commits)
+        chains = ChainPartition.from_graph(commit_graph)
+        chains.sort_children(chains.critical_paths(chains.weights()))
+        path = os.path.join(self.work_dir, 'chains.bin')
+        chains.save(path)
+        loaded = ChainPartition.load(path)
+        self.assertEqual(len(loaded), len(chains))
+        for chain in chains:
+            self.assertEqual(list(loaded.nodes(chain)), list(chains.nodes(chain)))
+            self.assertEqual(loaded.parent(chain), chains.parent(chain))
+            self.assertEqual(list(loaded.children(chain)), list(chains.children(chain)))
+            for node in chains.nodes(chain)[1:]:
+                self.assertEqual(commit_graph.in_degree(node), 1)
+            if chains.parent(chain) >= 0:
+                self.assertEqual(list(commit_graph.pred(chains.head(chain))), [chains.tail(chains.parent(chain))])
+        self.assertEqual(sorted(node for chain in chains for node in chains.nodes(chain)), list(commit_graph))
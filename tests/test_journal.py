@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bson import ObjectId
+
+from memeshark.graph import CompactCommitGraph
+from memeshark.journal import Journal, state_digest
+from memeshark.memeshark import MemeSHARK, ProjectError
+from memeshark.storage import MemoryStorage
+from tests.test_memeshark import config
+
+
+class JournalTest(unittest.TestCase):
+    """
+    Tests the recording and the replay of the finished chains of a :class:`~memeshark.journal.Journal`.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'journal')
+        # a - b - c - d
+        #      \
+        #       e - f
+        parents = {'a': '', 'b': 'a', 'c': 'b', 'd': 'c', 'e': 'b', 'f': 'e'}
+        self.commits = [{'_id': ObjectId(), 'revision_hash': revision_hash, 'parents': list(parents[revision_hash])}
+                        for revision_hash in 'abcdef']
+        self.ids = {commit['revision_hash']: commit['_id'] for commit in self.commits}
+        self.commit_graph, _ = CompactCommitGraph.from_commits(self.commits)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _nodes(self, processed):
+        """
+        :param processed: one byte per node
+        :return: the revision hashes of the nodes that are marked as processed
+        """
+        return ''.join(sorted(revision_hash for revision_hash, commit_id in self.ids.items()
+                              if processed[self.commit_graph.index(commit_id)]))
+
+    def _record(self, journal, head, tail, length, digest):
+        journal.record(self.ids[head], self.ids[tail], length, digest)
+
+    def test_records_are_replayed(self):
+        journal = Journal(self.path)
+        self._record(journal, 'a', 'b', 2, 'ab')
+        self._record(journal, 'c', 'd', 2, 'cd')
+        self._record(journal, 'e', 'f', 2, None)
+        # the records are on the disk before the journal is closed
+        processed, digests = Journal(self.path).load(self.commit_graph)
+        self.assertEqual(self._nodes(processed), 'abcdef')
+        self.assertEqual(digests, {self.commit_graph.index(self.ids['b']): 'ab',
+                                   self.commit_graph.index(self.ids['d']): 'cd',
+                                   self.commit_graph.index(self.ids['f']): None})
+        journal.close()
+
+    def test_torn_last_line_is_ignored(self):
+        journal = Journal(self.path)
+        self._record(journal, 'a', 'b', 2, 'ab')
+        journal.close()
+        line = json.dumps({'head': str(self.ids['c']), 'tail': str(self.ids['d']), 'length': 2, 'state': 'cd'})
+        with open(self.path, 'a') as f:
+            f.write(line[:len(line) // 2])
+        processed, digests = Journal(self.path).load(self.commit_graph)
+        self.assertEqual(self._nodes(processed), 'ab')
+        self.assertEqual(list(digests.values()), ['ab'])
+        # a resumed run terminates the torn line before it appends its records
+        journal = Journal(self.path)
+        self._record(journal, 'e', 'f', 2, 'ef')
+        journal.close()
+        processed, digests = Journal(self.path).load(self.commit_graph)
+        self.assertEqual(self._nodes(processed), 'abef')
+        with open(self.path, 'r') as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_chains_that_do_not_match_are_ignored(self):
+        journal = Journal(self.path)
+        self._record(journal, 'a', 'c', 2, 'ac')
+        self._record(journal, 'c', 'd', 3, 'cd')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'head': str(ObjectId()), 'tail': str(self.ids['d']), 'length': 1, 'state': None}))
+            f.write('\n')
+        processed, digests = Journal(self.path).load(self.commit_graph)
+        self.assertEqual(self._nodes(processed), '')
+        self.assertEqual(digests, {})
+
+    def test_remove(self):
+        journal = Journal(self.path)
+        self.assertEqual(self._nodes(journal.load(self.commit_graph)[0]), '')
+        self._record(journal, 'a', 'b', 2, 'ab')
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+        journal.remove()
+
+    def test_state_digest(self):
+        ces_ids = [ObjectId('5b0d5e3c9a3f1b2c3d4e5f61'), ObjectId('5b0d5e3c9a3f1b2c3d4e5f60')]
+        # the digest is the MD5 of the sorted binary IDs, which must not change between runs that share a journal
+        self.assertEqual(state_digest(ces_ids), '4c7dd0e3850bfe19aa2fb27c1d756e27')
+        self.assertEqual(state_digest(ces_ids), hashlib.md5(ces_ids[1].binary + ces_ids[0].binary).hexdigest())
+        self.assertEqual(state_digest(reversed(ces_ids)), state_digest(ces_ids))
+        self.assertEqual(state_digest([]), hashlib.md5(b'').hexdigest())
+
+    def test_digest_round_trip(self):
+        ces_ids = [ObjectId() for _ in range(5)]
+        journal = Journal(self.path)
+        self._record(journal, 'a', 'b', 2, state_digest(ces_ids))
+        journal.close()
+        _, digests = Journal(self.path).load(self.commit_graph)
+        self.assertEqual(digests[self.commit_graph.index(self.ids['b'])], state_digest(list(reversed(ces_ids))))
+
+
+class VerifyJournalTest(unittest.TestCase):
+    """
+    Tests that the :class:`~memeshark.memeshark.MemeSHARK` only resumes from a journal whose states match the
+    database.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'journal')
+        project_id = ObjectId()
+        vcs_system_id = ObjectId()
+        # a - b - c
+        parents = {'a': '', 'b': 'a', 'c': 'b'}
+        self.commits = [{'_id': ObjectId(), 'revision_hash': revision_hash, 'parents': list(parents[revision_hash]),
+                         'vcs_system_id': vcs_system_id} for revision_hash in 'abc']
+        self.ces_ids = [ObjectId() for _ in range(3)]
+        for commit in self.commits[:2]:
+            commit['code_entity_states'] = list(self.ces_ids)
+        self.storage = MemoryStorage(self.commits, (), [{'_id': project_id, 'name': 'p'}],
+                                     [{'_id': vcs_system_id, 'project_id': project_id}])
+        journal = Journal(self.path)
+        journal.record(self.commits[0]['_id'], self.commits[1]['_id'], 2, state_digest(self.ces_ids))
+        journal.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _prepare(self):
+        return MemeSHARK(self.storage)._prepare(config(journal=self.path), self.work_dir, 0, 'p')
+
+    def test_matching_tail_is_resumed(self):
+        job, tasks = self._prepare()
+        self.assertEqual(job.no_commits, 1)
+        self.assertEqual([job.commit_graph.node_id(job.chains.head(task)) for task in tasks],
+                         [self.commits[2]['_id']])
+        job.journal.close()
+
+    def test_differing_tail_is_rejected(self):
+        self.commits[1]['code_entity_states'] = self.ces_ids[1:]
+        with self.assertRaises(ProjectError):
+            self._prepare()
+        self.assertTrue(os.path.exists(self.path))
@@ -0,0 +1,214 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from array import array
+
+from bson import ObjectId
+from mongoengine import connect, disconnect
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from memeshark.graph import ChainPartition, CommitStatus, CompactCommitGraph
+from memeshark.lease import LeasedTasks, TaskBoard
+from memeshark.scheduler import job_directory
+
+# MongoDB against which the tasks are claimed; the tests are skipped if it is not reachable
+MONGO_URI = os.environ.get('MEMESHARK_TEST_MONGO_URI', 'mongodb://localhost:27017')
+DATABASE = 'memeshark_test_lease'
+
+
+def mongo_available():
+    """
+    :return: true if a MongoDB is reachable at :data:`MONGO_URI`
+    """
+    try:
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=500)
+        client.server_info()
+        client.close()
+        return True
+    except PyMongoError:
+        return False
+
+
+@unittest.skipUnless(mongo_available(), 'no MongoDB reachable at %s' % MONGO_URI)
+class TaskBoardTest(unittest.TestCase):
+    """
+    Tests the leases of the tasks of a :class:`~memeshark.lease.TaskBoard`.
+    """
+
+    LEASE_TIME = 0.5
+
+    def setUp(self):
+        self.client = MongoClient(MONGO_URI)
+        self.client.drop_database(DATABASE)
+        self.board = TaskBoard(self.client[DATABASE], 'run')
+        self.board.reset()
+        self.board.add_tasks(0, [0, 1], 0, {0: 2, 1: 1})
+
+    def tearDown(self):
+        self.client.drop_database(DATABASE)
+        self.client.close()
+
+    def test_claim_is_atomic(self):
+        self.board.add_tasks(0, list(range(2, 50)), 0, {chain: 1 for chain in range(2, 50)})
+        claimed = []
+
+        def claim(owner):
+            while True:
+                task = self.board.claim(owner, 60, LeasedTasks.MAX_ATTEMPTS)
+                if task is None:
+                    return
+                claimed.append(task['chain'])
+
+        threads = [threading.Thread(target=claim, args=('w%i' % number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), list(range(50)))
+
+    def test_renew(self):
+        task = self.board.claim('a', self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS)
+        for _ in range(3):
+            time.sleep(self.LEASE_TIME / 2)
+            self.assertTrue(self.board.renew(task['_id'], 'a', self.LEASE_TIME))
+        self.assertFalse(self.board.renew(task['_id'], 'b', self.LEASE_TIME))
+        self.board.claim('b', self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS)
+        self.assertIsNone(self.board.claim('c', self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS))
+
+    def test_expired_lease_is_claimed_again(self):
+        task = self.board.claim('a', self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS)
+        self.board.claim('a', 60, LeasedTasks.MAX_ATTEMPTS)
+        time.sleep(self.LEASE_TIME * 2)
+        claimed = self.board.claim('b', 60, LeasedTasks.MAX_ATTEMPTS)
+        self.assertEqual(claimed['_id'], task['_id'])
+        self.assertEqual(claimed['attempts'], 2)
+        # the worker that lost the lease can neither renew it nor complete the task
+        self.assertFalse(self.board.renew(task['_id'], 'a', 60))
+        self.assertFalse(self.board.complete(task['_id'], 'a', 'done', {'commits': 1}))
+        self.assertTrue(self.board.complete(task['_id'], 'b', 'done', {'commits': 1}))
+        self.assertEqual([result['_id'] for result in self.board.results()], [task['_id']])
+        self.assertEqual(self.board.results(), [])
+
+    def test_task_fails_after_third_expiry(self):
+        self.board.claim('a', 60, LeasedTasks.MAX_ATTEMPTS)
+        for attempt in range(LeasedTasks.MAX_ATTEMPTS):
+            task = self.board.claim('w%i' % attempt, self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS)
+            self.assertEqual(task['attempts'], attempt + 1)
+            time.sleep(self.LEASE_TIME * 2)
+        self.assertIsNone(self.board.claim('b', 60, LeasedTasks.MAX_ATTEMPTS))
+        self.assertEqual(self.board.outstanding(0), 2)
+        self.board.expire(LeasedTasks.MAX_ATTEMPTS)
+        self.assertEqual(self.board.outstanding(0), 1)
+        results = self.board.results()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['_id'], task['_id'])
+        self.assertEqual(results[0]['state'], 'failed')
+
+    def test_add_tasks_is_idempotent(self):
+        task = self.board.claim('a', 60, LeasedTasks.MAX_ATTEMPTS)
+        # a worker that processes the task again after its lease expired spawns the same branches
+        self.board.add_tasks(0, [0, 1, 2], 1, {0: 2, 1: 1, 2: 1})
+        self.assertEqual(self.board.outstanding(0), 3)
+        stored = self.board.tasks.find_one({'_id': task['_id']})
+        self.assertEqual(stored['state'], 'leased')
+        self.assertEqual(stored['owner'], 'a')
+        self.assertEqual(stored['attempts'], 1)
+        self.assertEqual(stored['priority'], 0)
+
+    def test_restarted_run(self):
+        stale = TaskBoard(self.client[DATABASE], 'run')
+        self.assertTrue(stale.join())
+        self.board.finish()
+        self.assertTrue(stale.is_finished())
+        self.assertFalse(stale.join())
+        # a new start of the run with the same name is not finished for its workers
+        board = TaskBoard(self.client[DATABASE], 'run')
+        board.reset()
+        board.add_tasks(0, [0], 0, {0: 1})
+        self.assertFalse(board.is_finished())
+        # the workers of the previous start neither see it running nor claim its tasks
+        self.assertTrue(stale.is_finished())
+        self.assertIsNone(stale.claim('a', 60, LeasedTasks.MAX_ATTEMPTS))
+        self.assertIsNotNone(board.claim('b', 60, LeasedTasks.MAX_ATTEMPTS))
+
+
+@unittest.skipUnless(mongo_available(), 'no MongoDB reachable at %s' % MONGO_URI)
+class LeasedTasksTest(unittest.TestCase):
+    """
+    Tests that a worker of a distributed run keeps the lease of its task through :class:`~memeshark.lease.LeasedTasks`.
+    """
+
+    LEASE_TIME = 0.6
+
+    def setUp(self):
+        self.client = MongoClient(MONGO_URI)
+        self.client.drop_database(DATABASE)
+        connect(DATABASE, host=MONGO_URI, alias='default')
+        self.work_dir = tempfile.mkdtemp()
+        self.board = TaskBoard(self.client[DATABASE], 'run')
+        self.job_files = self._job_files()
+        self.board.reset()
+        self.board.publish_job(0, self.job_files)
+        self.board.add_tasks(0, [0], 0, {0: 1})
+
+    def tearDown(self):
+        disconnect(alias='default')
+        self.client.drop_database(DATABASE)
+        self.client.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _job_files(self):
+        """
+        Writes the files of a job with a single chain of two commits.
+        :return: the directory of the files
+        """
+        directory = os.path.join(self.work_dir, 'coordinator')
+        os.makedirs(directory)
+        commit_graph, _ = CompactCommitGraph.from_commits([
+            {'_id': ObjectId(), 'revision_hash': 'a', 'parents': []},
+            {'_id': ObjectId(), 'revision_hash': 'b', 'parents': ['a']}])
+        commit_graph.save(os.path.join(directory, 'commit_graph.bin'))
+        ChainPartition.from_graph(commit_graph).save(os.path.join(directory, 'chains.bin'))
+        CommitStatus(bytearray(len(commit_graph)), array('q')).save(os.path.join(directory, 'commit_status.bin'))
+        with open(os.path.join(directory, 'job.json'), 'w') as f:
+            json.dump({'journal': False}, f)
+        return directory
+
+    def test_heartbeat_renews_lease(self):
+        leases = LeasedTasks('run', os.path.join(self.work_dir, 'host'), 0, self.LEASE_TIME, poll_interval=0.05)
+        self.assertEqual(leases.get(), (0, 0))
+        self.assertTrue(os.path.exists(os.path.join(job_directory(leases.work_dir, 0), 'job.json')))
+        time.sleep(self.LEASE_TIME * 3)
+        self.assertIsNone(self.board.claim('b', self.LEASE_TIME, LeasedTasks.MAX_ATTEMPTS))
+        leases.renew()
+        leases.put(('done', 0, (0, 0), 2, [], 0, 0))
+        leases.put(('stats', 0, 0, 0))
+        results = self.board.results()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['state'], 'done')
+        self.assertEqual(results[0]['commits'], 2)
+
+    def test_reused_run_name(self):
+        # the previous run with the same name finished before the worker is started
+        self.board.finish()
+        leases = LeasedTasks('run', os.path.join(self.work_dir, 'host'), 0, self.LEASE_TIME, poll_interval=0.05)
+        claimed = []
+        thread = threading.Thread(target=lambda: claimed.append(leases.get()), daemon=True)
+        thread.start()
+        time.sleep(0.5)
+        self.assertEqual(claimed, [])
+        board = TaskBoard(self.client[DATABASE], 'run')
+        board.reset()
+        board.publish_job(0, self.job_files)
+        board.add_tasks(0, [0], 0, {0: 1})
+        thread.join(5)
+        self.assertEqual(claimed, [(0, 0)])
+        leases.put(('done', 0, (0, 0), 2, [], 0, 0))
+        leases.put(('stats', 0, 0, 0))
+        board.finish()
+        self.assertIsNone(leases.get())
@@ -0,0 +1,196 @@
+import copy
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+
+from bson import ObjectId
+
+from benchmark import generate_history
+from memeshark.journal import state_digest
+from memeshark.memeshark import MemeSHARK, MemeSHARKWorker, ProjectError
+from memeshark.scheduler import Scheduler
+from memeshark.storage import MemoryStorage
+from tests.test_offline import code_entity_states, reference_merge, snapshot
+
+
+class ThreadWorker(object):
+    """
+    Runs a :class:`~memeshark.memeshark.MemeSHARKWorker` in a thread of the test instead of a process, such that it
+    shares the :class:`~memeshark.storage.MemoryStorage` with the test. It has the attributes of a process that the
+    :class:`~memeshark.scheduler.Scheduler` uses.
+    :param worker: the worker
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.number = worker.number
+        self.name = worker.alias
+        self.exitcode = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            self.worker.run()
+            self.exitcode = 0
+        except BaseException:
+            self.exitcode = 1
+            raise
+
+    def start(self):
+        self.thread.start()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+
+def config(**options):
+    """
+    :param options: options that differ from the defaults
+    :return: the options of the configuration that the preparation of the jobs uses
+    """
+    cfg = SimpleNamespace(project_name='p', projects=None, project_order='largest', incremental=False, journal=None,
+                          dry_run=False, dry_run_sample=1.0, processes=2)
+    for name, value in options.items():
+        setattr(cfg, name, value)
+    return cfg
+
+
+class MemeSHARKTest(unittest.TestCase):
+    """
+    Tests the preparation of the jobs by the :class:`~memeshark.memeshark.MemeSHARK` and the merging of the
+    :class:`~memeshark.memeshark.MemeSHARKWorker` through the task and result queues over a
+    :class:`~memeshark.storage.MemoryStorage`.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _history(self, seed, no_commits=40):
+        """
+        :param seed: seed of the history
+        :param no_commits: number of commits
+        :return: tuple of the commits and the code entity states of a generated history
+        """
+        commits = generate_history(no_commits, branch_probability=0.2, merge_probability=0.3, seed=seed,
+                                   shuffle=False)
+        states = code_entity_states(commits, seed)
+        return commits, states
+
+    def _run(self, storage, cfg, processes=2):
+        """
+        Prepares the job of the project of a configuration and merges it with workers that run in threads.
+        :param storage: the :class:`~memeshark.storage.MemoryStorage`
+        :param cfg: the configuration
+        :param processes: number of workers
+        :return: the :class:`~memeshark.scheduler.Scheduler` after all tasks are finished
+        """
+        work_dir = tempfile.mkdtemp(dir=self.work_dir)
+        prepared = MemeSHARK(storage)._prepare(cfg, work_dir, 0, cfg.project_name)
+        task_queue = queue.Queue()
+        result_queue = queue.Queue()
+        workers = [ThreadWorker(MemeSHARKWorker(work_dir, storage, number, task_queue, result_queue,
+                                                read_batch_size=7, write_batch_size=5, cache_memory=1))
+                   for number in range(processes)]
+        for worker in workers:
+            worker.start()
+        finished = []
+        scheduler = Scheduler(workers, task_queue, result_queue, finished.append)
+        scheduler.add(*prepared)
+        scheduler.run()
+        self.assertEqual([job.number for job in finished], [0])
+        self.assertEqual(scheduler.failed_tasks, 0)
+        self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+        return scheduler
+
+    def _project(self, commits, states, name='p'):
+        """
+        :param commits: the commits
+        :param states: the code entity states
+        :param name: name of the project
+        :return: a :class:`~memeshark.storage.MemoryStorage` in which the commits belong to a project
+        """
+        project_id = ObjectId()
+        vcs_system_id = ObjectId()
+        commits = copy.deepcopy(commits)
+        for commit in commits:
+            commit['vcs_system_id'] = vcs_system_id
+        return MemoryStorage(commits, copy.deepcopy(states), [{'_id': project_id, 'name': name}],
+                             [{'_id': vcs_system_id, 'project_id': project_id}])
+
+    def test_workers_merge_like_reference(self):
+        for seed in range(3):
+            commits, states = self._history(seed)
+            storage = self._project(commits, states)
+            scheduler = self._run(storage, config())
+            reference = self._project(commits, states)
+            reference_merge(reference)
+            self.assertEqual(snapshot(storage), snapshot(reference))
+            self.assertEqual(scheduler.processed_commits, len(commits))
+            self.assertEqual(scheduler.ces_total, len(states))
+            self.assertEqual(scheduler.ces_deleted, len(states) - len(storage.code_entity_states))
+
+    def test_incremental(self):
+        commits, states = self._history(1)
+        old = set(commit['_id'] for commit in commits[:25])
+        storage = self._project([commit for commit in commits if commit['_id'] in old],
+                                [ces for ces in states if ces['commit_id'] in old])
+        self._run(storage, config())
+        vcs_system_id = storage.vcs_systems[0]['_id']
+        for commit in copy.deepcopy([commit for commit in commits if commit['_id'] not in old]):
+            commit['vcs_system_id'] = vcs_system_id
+            storage.commits[commit['_id']] = commit
+        for ces in copy.deepcopy([ces for ces in states if ces['commit_id'] not in old]):
+            storage.code_entity_states[ces['_id']] = ces
+            storage._ces_of_commit.setdefault(ces['commit_id'], []).append(ces['_id'])
+        self.assertEqual(storage.unprocessed_commits(vcs_system_id), len(commits) - len(old))
+        scheduler = self._run(storage, config(incremental=True))
+        self.assertEqual(scheduler.processed_commits, len(commits) - len(old))
+        reference = self._project(commits, states)
+        reference_merge(reference)
+        self.assertEqual(snapshot(storage), snapshot(reference))
+
+    def test_select_projects(self):
+        commits, states = self._history(2, 20)
+        storage = self._project(commits, states, 'a')
+        small = self._project(*self._history(3, 5), name='b')
+        storage.projects.extend(small.projects + [{'_id': ObjectId(), 'name': 'c'}])
+        storage.vcs_systems.extend(small.vcs_systems)
+        storage.commits.update(small.commits)
+        memeshark = MemeSHARK(storage)
+        self.assertEqual(memeshark._select_projects(config(project_name=None, projects=['b', 'a', 'c', 'd'])),
+                         ['a', 'b'])
+        self.assertEqual(memeshark._select_projects(config(project_name=None, projects=['a', 'b'],
+                                                           project_order='smallest')), ['b', 'a'])
+        # projects without commits to process are skipped if all projects are selected
+        for commit in small.commits.values():
+            commit['code_entity_states'] = [ObjectId()]
+        self.assertEqual(memeshark._select_projects(config(project_name=None)), ['a'])
+        with self.assertRaises(ProjectError):
+            memeshark._prepare(config(project_name='c'), self.work_dir, 0, 'c')
+        with self.assertRaises(ProjectError):
+            memeshark._prepare(config(project_name='d'), self.work_dir, 0, 'd')
+
+    def test_verify_journal(self):
+        commits, states = self._history(0, 10)
+        storage = self._project(commits, states)
+        memeshark = MemeSHARK(storage)
+        commit_graph, _ = memeshark._generate_graph(storage.vcs_systems[0]['_id'])
+        node = commit_graph.index(commits[0]['_id'])
+        journaled = bytearray(len(commit_graph))
+        journaled[node] = 1
+        ces_ids = storage.ces_ids_of_commit(commits[0]['_id'])
+        storage.commits[commits[0]['_id']]['code_entity_states'] = list(reversed(ces_ids))
+        digest = state_digest(ces_ids)
+        self.assertTrue(memeshark._verify_journal(commit_graph, journaled, {node: digest}))
+        storage.commits[commits[0]['_id']]['code_entity_states'] = ces_ids[1:]
+        self.assertFalse(memeshark._verify_journal(commit_graph, journaled, {node: digest}))
+        # the state of a commit whose successors are all journaled is not read
+        for successor in commit_graph.succ(node):
+            journaled[successor] = 1
+        self.assertTrue(memeshark._verify_journal(commit_graph, journaled, {node: digest}))
@@ -0,0 +1,294 @@
+import copy
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from bson import ObjectId
+
+from benchmark import generate_history
+from memeshark.graph import build_commit_graph, ChainPartition, CommitStatus
+from memeshark.offline import OfflineWorker
+from memeshark.storage import MemoryStorage
+
+# fields of the code entity states that are not compared by the merging
+EXCLUDED_FIELDS = {'_id', 's_key', 'commit_id', 'ce_parent_id', 'cg_ids'}
+
+
+def code_entity_states(commits, seed, files=3, classes=2, methods=3):
+    """
+    Generates the code entity states of a history of files with classes and methods. Every commit continues the
+    metrics of its first parent and changes, adds, and removes some code entities.
+    :param commits: the commits in topological order
+    :param seed: seed for the random number generator
+    :param files: number of files
+    :param classes: number of classes per file
+    :param methods: number of methods per class
+    :return: list of the code entity states as dicts
+    """
+    rnd = random.Random(seed)
+    file_ids = [ObjectId() for _ in range(files)]
+    metrics = {}
+    states = []
+    for commit in commits:
+        parent = metrics.get(commit['parents'][0], {}) if len(commit['parents']) > 0 else {}
+        current = {}
+        ids = {}
+        for file_number in range(files):
+            if len(parent) > 0 and rnd.random() < 0.1:
+                continue
+            entities = [(file_number, -1, -1)]
+            for class_number in range(classes):
+                entities.append((file_number, class_number, -1))
+                entities.extend((file_number, class_number, method) for method in range(methods))
+            for entity in entities:
+                value = parent.get(entity)
+                if value is None or rnd.random() < 0.15:
+                    value = {'loc': float(rnd.randint(1, 4)), 'cc': float('nan') if rnd.random() < 0.3 else 1.0}
+                current[entity] = value
+                ids[entity] = ObjectId()
+        for (file_number, class_number, method), value in sorted(current.items()):
+            if class_number == -1:
+                long_name, ce_type, parent_id = 'f%i' % file_number, 'file', None
+            elif method == -1:
+                long_name, ce_type = 'f%i.C%i' % (file_number, class_number), 'class'
+                parent_id = ids[(file_number, -1, -1)]
+            else:
+                long_name, ce_type = 'f%i.C%i.m%i' % (file_number, class_number, method), 'method'
+                parent_id = ids[(file_number, class_number, -1)]
+            ces_id = ids[(file_number, class_number, method)]
+            states.append({'_id': ces_id, 's_key': str(ces_id), 'long_name': long_name, 'commit_id': commit['_id'],
+                           'file_id': file_ids[file_number], 'ce_type': ce_type, 'ce_parent_id': parent_id,
+                           'metrics': dict(value), 'imports': [], 'linter': []})
+        metrics[commit['revision_hash']] = current
+    return states
+
+
+def same_state(ces1, ces2):
+    """
+    Compares two code entity states like the original memeSHARK, i.e., NaN metrics are equal.
+    :param ces1: first code entity state
+    :param ces2: second code entity state
+    :return: true if the code entity states are equal
+    """
+    for field in set(ces1) | set(ces2):
+        if field in EXCLUDED_FIELDS:
+            continue
+        value1, value2 = ces1.get(field), ces2.get(field)
+        if isinstance(value1, dict) and isinstance(value2, dict):
+            for key in set(value1) | set(value2):
+                if key not in value1 or key not in value2:
+                    return False
+                if isinstance(value1[key], float) and isinstance(value2[key], float) and math.isnan(value1[key]) \
+                        and math.isnan(value2[key]):
+                    continue
+                if value1[key] != value2[key]:
+                    return False
+        elif value1 != value2:
+            return False
+    return True
+
+
+def reference_merge(storage):
+    """
+    Merges the code entity states of a :class:`~memeshark.storage.MemoryStorage` one commit after another like the
+    original memeSHARK, which is the reference of the tests.
+    :param storage: the storage, which is changed
+    """
+    commits = storage.commits
+    states = storage.code_entity_states
+    by_hash = {commit['revision_hash']: commit_id for commit_id, commit in commits.items()}
+    pred = {commit_id: [] for commit_id in commits}
+    succ = {commit_id: [] for commit_id in commits}
+    for commit_id, commit in commits.items():
+        for parent in commit['parents']:
+            if parent in by_hash:
+                pred[commit_id].append(by_hash[parent])
+                succ[by_hash[parent]].append(commit_id)
+
+    def key(ces):
+        return ces['long_name'] + str(ces['file_id'])
+
+    def stored_state(commit_id):
+        return {key(states[ces_id]): states[ces_id] for ces_id in commits[commit_id].get('code_entity_states') or []
+                if ces_id in states}
+
+    def merge_node(node, past_state):
+        while len(pred[node]) == 1:
+            if len(commits[node].get('code_entity_states') or []) > 0:
+                current_state = {}
+                if any(len(commits[node_succ].get('code_entity_states') or []) == 0 for node_succ in succ[node]):
+                    current_state = stored_state(node)
+            else:
+                current_state, changed, unchanged, ces_map = {}, [], [], {}
+                for ces_id in storage.ces_ids_of_commit(node):
+                    ces = states[ces_id]
+                    past = past_state.get(key(ces))
+                    if past is None or not same_state(past, ces):
+                        current_state[key(ces)] = ces
+                        changed.append(ces_id)
+                    else:
+                        current_state[key(ces)] = past
+                        ces_map[ces_id] = past['_id']
+                        unchanged.append(ces_id)
+                saved_children = True
+                while saved_children:
+                    saved_children = False
+                    for ces_id in list(unchanged):
+                        if states[ces_id]['ce_parent_id'] in changed:
+                            saved_children = True
+                            current_state[key(states[ces_id])] = states[ces_id]
+                            changed.append(ces_id)
+                            unchanged.remove(ces_id)
+                            del ces_map[ces_id]
+                commits[node]['code_entity_states'] = [ces['_id'] for ces in current_state.values()]
+                for ces in current_state.values():
+                    if ces['commit_id'] == node and ces['ce_parent_id'] in ces_map:
+                        ces['ce_parent_id'] = ces_map[ces['ce_parent_id']]
+                for ces_id in unchanged:
+                    del states[ces_id]
+            if len(succ[node]) != 1:
+                tasks.extend(node_succ for node_succ in succ[node] if len(pred[node_succ]) == 1)
+                return
+            node, past_state = succ[node][0], current_state
+
+    tasks = [commit_id for commit_id in commits if len(pred[commit_id]) != 1]
+    while len(tasks) > 0:
+        node = tasks.pop(0)
+        if len(pred[node]) == 1:
+            merge_node(node, stored_state(pred[node][0]))
+            continue
+        if len(commits[node].get('code_entity_states') or []) > 0:
+            # already processed in an earlier run
+            current_state = stored_state(node)
+        else:
+            current_state = {key(states[ces_id]): states[ces_id] for ces_id in storage.ces_ids_of_commit(node)}
+            commits[node]['code_entity_states'] = [ces['_id'] for ces in current_state.values()]
+        for node_succ in succ[node]:
+            merge_node(node_succ, current_state)
+
+
+def snapshot(storage):
+    """
+    :param storage: a :class:`~memeshark.storage.MemoryStorage`
+    :return: tuple of the sorted code entity states of the commits and the parents of the remaining code entity states
+    """
+    commits = {commit_id: sorted(commit.get('code_entity_states') or [])
+               for commit_id, commit in storage.commits.items()}
+    return commits, {ces_id: ces['ce_parent_id'] for ces_id, ces in storage.code_entity_states.items()}
+
+
+class OfflineWorkerTest(unittest.TestCase):
+    """
+    Compares the merging of an :class:`~memeshark.offline.OfflineWorker` over a
+    :class:`~memeshark.storage.MemoryStorage` with the merging of the original memeSHARK.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _merge(self, storage):
+        """
+        Merges the commits of a storage that are not yet processed with an :class:`~memeshark.offline.OfflineWorker`.
+        :param storage: the :class:`~memeshark.storage.MemoryStorage`
+        """
+        commit_graph, _ = build_commit_graph(list(storage.commits.values()))
+        processed = bytearray(len(commit_graph))
+        for commit_id in storage.processed_commits(list(storage.commits)):
+            processed[commit_graph.index(commit_id)] = 1
+        chains = ChainPartition.from_graph(commit_graph, processed if sum(processed) > 0 else None)
+        status = CommitStatus(processed, array('q'))
+        work_dir = tempfile.mkdtemp(dir=self.work_dir)
+        os.mkdir(os.path.join(work_dir, 'states'))
+        # a cache of one byte spills every state of a fork commit
+        OfflineWorker(work_dir, storage, commit_graph, chains, status, cache_memory=1).run()
+
+    def _assert_merged_like_reference(self, commits, states):
+        """
+        :param commits: the commits as dicts
+        :param states: the code entity states as dicts
+        """
+        storage = MemoryStorage(copy.deepcopy(commits), copy.deepcopy(states))
+        self._merge(storage)
+        reference = MemoryStorage(copy.deepcopy(commits), copy.deepcopy(states))
+        reference_merge(reference)
+        self.assertEqual(snapshot(storage), snapshot(reference))
+        self.assertLess(len(storage.code_entity_states), len(states))
+
+    def test_fork_and_merge(self):
+        # a - b - c - e - g - h
+        #      \          /
+        #       d ------ f
+        hashes = 'abcdefgh'
+        parents = {'b': 'a', 'c': 'b', 'd': 'b', 'e': 'c', 'f': 'd', 'g': 'ef', 'h': 'g'}
+        commits = [{'_id': ObjectId(), 'revision_hash': revision_hash, 'parents': list(parents.get(revision_hash, ''))}
+                   for revision_hash in hashes]
+        for seed in range(5):
+            self._assert_merged_like_reference(commits, code_entity_states(commits, seed))
+
+    def test_generated_histories(self):
+        for seed in range(3):
+            commits = generate_history(40, branch_probability=0.2, merge_probability=0.3, seed=seed, shuffle=False)
+            self._assert_merged_like_reference(commits, code_entity_states(commits, seed))
+
+    def test_incremental(self):
+        for seed in range(3):
+            commits = generate_history(40, branch_probability=0.2, merge_probability=0.3, seed=seed, shuffle=False)
+            states = code_entity_states(commits, seed)
+            # the first run merges the older commits, the second one the commits that were added since
+            old = set(commit['_id'] for commit in commits[:25])
+            storage = MemoryStorage([copy.deepcopy(commit) for commit in commits if commit['_id'] in old],
+                                    [copy.deepcopy(ces) for ces in states if ces['commit_id'] in old])
+            reference = MemoryStorage(copy.deepcopy(list(storage.commits.values())),
+                                      copy.deepcopy(list(storage.code_entity_states.values())))
+            self._merge(storage)
+            reference_merge(reference)
+            new_commits = [commit for commit in commits if commit['_id'] not in old]
+            new_states = [ces for ces in states if ces['commit_id'] not in old]
+            storage = MemoryStorage(list(storage.commits.values()) + copy.deepcopy(new_commits),
+                                    list(storage.code_entity_states.values()) + copy.deepcopy(new_states))
+            reference = MemoryStorage(list(reference.commits.values()) + copy.deepcopy(new_commits),
+                                      list(reference.code_entity_states.values()) + copy.deepcopy(new_states))
+            self._merge(storage)
+            reference_merge(reference)
+            self.assertEqual(snapshot(storage), snapshot(reference))
+
+    def test_reparenting(self):
+        commits = [{'_id': ObjectId(), 'revision_hash': 'a', 'parents': []},
+                   {'_id': ObjectId(), 'revision_hash': 'b', 'parents': ['a']}]
+        file_id = ObjectId()
+        states = []
+        ids = {}
+        for commit, changed in zip(commits, ([], ['f0.C0.m0', 'f0.C1'])):
+            for long_name, ce_type, parent in (('f0', 'file', None), ('f0.C0', 'class', 'f0'),
+                                               ('f0.C0.m0', 'method', 'f0.C0'), ('f0.C1', 'class', 'f0'),
+                                               ('f0.C1.m0', 'method', 'f0.C1')):
+                ces_id = ObjectId()
+                ids[(commit['revision_hash'], long_name)] = ces_id
+                states.append({'_id': ces_id, 's_key': str(ces_id), 'long_name': long_name,
+                               'commit_id': commit['_id'], 'file_id': file_id, 'ce_type': ce_type,
+                               'ce_parent_id': ids.get((commit['revision_hash'], parent)),
+                               'metrics': {'loc': 2.0 if long_name in changed else 1.0}, 'imports': [], 'linter': []})
+        storage = MemoryStorage(copy.deepcopy(commits), copy.deepcopy(states))
+        self._merge(storage)
+
+        kept = storage.code_entity_states
+        # the changed method is kept and references the class of the first commit, which replaced the unchanged class
+        self.assertNotIn(ids[('b', 'f0.C0')], kept)
+        self.assertEqual(kept[ids[('b', 'f0.C0.m0')]]['ce_parent_id'], ids[('a', 'f0.C0')])
+        # the unchanged method of a changed class is kept, such that it references the changed class
+        self.assertEqual(kept[ids[('b', 'f0.C1.m0')]]['ce_parent_id'], ids[('b', 'f0.C1')])
+        self.assertEqual(kept[ids[('b', 'f0.C1')]]['ce_parent_id'], ids[('a', 'f0')])
+        self.assertEqual(sorted(storage.commits[commits[1]['_id']]['code_entity_states']),
+                         sorted([ids[('a', 'f0')], ids[('a', 'f0.C0')], ids[('b', 'f0.C0.m0')], ids[('b', 'f0.C1')],
+                                 ids[('b', 'f0.C1.m0')]]))
+
+        reference = MemoryStorage(copy.deepcopy(commits), copy.deepcopy(states))
+        reference_merge(reference)
+        self.assertEqual(snapshot(storage), snapshot(reference))
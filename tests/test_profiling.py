@@ -0,0 +1,71 @@
+import cProfile
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+
+from memeshark.profiling import phases_path, PhaseTimer, profile_path, report_profiles
+from memeshark.storage import MemoryStorage
+
+
+class PhaseTimerTest(unittest.TestCase):
+    """
+    Tests the measurement of the phases of merging by the :class:`~memeshark.profiling.PhaseTimer`.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_nested_phase_pauses_enclosing_phase(self):
+        phases = PhaseTimer()
+        times = iter([0.0, 1.0, 4.0, 6.0, 7.0, 9.0])
+        with mock.patch('timeit.default_timer', lambda: next(times)):
+            with phases.phase('write'):
+                with phases.phase('delete'):
+                    pass
+                with phases.phase('delete'):
+                    pass
+        # the write phase lasts from 0 to 1, 4 to 6, and 7 to 9, the deletes from 1 to 4 and 6 to 7
+        self.assertEqual(phases.seconds['write'], 5.0)
+        self.assertEqual(phases.seconds['delete'], 4.0)
+        self.assertEqual(phases._active, [])
+
+    def test_disabled_timer(self):
+        phases = PhaseTimer(False)
+        with phases.phase('write'):
+            with phases.phase('delete'):
+                pass
+        self.assertEqual(phases.seconds, dict.fromkeys(PhaseTimer.PHASES, 0.0))
+
+    def test_memory_writer_measures_deletes(self):
+        ces_ids = [ObjectId() for _ in range(3)]
+        commit_id = ObjectId()
+        storage = MemoryStorage((), [{'_id': ces_id, 'commit_id': commit_id} for ces_id in ces_ids])
+        phases = PhaseTimer()
+        writer = storage.writer(phases=phases)
+        with phases.phase('write'):
+            writer.delete_ces(ces_ids[:2])
+        self.assertEqual(list(storage.code_entity_states), ces_ids[2:])
+        self.assertGreater(phases.seconds['delete'], 0.0)
+
+    def test_report_names_unprofiled_prefetch_threads(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        sorted(range(100))
+        profile.disable()
+        profile.dump_stats(profile_path(self.work_dir, 0))
+        phases = PhaseTimer()
+        phases.seconds['read'] = 1.0
+        phases.save(phases_path(self.work_dir, 0))
+        report_profiles(self.work_dir, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, 'memeshark.prof')))
+        with open(os.path.join(self.work_dir, 'report.txt'), 'r') as f:
+            report = f.read()
+        self.assertIn("bound by the latency of the MongoDB", report)
+        self.assertIn("prefetch threads are not profiled", report)
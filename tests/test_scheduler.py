@@ -0,0 +1,185 @@
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+from array import array
+
+from benchmark import generate_history
+from memeshark.graph import build_commit_graph, ChainPartition
+from memeshark.scheduler import estimate_makespan, Job, Scheduler, WorkerError
+from tests.test_graph import commits_of, FORK_AND_MERGE
+
+
+class ChainWorker(object):
+    """
+    Worker that follows the protocol of the :class:`~memeshark.memeshark.MemeSHARKWorker` without merging, i.e., it
+    continues with the first branch of a chain, hands the other branches back to the scheduler, and returns its
+    statistics after the sentinel. It records the chains that it processed.
+    :param number: number of the worker
+    :param jobs: dict from the numbers of the jobs to their chains
+    :param task_queue: queue from which the worker takes its tasks
+    :param result_queue: queue through which the worker reports to the scheduler
+    :param fail: chains whose tasks fail (optional)
+    """
+
+    def __init__(self, number, jobs, task_queue, result_queue, fail=()):
+        self.number = number
+        self.name = 'worker%i' % number
+        self.jobs = jobs
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.fail = fail
+        self.exitcode = None
+        self.processed = []
+        self.sentinels = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                self.sentinels += 1
+                break
+            job, chain = task
+            chains = self.jobs[job]
+            if chain in self.fail:
+                self.result_queue.put(('failed', self.number, task, 'error', 0, 1))
+                continue
+            commits = 0
+            finished = []
+            while True:
+                self.processed.append((job, chain))
+                commits += chains.length(chain)
+                finished.append((chain, None))
+                children = chains.children(chain)
+                if len(children) == 0:
+                    break
+                if len(children) > 1:
+                    self.result_queue.put(('spawned', self.number, job, list(children[1:]), finished))
+                    finished = []
+                chain = children[0]
+            self.result_queue.put(('done', self.number, task, commits, finished, 1, 2))
+        self.result_queue.put(('stats', self.number, 10, 20))
+        self.exitcode = 0
+
+
+class SchedulerTest(unittest.TestCase):
+    """
+    Tests the dispatching of the chains by the :class:`~memeshark.scheduler.Scheduler` and its shutdown protocol.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.task_queue = queue.Queue()
+        self.result_queue = queue.Queue()
+        self.chains = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _job(self, number, commits, priority=0):
+        """
+        :return: tuple of the :class:`~memeshark.scheduler.Job` of a history and its initial tasks
+        """
+        commit_graph, _ = build_commit_graph(commits)
+        chains = ChainPartition.from_graph(commit_graph)
+        critical_paths = chains.critical_paths(chains.weights())
+        chains.sort_children(critical_paths)
+        self.chains[number] = chains
+        job = Job(number, 'p%i' % number, commit_graph, chains, critical_paths, len(commit_graph), self.work_dir,
+                  priority=priority)
+        return job, [chain for chain in chains if chains.parent(chain) < 0]
+
+    def _workers(self, processes, fail=()):
+        workers = [ChainWorker(number, self.chains, self.task_queue, self.result_queue, fail)
+                   for number in range(processes)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _processed(self, workers):
+        return sorted(task for worker in workers for task in worker.processed)
+
+    def test_all_chains_are_processed_once(self):
+        for processes in (1, 3):
+            self.chains = {}
+            job, tasks = self._job(0, generate_history(200, 0.2, 0.2, seed=processes, shuffle=True))
+            workers = self._workers(processes)
+            finished = []
+            scheduler = Scheduler(workers, self.task_queue, self.result_queue, finished.append)
+            scheduler.add(job, tasks)
+            scheduler.run()
+            self.assertEqual(self._processed(workers), [(0, chain) for chain in self.chains[0]])
+            self.assertEqual(finished, [job])
+            self.assertEqual(job.processed_commits, 200)
+            self.assertEqual(scheduler.processed_commits, 200)
+            self.assertEqual(job.consumers, {})
+            self.assertEqual(job.outstanding, 0)
+            self.assertEqual(scheduler.jobs, {})
+            # every worker gets one sentinel and returns its statistics
+            self.assertEqual([worker.sentinels for worker in workers], [1] * processes)
+            self.assertEqual((scheduler.ces_deleted, scheduler.ces_total), (10 * processes, 20 * processes))
+            self.assertTrue(self.task_queue.empty())
+            self.assertTrue(self.result_queue.empty())
+
+    def test_jobs_added_while_running(self):
+        first = self._job(0, generate_history(50, 0.2, 0.2, seed=0, shuffle=True))
+        jobs = queue.Queue()
+        jobs.put(self._job(1, generate_history(30, 0.2, 0.2, seed=1, shuffle=True), 1))
+        jobs.put(None)
+        workers = self._workers(2)
+        finished = []
+        scheduler = Scheduler(workers, self.task_queue, self.result_queue, finished.append)
+        scheduler.add(*first)
+        scheduler.run(jobs)
+        self.assertEqual(sorted(job.number for job in finished), [0, 1])
+        self.assertEqual(self._processed(workers), sorted([(0, chain) for chain in self.chains[0]] +
+                                                          [(1, chain) for chain in self.chains[1]]))
+        self.assertEqual([worker.sentinels for worker in workers], [1, 1])
+
+    def test_failed_task(self):
+        job, tasks = self._job(0, commits_of(FORK_AND_MERGE))
+        merge = [chain for chain in tasks if job.commit_graph.in_degree(job.chains.head(chain)) == 2][0]
+        workers = self._workers(2, fail=[merge])
+        scheduler = Scheduler(workers, self.task_queue, self.result_queue)
+        scheduler.add(job, tasks)
+        scheduler.run()
+        self.assertEqual(scheduler.failed_tasks, 1)
+        self.assertEqual(job.failed_tasks, 1)
+        self.assertNotIn((0, merge), self._processed(workers))
+        self.assertEqual(job.processed_commits, 6)
+
+    def test_terminated_worker(self):
+        job, tasks = self._job(0, commits_of(FORK_AND_MERGE))
+        worker = ChainWorker(0, self.chains, self.task_queue, self.result_queue)
+        # the worker exits without taking a task
+        worker.exitcode = 1
+        scheduler = Scheduler([worker], self.task_queue, self.result_queue)
+        scheduler.LIVENESS_INTERVAL = 0.05
+        scheduler.add(job, tasks)
+        with self.assertRaises(WorkerError):
+            scheduler.run()
+
+    def test_estimate_makespan(self):
+        commits = commits_of(FORK_AND_MERGE)
+        job, _ = self._job(0, commits)
+        chains = job.chains
+        heads = {commit['revision_hash']: chain for commit in commits for chain in chains
+                 if job.commit_graph.node_id(chains.head(chain)) == commit['_id']}
+        # the chains a - b, c - e, d - f, and g - h, where d - f has the weight 3
+        chain_weights = array('d', [2.0] * len(chains))
+        chain_weights[heads['d']] = 3.0
+        critical_paths = chains.critical_paths(chain_weights)
+        chains.sort_children(critical_paths)
+        self.assertEqual(list(chains.children(heads['a'])), [heads['d'], heads['c']])
+        self.assertEqual(estimate_makespan(chains, chain_weights, critical_paths, 1), 9)
+        # a - b and g - h start at once, the worker of a - b continues with d - f, the other one steals c - e
+        self.assertEqual(estimate_makespan(chains, chain_weights, critical_paths, 2), 5)
+        self.assertEqual(estimate_makespan(chains, chain_weights, critical_paths, 8), max(critical_paths))